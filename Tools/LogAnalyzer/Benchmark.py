@@ -0,0 +1,362 @@
+#!/usr/bin/env python
+#
+# Performance benchmark for the LogAnalyzer: generates synthetic binary and text logs from the FMT definitions of a
+# template log, then measures how fast they are read (MB/s, records/s), the peak memory used, and the time taken by
+# each test. Results are written as JSON and can be compared against a stored baseline to flag regressions.
+#
+# Usage:
+#   ./Benchmark.py -o results.json                        # benchmark 10MB logs, save the results
+#   ./Benchmark.py -b results.json                        # rerun and compare, exits with 1 on a regression
+#   ./Benchmark.py -s 50 -m ATT=10,IMU=50,GPS=5 -M bulk,line -k /tmp/logs
+#
+# Each measurement runs in a fresh interpreter, so that peak RSS covers only that log read and test run.
+#
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import platform
+import resource
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy
+
+import DataflashLog
+
+dirName = os.path.dirname(os.path.abspath(__file__))
+
+VERSION = 1
+readModes = ("bulk", "line", "lazy")
+
+# ranges of the integer format characters, and how text log values are scaled for the binary log
+_limits = dict((kind, (numpy.iinfo(numpy.dtype(t)).min, numpy.iinfo(numpy.dtype(t)).max)) for (kind, t) in
+               (('b','i1'), ('B','u1'), ('M','u1'), ('h','i2'), ('H','u2'), ('c','i2'), ('C','u2'), ('i','i4'), ('I','u4'),
+                ('e','i4'), ('E','u4'), ('L','i4'), ('q','i8'), ('Q','u8')))
+_binaryScale = {'c': 100, 'C': 100, 'e': 100, 'E': 100, 'L': 1e7}
+_textFormat = {'f': '%.7g', 'd': '%.10g', 'c': '%.2f', 'C': '%.2f', 'e': '%.2f', 'E': '%.2f', 'L': '%.7f', 'n': '%s', 'N': '%s', 'Z': '%s'}
+
+
+class LogGenerator(object):
+    '''generates synthetic logs from the FMT definitions of a template log. Each message type's values cycle through
+    the template's data for it, with time fields kept increasing and a little noise added to the other numeric fields,
+    or are synthesized when the template has none. mix maps message names to relative weights, by default the message
+    counts of the template'''
+
+    def __init__(self, template, mix=None, seed=0):
+        self.template = template
+        self.seed = seed
+        counts = dict((name, len(list(group.values())[0].lineNumbers)) for (name, group) in template.channels.items())
+        mix = mix or counts
+        for name in mix:
+            if name not in template.formats:
+                raise ValueError("No FMT definition for {} in the template log".format(name))
+        self.names = sorted(name for name in mix if mix[name] > 0 and name not in DataflashLog.DataflashLog.specialMessages)
+        if not self.names:
+            raise ValueError("Empty message mix")
+        weights = numpy.array([mix[name] for name in self.names], dtype=numpy.float64)
+        self.weights = weights / weights.sum()
+        self.msgIds = dict((name, i+1) for (i, name) in enumerate(sorted(set(self.names) | set(['PARM', 'MSG']))))
+
+    def _types(self, name):
+        cls = self.template.formats.get(name)
+        if cls is None:
+            return ({'PARM': 'Nf', 'MSG': 'Z'}[name], {'PARM': ['Name', 'Value'], 'MSG': ['Message']}[name])
+        return (cls.types, cls.labels)
+
+    def _columns(self, name, count, rng):
+        '''numeric values (or strings) for each field of count messages'''
+        (types, labels) = self._types(name)
+        group = self.template.channels.get(name, {})
+        columns = []
+        for (label, kind) in zip(labels, types):
+            values = group[label].values if label in group else None
+            if kind in 'nNZ':
+                pool = [str(v) for v in values.tolist()] if values is not None else [label]
+                columns.append([pool[i % len(pool)] for i in range(count)])
+                continue
+            try:
+                pool = numpy.asarray(values, dtype=numpy.float64) if values is not None else None
+            except (TypeError, ValueError):
+                pool = None
+            if pool is None or not len(pool) or not numpy.isfinite(pool).any():
+                pool = 100 * numpy.sin(numpy.arange(500) / 50.0)
+            pool = numpy.where(numpy.isfinite(pool), pool, 0)
+            index = numpy.arange(count)
+            column = pool[index % len(pool)]
+            if label.startswith('Time'):
+                # keep timestamps increasing from one pass through the template to the next
+                step = numpy.median(numpy.diff(pool)) if len(pool) > 1 else 1
+                column = column + (index // len(pool)) * (pool.max() - pool.min() + max(step, 1))
+            elif kind in 'fd':
+                column = column + rng.normal(0, 1e-3, count) * (numpy.abs(pool).mean() + 1e-3)
+            elif kind in 'cCeE':
+                column = column + rng.randint(-2, 3, count) * 0.01
+            elif kind == 'L':
+                column = column + rng.randint(-2, 3, count) * 1e-7
+            if kind in _limits:
+                (low, high) = _limits[kind]
+                scale = _binaryScale.get(kind, 1)
+                column = numpy.clip(column, low / float(scale), high / float(scale))
+                if kind not in _binaryScale:
+                    column = numpy.round(column).astype(numpy.int64)
+            columns.append(column)
+        return columns
+
+    def _binaryFormat(self, name):
+        (types, labels) = self._types(name)
+        fmt = DataflashLog.BinaryFormat()
+        fmt.type   = self.msgIds[name] if name != 'FMT' else DataflashLog.BinaryFormat.MSG
+        fmt.length = struct.calcsize('<3x' + ''.join(DataflashLog.BinaryFormat.struct_field_type(t) for t in types))
+        fmt.name   = name.encode('ascii')
+        fmt.types  = types.encode('ascii')
+        fmt.labels = ','.join(labels).encode('ascii')
+        return fmt
+
+    def _header(self, binary):
+        '''FMT, PARM and MSG messages for the start of the log, returns (data, number of messages)'''
+        names = sorted(self.msgIds, key=self.msgIds.get)
+        vehicle = "{} {}".format(self.template.vehicleTypeString or "ArduCopter", self.template.firmwareVersion or "V3.1")
+        if binary:
+            fmtFmt = DataflashLog.BinaryFormat()
+            pack = struct.Struct('<BBB' + ''.join(DataflashLog.BinaryFormat.struct_field_type(t) for t in 'BBnNZ')).pack
+            out = [pack(0xa3, 0x95, fmtFmt.MSG, fmtFmt.MSG, fmtFmt.SIZE, b'FMT', b'BBnNZ', b'Type,Length,Name,Format,Columns')]
+            for name in names:
+                fmt = self._binaryFormat(name)
+                out.append(pack(0xa3, 0x95, fmtFmt.MSG, fmt.type, fmt.length, fmt.name, fmt.types, fmt.labels))
+            parm = self._binaryFormat('PARM')
+            parmPack = struct.Struct('<BBB' + ''.join(DataflashLog.BinaryFormat.struct_field_type(t) for t in parm.types.decode('ascii'))).pack
+            for (param, value) in sorted(self.template.parameters.items()):
+                out.append(parmPack(0xa3, 0x95, parm.type, param.encode('ascii'), float(value)))
+            out.append(struct.pack('<BBB64s', 0xa3, 0x95, self.msgIds['MSG'], vehicle.encode('ascii')))
+            return (b''.join(out), len(out))
+        out = ["FMT, 128, 89, FMT, BBnNZ, Type,Length,Name,Format,Columns"]
+        for name in names:
+            fmt = self._binaryFormat(name)
+            out.append("FMT, {}, {}, {}, {}, {}".format(fmt.type, fmt.length, name, self._types(name)[0], ','.join(self._types(name)[1])))
+        out.extend("PARM, {}, {}".format(param, value) for (param, value) in sorted(self.template.parameters.items()))
+        out.append("MSG, {}".format(vehicle))
+        return ('\n'.join(out) + '\n', len(out))
+
+    def _messageSizes(self, binary, rng):
+        '''bytes per message of each type, for text measured over a sample of formatted lines'''
+        if binary:
+            return numpy.array([self._binaryFormat(name).length for name in self.names], dtype=numpy.float64)
+        return numpy.array([numpy.mean([len(line)+1 for line in self._textLines(name, 100, rng)]) for name in self.names])
+
+    def _textLines(self, name, count, rng):
+        (types, labels) = self._types(name)
+        line = ', '.join([name] + [_textFormat.get(kind, '%d') for kind in types])
+        columns = [column.tolist() if isinstance(column, numpy.ndarray) else column for column in self._columns(name, count, rng)]
+        return [line % row for row in zip(*columns)]
+
+    def _binaryRecords(self, name, count, rng):
+        '''count messages of one type as a (count, length) array of bytes'''
+        fmt = self._binaryFormat(name)
+        (types, labels) = self._types(name)
+        dtype = fmt.to_dtype(labels, list(types))
+        if dtype is None:
+            raise ValueError("Can't generate binary {} messages, its FMT has duplicated labels".format(name))
+        records = numpy.zeros(count, dtype=dtype)
+        for (label, kind, column) in zip(labels, types, self._columns(name, count, rng)):
+            if kind in 'nNZ':
+                records[label] = [value.encode('ascii', 'replace') if not isinstance(value, bytes) else value for value in column]
+            elif kind in _binaryScale:
+                records[label] = numpy.round(column * _binaryScale[kind])
+            else:
+                records[label] = column
+        raw = records.view(numpy.uint8).reshape(count, fmt.length)
+        raw[:, 0] = 0xa3
+        raw[:, 1] = 0x95
+        raw[:, 2] = fmt.type
+        return raw
+
+    def write(self, path, sizeMB, binary):
+        '''writes a log of about sizeMB megabytes, returns the number of messages in it'''
+        rng = numpy.random.RandomState(self.seed)
+        (header, headerCount) = self._header(binary)
+        average = float(numpy.dot(self.weights, self._messageSizes(binary, rng)))
+        count = max(1, int((sizeMB * 1024 * 1024 - len(header)) / average))
+        order = rng.choice(len(self.names), size=count, p=self.weights)
+        if binary:
+            sizes = numpy.array([self._binaryFormat(name).length for name in self.names])[order]
+            offsets = numpy.concatenate(([0], numpy.cumsum(sizes)[:-1])) + len(header)
+            data = numpy.zeros(len(header) + int(sizes.sum()), dtype=numpy.uint8)
+            data[:len(header)] = numpy.frombuffer(header, dtype=numpy.uint8)
+            for (i, name) in enumerate(self.names):
+                positions = offsets[order == i]
+                raw = self._binaryRecords(name, len(positions), rng)
+                for j in range(raw.shape[1]):
+                    data[positions + j] = raw[:, j]
+            with open(path, 'wb') as f:
+                f.write(data.tobytes())
+        else:
+            lines = [iter(self._textLines(name, int((order == i).sum()), rng)) for (i, name) in enumerate(self.names)]
+            with open(path, 'w') as f:
+                f.write(header)
+                f.write('\n'.join(next(lines[i]) for i in order.tolist()))
+                f.write('\n')
+        return count + headerCount
+
+
+def measure(logfile, mode):
+    '''reads logfile and runs the test suite over it, in this process. Returns the timings and memory use'''
+    from LogAnalyzer import TestSuite
+    startRSS = _maxRSS()
+    startTime = time.time()
+    logdata = DataflashLog.DataflashLog(logfile, bulkDecode=(mode != "line"), lazy=(mode == "lazy"))
+    parseSecs = time.time() - startTime
+    parseRSS = _maxRSS()
+    testSuite = TestSuite()
+    startTime = time.time()
+    testSuite.run(logdata, False)
+    testsSecs = time.time() - startTime
+    size = os.path.getsize(logfile)
+    return {
+        "sizeMB": size / 1048576.0,
+        "records": logdata.lineCount,
+        "parseSecs": parseSecs,
+        "MBps": size / 1048576.0 / parseSecs,
+        "recordsPerSec": logdata.lineCount / parseSecs,
+        "startRSS_MB": startRSS,
+        "parseRSS_MB": parseRSS,
+        "peakRSS_MB": _maxRSS(),
+        "testsSecs": testsSecs,
+        "tests": dict((test.name, test.execTime / 1000.0) for test in testSuite.tests if test.enable),
+    }
+
+def _maxRSS():
+    '''peak resident memory of this process in MB'''
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1048576.0 if sys.platform == 'darwin' else 1024.0)
+
+def runMeasurement(logfile, mode, repeat):
+    '''measures a log in fresh interpreters, keeping the best time and lowest memory use out of repeat runs'''
+    best = None
+    for i in range(repeat):
+        output = subprocess.check_output([sys.executable, os.path.abspath(__file__), "--measure", mode, logfile], cwd=dirName)
+        result = json.loads(output.decode('utf-8').splitlines()[-1])
+        if best is None:
+            best = result
+            continue
+        for (key, value) in result.items():
+            if key == "tests":
+                for (name, secs) in value.items():
+                    best["tests"][name] = min(best["tests"].get(name, secs), secs)
+            elif key in ("MBps", "recordsPerSec"):
+                best[key] = max(best[key], value)
+            elif isinstance(value, float):
+                best[key] = min(best[key], value)
+    return best
+
+
+def compareResults(results, baseline, tolerance=0.25, minSecs=0.05, minMB=10):
+    '''returns a list of regression descriptions, for the times or memory use in results which are more than
+    tolerance (a fraction) worse than in baseline. Changes below minSecs or minMB are ignored as noise'''
+    regressions = []
+    def check(run, what, old, new, floor):
+        if old is not None and new > old * (1 + tolerance) and new - old > floor:
+            regressions.append("{} {}: {:.3f} -> {:.3f} (+{:.0f}%)".format(run, what, old, new, 100 * (new - old) / max(old, 1e-9)))
+    for (run, result) in sorted(results["runs"].items()):
+        old = baseline.get("runs", {}).get(run)
+        if old is None:
+            continue
+        check(run, "parseSecs", old.get("parseSecs"), result["parseSecs"], minSecs)
+        check(run, "peakRSS_MB", old.get("peakRSS_MB"), result["peakRSS_MB"], minMB)
+        for (name, secs) in sorted(result["tests"].items()):
+            check(run, "test " + name, old.get("tests", {}).get(name), secs, minSecs)
+    return regressions
+
+
+def parseMix(text):
+    '''parses NAME=weight,NAME=weight'''
+    mix = {}
+    for item in text.split(','):
+        (name, weight) = item.split('=')
+        mix[name.strip()] = float(weight)
+    return mix
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the LogAnalyzer log readers and tests on synthetic logs')
+    parser.add_argument('-s', '--size', metavar='MB', type=float, default=10, help='size of each generated log in MB')
+    parser.add_argument('-f', '--format', metavar='', choices=['bin','log','both'], default='both', help='generate \'bin\', \'log\' or \'both\' kinds of log')
+    parser.add_argument('-m', '--mix', metavar='MIX', type=str, help='message mix as NAME=weight,... (default: the template\'s message counts)')
+    parser.add_argument('-t', '--template', metavar='LOG', type=str, default=os.path.join(dirName, 'examples', 'nan.log'), help='log whose FMT definitions, parameters and data are used to generate the logs')
+    parser.add_argument('-M', '--modes', metavar='MODES', type=str, default='bulk', help='comma separated read modes to measure: bulk, line (message by message) and lazy (binary logs only)')
+    parser.add_argument('-r', '--repeat', metavar='N', type=int, default=3, help='run each measurement N times and keep the best')
+    parser.add_argument('-o', '--output', metavar='FILE', type=str, help='write the results to a JSON file, which can be used as a baseline')
+    parser.add_argument('-b', '--baseline', metavar='FILE', type=str, help='compare against the results in FILE, exiting with status 1 on a regression')
+    parser.add_argument('-T', '--tolerance', metavar='FRACTION', type=float, default=0.25, help='fraction by which a time or memory use can grow before it counts as a regression')
+    parser.add_argument('-k', '--keep', metavar='DIR', type=str, help='write the generated logs to DIR and keep them, reusing any already there')
+    parser.add_argument('--seed', metavar='N', type=int, default=0, help='random seed for the generated data')
+    parser.add_argument('--measure', nargs=2, metavar=('MODE', 'LOG'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure:
+        print(json.dumps(measure(args.measure[1], args.measure[0])))
+        return
+
+    modes = [mode.strip() for mode in args.modes.split(',')]
+    for mode in modes:
+        if mode not in readModes:
+            parser.error("unknown read mode '%s'" % mode)
+    mix = parseMix(args.mix) if args.mix else None
+    generator = LogGenerator(DataflashLog.DataflashLog(args.template), mix, args.seed)
+
+    logDir = args.keep or tempfile.mkdtemp(prefix='logbench')
+    if args.keep and not os.path.isdir(logDir):
+        os.makedirs(logDir)
+    results = {
+        "version": VERSION,
+        "python": platform.python_version(),
+        "numpy": numpy.__version__,
+        "platform": platform.platform(),
+        "config": {"size": args.size, "template": os.path.basename(args.template), "mix": mix, "seed": args.seed, "repeat": args.repeat},
+        "runs": {},
+    }
+    try:
+        for kind in (['bin', 'log'] if args.format == 'both' else [args.format]):
+            logfile = os.path.join(logDir, "bench_%g_%d.%s" % (args.size, args.seed, kind))
+            if not (args.keep and os.path.exists(logfile)):
+                startTime = time.time()
+                generator.write(logfile, args.size, kind == 'bin')
+                print("Generated %s (%.1f MB) in %.1f seconds" % (logfile, os.path.getsize(logfile) / 1048576.0, time.time() - startTime))
+            for mode in modes:
+                if mode == "lazy" and kind != 'bin':
+                    continue
+                run = "%s/%s" % (kind, mode)
+                result = results["runs"][run] = runMeasurement(logfile, mode, args.repeat)
+                print("  %-9s %7.1f MB  read %6.2fs %7.1f MB/s %9.0f records/s  peak RSS %6.1f MB  tests %6.2fs" % (
+                    run, result["sizeMB"], result["parseSecs"], result["MBps"], result["recordsPerSec"], result["peakRSS_MB"], result["testsSecs"]))
+                for (name, secs) in sorted(result["tests"].items(), key=lambda item: -item[1])[:5]:
+                    print("      %-22s %8.3fs" % (name, secs))
+    finally:
+        if not args.keep:
+            shutil.rmtree(logDir, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print("Results written to file: %s" % args.output)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get("config") != results["config"]:
+            print("Warning: baseline was measured with different settings: %s" % baseline.get("config"))
+        regressions = compareResults(results, baseline, args.tolerance)
+        for regression in regressions:
+            print("REGRESSION " + regression)
+        if regressions:
+            sys.exit(1)
+        print("No regressions against %s" % args.baseline)
+
+
+if __name__ == "__main__":
+    main()
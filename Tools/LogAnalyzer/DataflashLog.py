@@ -6,9 +6,12 @@
 
 from __future__ import print_function
 import collections
+import heapq
 import os
+import mmap
 import numpy
-import bisect
+import operator
+import struct
 import sys
 import ctypes
 
@@ -42,52 +45,42 @@ class Format(object):
             pass
         return value
 
+    @staticmethod
+    def columnConverter(valueType):
+        '''returns a function converting a block of text log tokens from one column in a single step, to a numpy array
+        when every token casts to the column's type, otherwise to a list of the values trycastToFormatType gives'''
+        dtype = None
+        if valueType is not None:
+            if valueType in "fcCeELd":
+                dtype = numpy.float64
+            elif valueType in "bBhHiIMQq":
+                dtype = numpy.int64
+        def convert(tokens):
+            if dtype is None:
+                return list(tokens)
+            try:
+                return numpy.array(tokens).astype(dtype)
+            except (ValueError, OverflowError):
+                return [Format.trycastToFormatType(token, valueType) for token in tokens]
+        return convert
+
     def to_class(self):
+        # labels without a format character are left as strings, as they don't match any format
+        casts = [self.types[i] if i < len(self.types) else None for i in range(len(self.labels))]
         members = dict(
             NAME = self.name,
-            labels = self.labels[:],
+            types = self.types,
+            converters = tuple(Format.columnConverter(valueType) for valueType in casts),
         )
 
-        fieldtypes = [i for i in self.types]
-        fieldlabels = self.labels[:]
-
-        # field access
-        for (label, _type) in zip(fieldlabels, fieldtypes):
-            def createproperty(name, format):
-                # extra scope for variable sanity
-                # scaling via _NAME and def NAME(self): return self._NAME / SCALE
-                propertyname = name
-                attributename = '_' + name
-                p = property(lambda x:getattr(x, attributename),
-                             lambda x, v:setattr(x,attributename, Format.trycastToFormatType(v,format)))
-                members[propertyname] = p
-                members[attributename] = None
-            createproperty(label, _type)
-
-        # repr shows all values but the header
-        members['__repr__'] = lambda x: "<{cls} {data}>".format(cls=x.__class__.__name__, data = ' '.join(["{}:{}".format(k,getattr(x,'_'+k)) for k in x.labels]))
-
-        def init(a, *x):
-            if len(x) != len(a.labels):
+        def new(cls, *values):
+            if len(values) != len(cls.labels):
                 raise ValueError("Invalid Length")
-            #print(list(zip(a.labels, x)))
-            for (l,v) in zip(a.labels, x):
-                try:
-                    setattr(a, l, v)
-                except Exception as e:
-                    print("{} {} {} failed".format(a,l,v))
-                    print(e)
-
-        members['__init__'] = init
+            return tuple.__new__(cls, [value if valueType is None else Format.trycastToFormatType(value, valueType)
+                                       for (value, valueType) in zip(values, casts)])
+        members['__new__'] = new
 
-        # finally, create the class
-        cls = type(\
-            'Log__{:s}'.format(self.name),
-            (object,),
-            members
-        )
-        #print(members)
-        return cls
+        return _recordClass('Log__{:s}'.format(self.name), self.labels, members)
 
 
 class logheader(ctypes.LittleEndianStructure):
@@ -145,11 +138,42 @@ class BinaryFormat(ctypes.LittleEndianStructure):
     def __repr__(self):
         return "<{cls} {data}>".format(cls=self.__class__.__name__, data = ' '.join(["{}:{}".format(k,getattr(self,k)) for (k,_) in self._fields_[1:]]))
 
+    @staticmethod
+    def numpy_field_type(format):
+        '''numpy equivalent of the ctypes type in FIELD_FORMAT, char arrays become fixed length byte strings'''
+        ctype = BinaryFormat.FIELD_FORMAT[format]
+        if getattr(ctype, '_type_', None) is ctypes.c_char:
+            return numpy.dtype('S%u' % ctypes.sizeof(ctype))
+        return numpy.dtype(ctype).newbyteorder('<')
+
+    @staticmethod
+    def struct_field_type(format):
+        '''struct module equivalent of the ctypes type in FIELD_FORMAT'''
+        dtype = BinaryFormat.numpy_field_type(format)
+        if dtype.kind == 'S':
+            return '%us' % dtype.itemsize
+        return {'i': 'bhiq', 'u': 'BHIQ', 'f': '  fd'}[dtype.kind][dtype.itemsize.bit_length()-1]
+
+    def to_dtype(self, fieldlabels, fieldtypes):
+        '''returns a numpy structured dtype matching the binary layout of this message type, or None if it cannot be expressed as one'''
+        fields = [('head', 'V%u' % ctypes.sizeof(logheader))]
+        for (label, _type) in zip(fieldlabels, fieldtypes):
+            fields.append((label, BinaryFormat.numpy_field_type(_type)))
+        try:
+            dtype = numpy.dtype(fields)
+        except (ValueError, TypeError):
+            # e.g. duplicated labels
+            return None
+        if dtype.itemsize != self.length:
+            return None
+        return dtype
+
     def to_class(self):
         members = dict(
             NAME = self.name,
             MSG = self.type,
             SIZE = self.length,
+            types = self.types,
             labels = self.labels.split(",") if self.labels else [],
             _pack_ = True)
 
@@ -171,7 +195,7 @@ class BinaryFormat(ctypes.LittleEndianStructure):
                 scale = BinaryFormat.FIELD_SCALE.get(format, None)
                 p = property(lambda x:getattr(x, attributename))
                 if scale is not None:
-                    p = property(lambda x:getattr(x, attributename) / scale) 
+                    p = property(lambda x:getattr(x, attributename) / float(scale))
                 members[propertyname] = p
                 try:
                     fields.append((attributename, BinaryFormat.FIELD_FORMAT[format]))
@@ -180,6 +204,20 @@ class BinaryFormat(ctypes.LittleEndianStructure):
                     raise
             createproperty(label, _type)
         members['_fields_'] = fields
+        members['DTYPE'] = self.to_dtype(fieldlabels, fieldtypes)
+
+        # compact records for reading the log message by message, which unpack the raw fields with struct and, like
+        # the properties above, only scale values or trim char arrays when a field is read
+        conversions = {}
+        for (i, _type) in enumerate(fieldtypes):
+            scale = BinaryFormat.FIELD_SCALE.get(_type, None)
+            if scale is not None:
+                conversions[i] = lambda value, scale=float(scale): value / scale
+            elif BinaryFormat.numpy_field_type(_type).kind == 'S':
+                conversions[i] = lambda value: value.split(b'\0', 1)[0]
+        members['STRUCT'] = struct.Struct('<%ux%s' % (ctypes.sizeof(logheader), ''.join(BinaryFormat.struct_field_type(t) for t in fieldtypes)))
+        members['RECORD'] = _recordClass('Record__{:s}'.format(self.name), members['labels'], dict(
+            NAME = self.name, MSG = self.type, SIZE = self.length, types = self.types), conversions)
 
         # repr shows all values but the header
         members['__repr__'] = lambda x: "<{cls} {data}>".format(cls=x.__class__.__name__, data = ' '.join(["{}:{}".format(k,getattr(x,k)) for k in x.labels]))
@@ -201,45 +239,200 @@ class BinaryFormat(ctypes.LittleEndianStructure):
 
 BinaryFormat.SIZE = ctypes.sizeof(BinaryFormat)
 
+def _native(value):
+    '''converts a numpy scalar to the equivalent python int/float/str, leaves anything else alone'''
+    if isinstance(value, numpy.generic):
+        return value.item()
+    return value
+
+def _recordClass(className, labels, members, conversions=None):
+    '''returns a compact class for the records of one message type: a namedtuple with no per-instance __dict__, holding
+    one value per label. conversions maps a field's index to a function applied each time it is read, so e.g. scaling is
+    only done for the fields actually used, while indexing gives the stored value. Labels which aren't valid namedtuple
+    field names, or are repeated, are still readable by label'''
+    base = collections.namedtuple('Record', labels, rename=True)
+    members = dict(members, __slots__=(), labels=list(labels))
+    conversions = conversions or {}
+    for (i, label) in enumerate(labels):
+        if i in conversions:
+            members[label] = property(lambda x, i=i, convert=conversions[i]: convert(tuple.__getitem__(x, i)))
+        elif base._fields[i] != label or label in labels[i+1:]:
+            members[label] = property(operator.itemgetter(i))
+    # repr shows all values by label
+    members['__repr__'] = lambda x: "<{cls} {data}>".format(cls=x.__class__.__name__, data = ' '.join(["{}:{}".format(k,getattr(x,k)) for k in x.labels]))
+    return type(className, (base,), members)
+
+def _valuesToArray(values):
+    '''packs a list of channel values into a typed numpy array, falling back to an object array for strings or mixed types'''
+    array = numpy.array(values)
+    if array.dtype.kind not in "biuf":
+        array = numpy.array(values, dtype=object)
+    return array
+
+ChannelStats = collections.namedtuple('ChannelStats', ('count', 'min', 'max', 'mean', 'std', 'nanCount', 'infCount',
+                                                      'firstLine', 'lastLine', 'firstNaNLine', 'firstInfLine'))
+
+def _channelStats(lineNumbers, values):
+    '''summary of a channel's samples: min/max/mean/std are over the finite values (None if there are none, or the
+    values aren't numeric), the NaN/Inf counts and the lines of the first of each (None if there are none)'''
+    (nanCount, infCount, firstNaNLine, firstInfLine) = (0, 0, None, None)
+    (minimum, maximum, mean, std) = (None, None, None, None)
+    if values.dtype.kind in "fc":
+        finite = numpy.isfinite(values)
+        if not finite.all():
+            nans = numpy.flatnonzero(numpy.isnan(values))
+            infs = numpy.flatnonzero(numpy.isinf(values))
+            (nanCount, infCount) = (len(nans), len(infs))
+            firstNaNLine = int(lineNumbers[nans[0]]) if nanCount else None
+            firstInfLine = int(lineNumbers[infs[0]]) if infCount else None
+            values = values[finite]
+    elif values.dtype.kind == "O":
+        # strings, or numbers mixed with them
+        nans = [i for (i, value) in enumerate(values) if isinstance(value, float) and value != value]
+        (nanCount, firstNaNLine) = (len(nans), int(lineNumbers[nans[0]]) if nans else None)
+    if values.dtype.kind in "biuf" and len(values):
+        (minimum, maximum) = (_native(values.min()), _native(values.max()))
+        (mean, std) = (float(values.mean()), float(values.std()))
+    (firstLine, lastLine) = (int(lineNumbers[0]), int(lineNumbers[-1])) if len(lineNumbers) else (None, None)
+    return ChannelStats(len(lineNumbers), minimum, maximum, mean, std, nanCount, infCount, firstLine, lastLine, firstNaNLine, firstInfLine)
+
 class Channel(object):
     '''storage for a single stream of data, i.e. all GPS.RelAlt values'''
 
-    # TODO: rethink data storage, but do more thorough regression testing before refactoring it
+    # data is stored column-wise as two numpy arrays of equal length: lineNumbers (int64, ascending) and
+    # values (typed by the FMT field where possible). Samples added one at a time with append() are
+    # buffered in plain lists and folded into the arrays the first time the channel is read. Lazily loaded
+    # logs give each channel a loader instead, which decodes the channel's message group on first access.
+    # dictData and listData are compatibility views for older code, built on demand and cached, as are the stats.
     # TODO: store data as a scipy spline curve so we can more easily interpolate and sample the slope?
 
-    def __init__(self):
-        self.dictData = {} #  dict of linenum->value      # store dupe data in dict and list for now, until we decide which is the better way to go
-        self.listData = [] #  list of (linenum,value)     # store dupe data in dict and list for now, until we decide which is the better way to go
+    def __init__(self, lineNumbers=None, values=None, loader=None, stats=None):
+        if lineNumbers is None:
+            self._lineNumbers = numpy.zeros(0, dtype=numpy.int64)
+            self._values      = numpy.zeros(0)
+        else:
+            self._lineNumbers = numpy.asarray(lineNumbers, dtype=numpy.int64)
+            self._values      = numpy.asarray(values)
+        self._pendingLines  = []
+        self._pendingValues = []
+        self._dictData = None
+        self._listData = None
+        self._loader   = loader
+        self._stats    = stats
+
+    def append(self, lineNumber, value):
+        '''adds a single sample, line numbers must be added in ascending order'''
+        self._pendingLines.append(lineNumber)
+        self._pendingValues.append(value)
+
+    def extend(self, lineNumbers, values):
+        '''adds a block of samples from a pair of arrays, line numbers must be ascending and follow any existing data'''
+        self._flush()
+        if len(self._lineNumbers):
+            self._lineNumbers = numpy.concatenate((self._lineNumbers, numpy.asarray(lineNumbers, dtype=numpy.int64)))
+            self._values      = numpy.concatenate((self._values, numpy.asarray(values)))
+        else:
+            self._lineNumbers = numpy.asarray(lineNumbers, dtype=numpy.int64)
+            self._values      = numpy.asarray(values)
+        self._dictData = None
+        self._listData = None
+        self._stats    = None
+
+    def _flush(self):
+        if self._loader is not None:
+            loader = self._loader
+            self._loader = None
+            loader()
+        if not self._pendingLines:
+            return
+        lines  = numpy.array(self._pendingLines, dtype=numpy.int64)
+        values = _valuesToArray(self._pendingValues)
+        self._pendingLines  = []
+        self._pendingValues = []
+        self.extend(lines, values)
+
+    @property
+    def lineNumbers(self):
+        '''numpy array of the line number of each sample'''
+        self._flush()
+        return self._lineNumbers
+
+    @property
+    def values(self):
+        '''numpy array of the sample values, index-aligned with lineNumbers'''
+        self._flush()
+        return self._values
+
+    @property
+    def dictData(self):
+        '''dict of linenum->value, compatibility view'''
+        if self._dictData is None:
+            self._dictData = dict(zip(self.lineNumbers.tolist(), self.values.tolist()))
+        return self._dictData
+    @dictData.setter
+    def dictData(self, data):
+        lines = sorted(data.keys())
+        self._pendingLines  = []
+        self._pendingValues = []
+        self._lineNumbers = numpy.array(lines, dtype=numpy.int64)
+        self._values      = _valuesToArray([data[line] for line in lines])
+        self._dictData = None
+        self._listData = None
+        self._stats    = None
+
+    @property
+    def listData(self):
+        '''list of (linenum,value), compatibility view'''
+        if self._listData is None:
+            self._listData = list(zip(self.lineNumbers.tolist(), self.values.tolist()))
+        return self._listData
+    @listData.setter
+    def listData(self, data):
+        self.dictData = dict(data)
+
     def getSegment(self, startLine, endLine):
-        '''returns a segment of this data (from startLine to endLine, inclusive) as a new Channel instance'''
-        segment = Channel()
-        segment.dictData = {k:v for k,v in self.dictData.iteritems() if k >= startLine and k <= endLine}
-        return segment
+        '''returns a segment of this data (from startLine to endLine, inclusive) as a new Channel instance, sharing this channel's arrays'''
+        startIndex = numpy.searchsorted(self.lineNumbers, startLine, 'left')
+        endIndex   = numpy.searchsorted(self.lineNumbers, endLine, 'right')
+        return Channel(self.lineNumbers[startIndex:endIndex], self.values[startIndex:endIndex])
+    @property
+    def stats(self):
+        '''ChannelStats summary of the samples, computed in one pass over the arrays and cached'''
+        self._flush()
+        if self._stats is None:
+            self._stats = _channelStats(self._lineNumbers, self._values)
+        return self._stats
+
+    # min/max/avg come from the stats unless there are NaNs or Infs, which the stats leave out but these include
     def min(self):
-        return min(self.dictData.values())
+        stats = self.stats
+        if stats.min is None or stats.nanCount or stats.infCount:
+            return _native(numpy.min(self.values))
+        return stats.min
     def max(self):
-        return max(self.dictData.values())
+        stats = self.stats
+        if stats.max is None or stats.nanCount or stats.infCount:
+            return _native(numpy.max(self.values))
+        return stats.max
     def avg(self):
-        return numpy.mean(self.dictData.values())
+        stats = self.stats
+        if stats.mean is None or stats.nanCount or stats.infCount:
+            return _native(numpy.mean(self.values))
+        return stats.mean
+    def getValueAt(self, index):
+        '''returns the value at the given index within this channel's data'''
+        return _native(self.values[index])
     def getNearestValueFwd(self, lineNumber):
         '''Returns (value,lineNumber)'''
-        index = bisect.bisect_left(self.listData, (lineNumber,-99999))
-        while index<len(self.listData):
-            line  = self.listData[index][0]
-            #print("Looking forwards for nearest value to line number %d, starting at line %d" % (lineNumber,line)) # TEMP
-            if line >= lineNumber:
-                return (self.listData[index][1],line)
-            index += 1
+        index = numpy.searchsorted(self.lineNumbers, lineNumber, 'left')
+        if index < len(self.lineNumbers):
+            return (self.getValueAt(index), int(self.lineNumbers[index]))
         raise Exception("Error finding nearest value for line %d" % lineNumber)
     def getNearestValueBack(self, lineNumber):
         '''Returns (value,lineNumber)'''
-        index = bisect.bisect_left(self.listData, (lineNumber,-99999)) - 1
-        while index>=0:
-            line  = self.listData[index][0]
-            #print("Looking backwards for nearest value to line number %d, starting at line %d" % (lineNumber,line)) # TEMP
-            if line <= lineNumber:
-                return (self.listData[index][1],line)
-            index -= 1
+        index = numpy.searchsorted(self.lineNumbers, lineNumber, 'left') - 1
+        if index >= 0:
+            return (self.getValueAt(index), int(self.lineNumbers[index]))
         raise Exception("Error finding nearest value for line %d" % lineNumber)
     def getNearestValue(self, lineNumber, lookForwards=True):
         '''find the nearest data value to the given lineNumber, defaults to first looking forwards. Returns (value,lineNumber)'''
@@ -262,18 +455,270 @@ class Channel(object):
         weight = (lineNumber-prevValueLine) / float(nextValueLine-prevValueLine)
         return ((weight*prevValue) + ((1-weight)*nextValue))
     def getIndexOf(self, lineNumber):
-        '''returns the index within this channel's listData of the given lineNumber, or raises an Exception if not found'''
-        index = bisect.bisect_left(self.listData, (lineNumber,-99999))
-        #print("INDEX of line %d: %d" % (lineNumber,index))
-        #print("self.listData[index][0]: %d" % self.listData[index][0])
-        if (self.listData[index][0] == lineNumber):
-            return index
+        '''returns the index within this channel's data of the given lineNumber, or raises an Exception if not found'''
+        index = numpy.searchsorted(self.lineNumbers, lineNumber, 'left')
+        if index < len(self.lineNumbers) and self.lineNumbers[index] == lineNumber:
+            return int(index)
         else:
             raise Exception("Error finding index for line %d" % lineNumber)
 
+class TimeIndex(object):
+    '''time based access to one message group (e.g. all IMU messages) using its TimeUS/TimeMS/Time field, see
+    DataflashLog.timeIndex(). Times are in seconds. Lookups are binary searches over the group's samples sorted by
+    time, which for a well behaved log is just log order; sortedIndices maps back to the channels' own order'''
+
+    timeLabels = ('TimeUS', 'TimeMS', 'Time')
+
+    def __init__(self, group):
+        self.group = group
+        self.timeLabel = None
+        for label in TimeIndex.timeLabels:
+            if label in group:
+                self.timeLabel = label
+                break
+        if self.timeLabel is None:
+            raise KeyError("no time field in %s" % sorted(group.keys()))
+        scale = 1.0E-6 if self.timeLabel == 'TimeUS' else 1.0E-3
+        times = numpy.asarray(group[self.timeLabel].values, dtype=numpy.float64) * scale
+        if len(times) and numpy.any(times[1:] < times[:-1]):
+            self.sortedIndices = numpy.argsort(times, kind='mergesort')
+            self.times = times[self.sortedIndices]
+        else:
+            self.sortedIndices = None
+            self.times = times
+        self.lineNumbers = self._sorted(group[self.timeLabel].lineNumbers)
+
+    def _sorted(self, array):
+        return array if self.sortedIndices is None else array[self.sortedIndices]
+
+    def values(self, label):
+        '''the label's values in time order'''
+        return self._sorted(self.group[label].values)
+
+    def __len__(self):
+        return len(self.times)
+
+    def searchTime(self, time, side='left'):
+        '''numpy.searchsorted over the sample times, time can be a scalar or an array'''
+        return numpy.searchsorted(self.times, time, side)
+
+    def indexAt(self, time):
+        '''index of the last sample at or before time, -1 if there are none'''
+        return int(self.searchTime(time, 'right')) - 1
+
+    def valueAt(self, label, time, interpolate=False):
+        '''the value of label at time: that of the last sample at or before time, or if interpolate, linearly
+        interpolated between the samples either side. Raises an Exception before the first sample'''
+        if interpolate:
+            return _native(self.resample(label, [time])[0])
+        index = self.indexAt(time)
+        if index < 0:
+            raise Exception("No %s data at time %f" % (label, time))
+        return _native(self.values(label)[index])
+
+    def resample(self, label, times, interpolate=True):
+        '''label's values at each of times (an array, e.g. a common time base for several groups), either linearly
+        interpolated or, if not interpolate, from the last sample at or before each time (the first sample for times
+        before it)'''
+        values = self.values(label)
+        if interpolate:
+            return numpy.interp(times, self.times, values)
+        return values[numpy.clip(self.searchTime(times, 'right') - 1, 0, len(values)-1)]
+
+    def slice(self, startTime, endTime):
+        '''slice of the (time ordered) samples with startTime <= time <= endTime'''
+        return slice(int(self.searchTime(startTime, 'left')), int(self.searchTime(endTime, 'right')))
+
+    def segment(self, label, startTime, endTime):
+        '''returns a Channel of label's samples with startTime <= time <= endTime'''
+        timeSlice = self.slice(startTime, endTime)
+        return Channel(self.lineNumbers[timeSlice], self.values(label)[timeSlice])
+
+    def timeAtLine(self, lineNumber):
+        '''time of the first sample at or after lineNumber, or of the last sample if there are none'''
+        lineNumbers = self.group[self.timeLabel].lineNumbers
+        index = min(int(numpy.searchsorted(lineNumbers, lineNumber, 'left')), len(lineNumbers)-1)
+        if self.sortedIndices is not None:
+            index = int(numpy.flatnonzero(self.sortedIndices == index)[0])
+        return float(self.times[index])
+
+class InstanceStack(object):
+    '''the instances of a sensor family (e.g. IMU, IMU2 and IMU3) stacked into 2-D arrays of instance x sample, see
+    DataflashLog.instanceStack(). The first instance with data is the reference: its samples in time order give the
+    time base, and each other instance contributes its sample nearest in time to each of them. values[label] is the
+    (instances, samples) array of a label, lineNumbers and timeOffsets (seconds from the reference time) say which
+    sample of each instance was used. Instances without any data are left out, so names lists those stacked'''
+
+    def __init__(self, logdata, groupNames, labels):
+        indexes = [(name, logdata.timeIndex(name)) for name in groupNames]
+        indexes = [(name, index) for (name, index) in indexes if len(index)]
+        self.names  = [name for (name, index) in indexes]
+        self.labels = list(labels)
+        if not indexes:
+            self.times       = numpy.zeros(0)
+            self.lineNumbers = numpy.zeros((0, 0), dtype=numpy.int64)
+            self.timeOffsets = numpy.zeros((0, 0))
+            self.values      = dict((label, numpy.zeros((0, 0))) for label in self.labels)
+            return
+        self.times = indexes[0][1].times
+        rows = [numpy.arange(len(self.times))] + [DataflashLogHelper.nearestIndices(index.times, self.times) for (name, index) in indexes[1:]]
+        self.lineNumbers = numpy.array([index.lineNumbers[row] for ((name, index), row) in zip(indexes, rows)])
+        self.timeOffsets = numpy.array([index.times[row] - self.times for ((name, index), row) in zip(indexes, rows)])
+        self.values = dict((label, numpy.array([index.values(label)[row] for ((name, index), row) in zip(indexes, rows)]))
+                           for label in self.labels)
+
+    def __len__(self):
+        return len(self.names)
+
+    def pairs(self):
+        '''(i, j) for every pair of instances, i < j'''
+        return [(i, j) for i in range(len(self)) for j in range(i+1, len(self))]
+
+    def difference(self, labels, i, j):
+        '''per sample, the length of the vector of labels (e.g. AccX, AccY, AccZ) of instance i minus that of instance j'''
+        return numpy.sqrt(sum((self.values[label][i] - self.values[label][j])**2 for label in labels))
+
+    def spread(self, label):
+        '''per sample, the largest minus the smallest value of label across the instances'''
+        return numpy.ptp(self.values[label], axis=0)
+
+    def medianDeviation(self, labels):
+        '''(instances, samples) array of how far each instance's vector of labels is from the per sample median of all
+        of them, e.g. to pick out the odd one of three IMUs'''
+        return numpy.sqrt(sum((values - numpy.median(values, axis=0))**2 for values in (self.values[label] for label in labels)))
+
+class SegmentIndex(object):
+    '''the log split into flight mode segments, and the armed intervals from the arm/disarm events, see
+    DataflashLog.segmentIndex(). Segment i runs from startLines[i], its mode change, to endLines[i], the line before
+    the next one (or the end of the log), with startTimes/endTimes in seconds from the GPS time at those lines (None
+    without GPS data). Segments slice any channel with a binary search of its line numbers, giving array views rather
+    than copies'''
+
+    Segment = collections.namedtuple('Segment', ('mode', 'modeNum', 'startLine', 'endLine', 'startTime', 'endTime'))
+
+    ARMED, DISARMED = 10, 11  # EV ids
+
+    def __init__(self, logdata):
+        self.modeChanges = logdata.modeChanges
+        changes = sorted(logdata.modeChanges.items())
+        self.modes       = [mode for (line, (mode, modeNum)) in changes]
+        self.modeNums    = [modeNum for (line, (mode, modeNum)) in changes]
+        self.startLines  = numpy.array([line for (line, change) in changes], dtype=numpy.int64)
+        self.endLines    = numpy.append(self.startLines[1:] - 1, logdata.lineCount).astype(numpy.int64)
+        self.startTimes  = self.gpsTimesAtLines(logdata, self.startLines)
+        self.endTimes    = self.gpsTimesAtLines(logdata, self.endLines)
+
+        # pair up the arm and disarm events, a log can start or end while armed
+        (armStarts, armEnds) = ([], [])
+        if "EV" in logdata.channels:
+            ids = logdata.channels["EV"]["Id"]
+            for index in numpy.flatnonzero((ids.values == SegmentIndex.ARMED) | (ids.values == SegmentIndex.DISARMED)):
+                (line, armed) = (int(ids.lineNumbers[index]), ids.values[index] == SegmentIndex.ARMED)
+                if armed and len(armStarts) == len(armEnds):
+                    armStarts.append(line)
+                elif not armed and len(armStarts) > len(armEnds):
+                    armEnds.append(line)
+                elif not armed and not armStarts:
+                    armStarts.append(0)
+                    armEnds.append(line)
+            if len(armStarts) > len(armEnds):
+                armEnds.append(logdata.lineCount)
+        self.armStartLines = numpy.array(armStarts, dtype=numpy.int64)
+        self.armEndLines   = numpy.array(armEnds, dtype=numpy.int64)
+
+    @staticmethod
+    def gpsTimesAtLines(logdata, lineNumbers):
+        '''vectorized DataflashLogHelper.getTimeAtLine() in seconds: the GPS time of the first GPS message at or after each
+        line, or the last GPS time for lines after it. None if there is no GPS data'''
+        if "GPS" not in logdata.channels:
+            return None
+        group = logdata.channels["GPS"]
+        for (label, scale) in (("Time", 1.0E-3), ("TimeMS", 1.0E-3), ("TimeUS", 1.0E-6)):
+            if label in group:
+                break
+        else:
+            return None
+        channel = group[label]
+        if not len(channel.lineNumbers):
+            return None
+        times = numpy.asarray(channel.values, dtype=numpy.float64) * scale
+        index = numpy.searchsorted(channel.lineNumbers, lineNumbers, 'left')
+        found = index < len(times)
+        index = numpy.minimum(index, len(times)-1)
+        found &= channel.lineNumbers[index] <= logdata.lineCount
+        return numpy.where(found, times[index], times.max())
+
+    def __len__(self):
+        return len(self.startLines)
+
+    def __getitem__(self, i):
+        '''segment i as a Segment tuple'''
+        times = (None, None) if self.startTimes is None else (float(self.startTimes[i]), float(self.endTimes[i]))
+        return SegmentIndex.Segment(self.modes[i], self.modeNums[i], int(self.startLines[i]), int(self.endLines[i]), *times)
+
+    def durations(self):
+        '''array of each segment's length in seconds, counting the GPS time step which ends it, or None without GPS data'''
+        if self.startTimes is None:
+            return None
+        return self.endTimes - self.startTimes + 0.001
+
+    def indices(self, modes=None, minLengthSeconds=None):
+        '''indices of the segments in any of modes (a mode name or list of them, all modes if None) lasting longer than
+        minLengthSeconds (which needs GPS data), in log order'''
+        if isinstance(modes, str):
+            modes = [modes]
+        selected = numpy.ones(len(self), dtype=bool)
+        if modes is not None:
+            selected &= numpy.array([mode in modes for mode in self.modes], dtype=bool)
+        if minLengthSeconds is not None:
+            if self.startTimes is None:
+                raise Exception("no GPS log data found")
+            selected &= self.durations() > minLengthSeconds
+        return numpy.flatnonzero(selected)
+
+    def segments(self, modes=None, minLengthSeconds=None):
+        '''the Segments selected as by indices()'''
+        return [self[i] for i in self.indices(modes, minLengthSeconds)]
+
+    def modeAt(self, lineNumber):
+        '''the mode at lineNumber, None before the first mode change'''
+        i = int(numpy.searchsorted(self.startLines, lineNumber, 'right')) - 1
+        return self.modes[i] if i >= 0 else None
+
+    def isArmedAt(self, lineNumber):
+        '''whether the vehicle is armed at lineNumber, going by the arm/disarm events'''
+        i = int(numpy.searchsorted(self.armStartLines, lineNumber, 'right')) - 1
+        return i >= 0 and lineNumber <= self.armEndLines[i]
+
+    @staticmethod
+    def lineSlices(channel, startLines, endLines):
+        '''a slice of the channel's samples from each of startLines to the matching endLines (inclusive), found with
+        one binary search of its line numbers for all of them'''
+        starts = numpy.searchsorted(channel.lineNumbers, startLines, 'left').tolist()
+        ends   = numpy.searchsorted(channel.lineNumbers, endLines, 'right').tolist()
+        return [slice(start, end) for (start, end) in zip(starts, ends)]
+
+    def slices(self, channel, indices=None):
+        '''slices of the channel's samples in each of the segments with the given indices, all of them if None'''
+        if indices is None:
+            indices = numpy.arange(len(self))
+        return SegmentIndex.lineSlices(channel, self.startLines[indices], self.endLines[indices])
+
+    def channelSegments(self, channel, indices=None):
+        '''Channels of the samples in each of the segments with the given indices, sharing the channel's arrays'''
+        return [Channel(channel.lineNumbers[s], channel.values[s]) for s in self.slices(channel, indices)]
+
+    def armedSlices(self, channel):
+        '''slices of the channel's samples in each armed interval'''
+        return SegmentIndex.lineSlices(channel, self.armStartLines, self.armEndLines)
+
 class LogIterator:
-    '''Smart iterator that can move through a log by line number and maintain an index into the nearest values of all data channels'''
-    # TODO: LogIterator currently indexes the next available value rather than the nearest value, we should make it configurable between next/nearest
+    '''Smart iterator that can move through a log by line number and maintain an index into the values of all data channels.
+    In "next" mode (the default) each message type is indexed at its next available value, at or after the current line,
+    in "nearest" mode at the value with the nearest line number. Each iterator keeps its own position, so any number of
+    them can move through the same log independently'''
+
+    modes = ("next", "nearest")
 
     class LogIteratorSubValue:
         '''syntactic sugar to allow access by LogIterator[lineLabel][dataLabel]'''
@@ -286,45 +731,69 @@ class LogIterator:
             self.iterators = iterators
         def __getitem__(self, dataLabel):
             index = self.iterators[self.lineLabel][0]
-            return self.logdata.channels[self.lineLabel][dataLabel].listData[index][1]
+            return self.logdata.channels[self.lineLabel][dataLabel].getValueAt(index)
 
-    iterators   = {}      # lineLabel -> (listIndex,lineNumber)
     logdata     = None
     currentLine = None
 
-    def __init__(self, logdata, lineNumber=0):
+    def __init__(self, logdata, lineNumber=0, mode="next"):
+        if mode not in LogIterator.modes:
+            raise ValueError("Unknown LogIterator mode: {}".format(mode))
         self.logdata = logdata
+        self.mode = mode
         self.currentLine = lineNumber
+        self.iterators = {}    # lineLabel -> (listIndex,lineNumber)
+        self.lineNumbers = {}  # lineLabel -> line numbers of that message type
         for lineLabel in self.logdata.formats:
             if lineLabel in self.logdata.channels:
-                self.iterators[lineLabel] = ()
+                dataLabel = self.logdata.formats[lineLabel].labels[0]
+                self.lineNumbers[lineLabel] = self.logdata.channels[lineLabel][dataLabel].lineNumbers
         self.jump(lineNumber)
     def __iter__(self):
         return self
     def __getitem__(self, lineLabel):
         return LogIterator.LogIteratorSubValue(self.logdata, self.iterators, lineLabel)
+
+    # the message types are kept in a heap ordered by the line at which each one next has to move on to its following
+    # value, so stepping only touches the types which actually advance
+    def _switchLine(self, lineLabel, index):
+        '''first current line at which lineLabel should move from index to index+1, or None if index is its last value'''
+        lineNumbers = self.lineNumbers[lineLabel]
+        if index >= len(lineNumbers)-1:
+            return None
+        if self.mode == "next":
+            return int(lineNumbers[index]) + 1
+        # nearest: move on once the following value is strictly closer, ties stay with the earlier value
+        return (int(lineNumbers[index]) + int(lineNumbers[index+1])) // 2 + 1
+    def _schedule(self, lineLabel, index):
+        switchLine = self._switchLine(lineLabel, index)
+        if switchLine is not None:
+            heapq.heappush(self.pending, (switchLine, lineLabel))
+
     def next(self):
         '''increment iterator to next log line'''
         self.currentLine += 1
         if self.currentLine > self.logdata.lineCount:
             return self
-        for lineLabel in self.iterators.keys():
-            # check if the currentLine has gone past our the line we're pointing to for this type of data
-            dataLabel = self.logdata.formats[lineLabel].labels[0]
-            (index, lineNumber) = self.iterators[lineLabel]
-            # if so, and it is not the last entry in the log, then increment the indices for all dataLabels under that lineLabel
-            if (self.currentLine > lineNumber) and (index < len(self.logdata.channels[lineLabel][dataLabel].listData)-1):
-                index += 1
-                lineNumber = self.logdata.channels[lineLabel][dataLabel].listData[index][0]
-                self.iterators[lineLabel] = (index,lineNumber)
+        while self.pending and self.pending[0][0] <= self.currentLine:
+            (switchLine, lineLabel) = heapq.heappop(self.pending)
+            index = self.iterators[lineLabel][0] + 1
+            self.iterators[lineLabel] = (index, int(self.lineNumbers[lineLabel][index]))
+            self._schedule(lineLabel, index)
         return self
     def jump(self, lineNumber):
         '''jump iterator to specified log line'''
         self.currentLine = lineNumber
-        for lineLabel in self.iterators.keys():
-            dataLabel = self.logdata.formats[lineLabel].labels[0]
-            (value,lineNumber) = self.logdata.channels[lineLabel][dataLabel].getNearestValue(self.currentLine)
-            self.iterators[lineLabel] = (self.logdata.channels[lineLabel][dataLabel].getIndexOf(lineNumber), lineNumber)
+        self.pending = []
+        for (lineLabel, lineNumbers) in self.lineNumbers.items():
+            index = int(numpy.searchsorted(lineNumbers, lineNumber, 'left'))
+            if index == len(lineNumbers):
+                # nothing at or after the line, fall back to the last value
+                index -= 1
+            elif self.mode == "nearest" and index > 0 and lineNumber - lineNumbers[index-1] <= lineNumbers[index] - lineNumber:
+                index -= 1
+            self.iterators[lineLabel] = (index, int(lineNumbers[index]))
+            self._schedule(lineLabel, index)
 
 
 class DataflashLogHelper:
@@ -339,46 +808,106 @@ class DataflashLogHelper:
         timeLabel = "TimeMS"
         if "Time" in logdata.channels["GPS"]:
             timeLabel = "Time"
-        while lineNumber <= logdata.lineCount:
-            if lineNumber in logdata.channels["GPS"][timeLabel].dictData:
-                return logdata.channels["GPS"][timeLabel].dictData[lineNumber]
-            lineNumber = lineNumber + 1
+        channel = logdata.channels["GPS"][timeLabel]
+        index = numpy.searchsorted(channel.lineNumbers, lineNumber, 'left')
+        if index < len(channel.lineNumbers) and channel.lineNumbers[index] <= logdata.lineCount:
+            return channel.getValueAt(index)
 
-        sys.stderr.write("didn't find GPS data for " + str(lineNumber) + " - using maxtime\n")
-        return logdata.channels["GPS"][timeLabel].max()
+        sys.stderr.write("didn't find GPS data for " + str(max(lineNumber, logdata.lineCount+1)) + " - using maxtime\n")
+        return channel.max()
 
     @staticmethod
     def findLoiterChunks(logdata, minLengthSeconds=0, noRCInputs=True):
         '''returns a list of (to,from) pairs defining sections of the log which are in loiter mode. Ordered from longest to shortest in time. If noRCInputs == True it only returns chunks with no control inputs'''
         # TODO: implement noRCInputs handling when identifying stable loiter chunks, for now we're ignoring it
+        segments = logdata.segmentIndex()
+        if not len(segments.indices("LOITER")):
+            return []
+        chunks = [(segment.startLine, segment.endLine) for segment in segments.segments("LOITER", minLengthSeconds)]
+        chunks.sort(key=lambda chunk: chunk[1]-chunk[0], reverse=True)
+        return chunks
+
+    @staticmethod
+    def nearestIndices(times, targetTimes):
+        '''for each of targetTimes, the index of the nearest of times (which must be ascending), ties going to the earlier'''
+        times = numpy.asarray(times)
+        nextIndex = numpy.clip(numpy.searchsorted(times, targetTimes, 'left'), 0, len(times)-1)
+        prevIndex = numpy.clip(nextIndex-1, 0, len(times)-1)
+        useNext = numpy.abs(times[nextIndex]-targetTimes) < numpy.abs(times[prevIndex]-targetTimes)
+        return numpy.where(useNext, nextIndex, prevIndex)
+
+    @staticmethod
+    def alignGroups(logdata, groupName, otherGroupName, labels):
+        '''matches every message of one group (e.g. "IMU") with the message of another (e.g. "IMU2") nearest to it in time,
+        using their TimeUS/TimeMS/Time fields. Returns (times, values, otherValues): times of the groupName messages in
+        seconds and in ascending order, and dicts of label -> numpy array of the two groups' values for each of labels'''
+        group = logdata.channels[groupName]
+        otherGroup = logdata.channels[otherGroupName]
+        timeLabel = None
+        for i in 'TimeUS','TimeMS','Time':
+            if i in group and i in otherGroup:
+                timeLabel = i
+                break
+        if timeLabel is None:
+            raise Exception("no common time field in %s and %s" % (groupName, otherGroupName))
+        multiplier = 1.0E-6 if timeLabel == 'TimeUS' else 1.0E-3
+
+        def sortedByTime(group):
+            times = numpy.asarray(group[timeLabel].values, dtype=numpy.float64) * multiplier
+            order = numpy.argsort(times, kind='mergesort')
+            return (times[order], dict((label, numpy.asarray(group[label].values)[order]) for label in labels))
+        (times, values) = sortedByTime(group)
+        (otherTimes, otherValues) = sortedByTime(otherGroup)
+        if not len(times) or not len(otherTimes):
+            return (times, values, dict((label, otherValues[label][:0]) for label in labels))
+        nearest = DataflashLogHelper.nearestIndices(otherTimes, times)
+        return (times, values, dict((label, otherValues[label][nearest]) for label in labels))
 
-        def chunkSizeCompare(chunk1, chunk2):
-            chunk1Len = chunk1[1]-chunk1[0]
-            chunk2Len = chunk2[1]-chunk2[0]
-            if chunk1Len == chunk2Len:
-                return 0
-            elif chunk1Len > chunk2Len:
-                return -1
+    @staticmethod
+    def firstOrderFilter(values, dt, timeConstant, initial=0.0, blockSize=1024):
+        '''low pass filters values sampled at varying intervals dt (scalar or per sample), returning the filter output for
+        each sample: y[k] = y[k-1] + (values[k]-y[k-1])*dt[k]/timeConstant. Runs a block at a time with numpy by writing
+        the recurrence as y[k] = c[k]*y[k-1] + b[k], whose solution is y[k] = P[k]*(y[start] + sum(b[m]/P[m])) where P is
+        the running product of c'''
+        values = numpy.asarray(values, dtype=numpy.float64)
+        alpha = numpy.broadcast_to(numpy.asarray(dt, dtype=numpy.float64) / timeConstant, values.shape)
+        c = 1 - alpha
+        b = alpha * values
+        filtered = numpy.empty_like(values)
+        y = initial
+        for start in range(0, len(values), blockSize):
+            end = min(start+blockSize, len(values))
+            P = numpy.cumprod(c[start:end])
+            if numpy.abs(P).min() > 1e-100:
+                filtered[start:end] = P * (y + numpy.cumsum(b[start:end] / P))
             else:
-                return 1
-
-        od = collections.OrderedDict(sorted(logdata.modeChanges.items(), key=lambda t: t[0]))
-        chunks = []
-        for i in range(len(od.keys())):
-            if od.values()[i][0] == "LOITER":
-                startLine = od.keys()[i]
-                endLine   = None
-                if i == len(od.keys())-1:
-                    endLine = logdata.lineCount
-                else:
-                    endLine = od.keys()[i+1]-1
-                chunkTimeSeconds = (DataflashLogHelper.getTimeAtLine(logdata,endLine)-DataflashLogHelper.getTimeAtLine(logdata,startLine)+1) / 1000.0
-                if chunkTimeSeconds > minLengthSeconds:
-                    chunks.append((startLine,endLine))
-                    #print("LOITER chunk: %d to %d, %d lines" % (startLine,endLine,endLine-startLine+1))
-                    #print("  (time %d to %d, %d seconds)" % (DataflashLogHelper.getTimeAtLine(logdata,startLine), DataflashLogHelper.getTimeAtLine(logdata,endLine), chunkTimeSeconds))
-        chunks.sort(chunkSizeCompare)
-        return chunks
+                # the product has (nearly) vanished, e.g. dt >= timeConstant, step through this block instead
+                for k in range(start, end):
+                    y = c[k]*y + b[k]
+                    filtered[k] = y
+            y = filtered[end-1]
+        return filtered
+
+    @staticmethod
+    def replayMessages(logdata, types=None):
+        '''generator of (lineNumber, message) from the stored channel data of the given message types (all of them if None)
+        in line order. The messages have the NAME, labels and field attributes of those read from the log, so code written
+        against DataflashLog.readStream() can also be run over an already loaded log'''
+        groups = []
+        for name in sorted(logdata.channels if types is None else set(types) & set(logdata.channels)):
+            records = logdata.recordArray(name)
+            labels = list(records.dtype.names[1:])
+            record = _recordClass('Log__' + name, labels, dict(NAME=name))
+            rows = (row[1:] for row in records.tolist())
+            groups.append((records.lineNumber, record, rows))
+        if not groups:
+            return
+        lines = numpy.concatenate([lineNumbers for (lineNumbers, record, rows) in groups])
+        which = numpy.concatenate([numpy.full(len(lineNumbers), i, dtype=numpy.int64) for (i, (lineNumbers, record, rows)) in enumerate(groups)])
+        order = numpy.argsort(lines, kind='mergesort')
+        for (lineNumber, i) in zip(lines[order].tolist(), which[order].tolist()):
+            (lineNumbers, record, rows) = groups[i]
+            yield (lineNumber, record(*next(rows)))
 
     @staticmethod
     def isLogEmpty(logdata):
@@ -387,6 +916,8 @@ class DataflashLogHelper:
         throttleThreshold = 20
         if logdata.vehicleType == VehicleType.Copter:
             throttleThreshold = 200 # copter uses 0-1000, plane+rover use 0-100
+        if not any(channel.stats.count for group in logdata.channels.values() for channel in group.values()):
+            return "No log data"
         if "CTUN" in logdata.channels:
             try:
                 maxThrottle = logdata.channels["CTUN"]["ThrOut"].max()
@@ -408,7 +939,7 @@ class DataflashLog(object):
     floatTypes = "fcCeEL"
     charTypes  = "nNZ"    
 
-    def __init__(self, logfile=None, format="auto", ignoreBadlines=False):
+    def __init__(self, logfile=None, format="auto", ignoreBadlines=False, bulkDecode=True, lazy=False, cache=False):
         self.filename = None
 
         self.vehicleType     = None # from VehicleType enumeration; value derived from header
@@ -430,8 +961,66 @@ class DataflashLog(object):
         self.skippedLines = 0
         self.backpatch_these_modechanges = []
 
+        # set by readStream(): data messages go to streamHandler(lineNumber, message) instead of into channels
+        self.streamHandler = None
+        self.streamGPS     = None # (first, last) GPS message seen while streaming, for durationSecs
+
         if logfile:
-            self.read(logfile, format, ignoreBadlines)
+            self.read(logfile, format, ignoreBadlines, bulkDecode, lazy, cache)
+
+    def readStream(self, logfile, handler, format="auto", ignoreBadlines=False):
+        '''reads the log in a single pass, passing each data message to handler(lineNumber, message) as it is decoded
+        instead of storing it in channels, so memory use doesn't grow with the length of the log. Header info, formats,
+        parameters, messages and mode changes are still gathered as by read()'''
+        self.streamHandler = handler
+        self.streamGPS = None
+        try:
+            self.read(logfile, format, ignoreBadlines, bulkDecode=False)
+        finally:
+            self.streamHandler = None
+
+    def timeIndex(self, groupName):
+        '''returns the TimeIndex for a message group, e.g. "IMU", built on first use'''
+        if not hasattr(self, '_timeIndexes'):
+            self._timeIndexes = {}
+        index = self._timeIndexes.get(groupName)
+        if index is None or index.group is not self.channels[groupName]:
+            index = self._timeIndexes[groupName] = TimeIndex(self.channels[groupName])
+        return index
+
+    def instanceGroups(self, family):
+        '''names of the message groups holding the instances of a sensor family, e.g. ["IMU", "IMU2", "IMU3"] for "IMU"'''
+        names = [name for name in [family] + ["%s%d" % (family, i) for i in range(2, 10)] if name in self.channels]
+        # the same group can be aliased under another name, see TestSuite.run()
+        return [name for (i, name) in enumerate(names) if not any(self.channels[name] is self.channels[other] for other in names[:i])]
+
+    def instanceStack(self, family, labels):
+        '''returns an InstanceStack of the given labels of all the instances of a sensor family, e.g. "IMU"'''
+        return InstanceStack(self, self.instanceGroups(family), labels)
+
+    def segmentIndex(self):
+        '''returns the SegmentIndex of flight modes and armed intervals, built on first use'''
+        index = getattr(self, '_segmentIndex', None)
+        if index is None or index.modeChanges is not self.modeChanges:
+            index = self._segmentIndex = SegmentIndex(self)
+        return index
+
+    def channelStats(self, groupName=None):
+        '''returns {label: ChannelStats} for a message group, or {groupName: {label: ChannelStats}} for the whole log.
+        The stats of non-lazy logs are computed as they are read, or come from the cache'''
+        if groupName is not None:
+            return dict((label, channel.stats) for (label, channel) in self.channels[groupName].items())
+        return dict((name, self.channelStats(name)) for name in self.channels)
+
+    def recordArray(self, groupName):
+        '''returns the data of a message group, e.g. "ATUN", as a numpy record array with one record per message in line order,
+        holding a lineNumber field followed by a field per label (records.RateMax, records[i].RateMax). This is a cheap way
+        to work with whole messages, rather than building an object for each one'''
+        group = self.channels[groupName]
+        labels = [label for label in self.formats[groupName].labels if label in group] if groupName in self.formats else []
+        labels = labels or sorted(group)
+        arrays = [group[labels[0]].lineNumbers] + [group[label].values for label in labels]
+        return numpy.rec.fromarrays(arrays, names=['lineNumber'] + labels)
 
     def getCopterType(self):
         '''returns quad/hex/octo/tradheli if this is a copter log'''
@@ -451,9 +1040,18 @@ class DataflashLog(object):
         else:
             return ""
 
-    def read(self, logfile, format="auto", ignoreBadlines=False):
-        '''returns on successful log read (including bad lines if ignoreBadlines==True), will throw an Exception otherwise'''
+    def read(self, logfile, format="auto", ignoreBadlines=False, bulkDecode=True, lazy=False, cache=False):
+        '''returns on successful log read (including bad lines if ignoreBadlines==True), will throw an Exception otherwise.
+        bulkDecode decodes logs a whole message type at a time, set it to False to decode message by message.
+        lazy memory-maps a binary log file and only decodes each message type the first time its channels are read.
+        cache loads the log from a cache file next to it (see DataflashLogCache), writing or rebuilding the cache if
+        it is missing or stale'''
         # TODO: dataflash log parsing code is pretty hacky, should re-write more methodically
+        cacheOptions = {"format": format, "ignoreBadlines": ignoreBadlines}
+        if cache and logfile != '<stdin>':
+            import DataflashLogCache
+            if DataflashLogCache.load(self, logfile, cacheOptions):
+                return
         self.filename = logfile
         if self.filename == '<stdin>':
             f = sys.stdin
@@ -475,9 +1073,16 @@ class DataflashLog(object):
         else:
             raise ValueError("Unknown log format for {}: {}".format(self.filename, format))
 
+        lazy = lazy and head == '\xa3\x95\x80\x80' and self.filename != '<stdin>'
         if head == '\xa3\x95\x80\x80':
-            numBytes, lineNumber = self.read_binary(f, ignoreBadlines)
-            pass
+            if lazy:
+                numBytes, lineNumber = self.read_binary_bulk(f, ignoreBadlines, lazy=True)
+            elif bulkDecode:
+                numBytes, lineNumber = self.read_binary_bulk(f, ignoreBadlines)
+            else:
+                numBytes, lineNumber = self.read_binary(f, ignoreBadlines)
+        elif bulkDecode:
+            numBytes, lineNumber = self.read_text_bulk(f, ignoreBadlines)
         else:
             numBytes, lineNumber = self.read_text(f, ignoreBadlines)
 
@@ -485,20 +1090,32 @@ class DataflashLog(object):
         self.lineCount  = lineNumber
         self.filesizeKB = numBytes / 1024.0
         # TODO: switch duration calculation to use TimeMS values rather than GPS timestemp
-        if "GPS" in self.channels:
+        if "GPS" in self.channels or self.streamGPS:
+            gpsLabels = self.channels["GPS"] if "GPS" in self.channels else self.streamGPS[0].labels
             # the GPS time label changed at some point, need to handle both
             timeLabel = None
             for i in 'TimeMS','TimeUS','Time':
-                if i in self.channels["GPS"]:
+                if i in gpsLabels:
                     timeLabel = i
                     break
-            firstTimeGPS = int(self.channels["GPS"][timeLabel].listData[0][1])
-            lastTimeGPS  = int(self.channels["GPS"][timeLabel].listData[-1][1])
+            if "GPS" in self.channels:
+                firstTimeGPS = int(self.channels["GPS"][timeLabel].values[0])
+                lastTimeGPS  = int(self.channels["GPS"][timeLabel].values[-1])
+            else:
+                firstTimeGPS = int(getattr(self.streamGPS[0], timeLabel))
+                lastTimeGPS  = int(getattr(self.streamGPS[1], timeLabel))
             if timeLabel == 'TimeUS':
                 firstTimeGPS /= 1000
                 lastTimeGPS /= 1000
             self.durationSecs = (lastTimeGPS-firstTimeGPS) / 1000
 
+        # lazily loaded channels work out their stats on first use instead
+        if not lazy:
+            self.channelStats()
+
+        if cache and self.filename != '<stdin>':
+            DataflashLogCache.save(self, cacheOptions)
+
         # TODO: calculate logging rate based on timestamps
         # ...
 
@@ -587,6 +1204,10 @@ class DataflashLog(object):
             else:
                 self.handleModeChange(lineNumber, e)
         # anything else must be the log data
+        elif self.streamHandler is not None:
+            if e.NAME == "GPS":
+                self.streamGPS = (self.streamGPS[0] if self.streamGPS else e, e)
+            self.streamHandler(lineNumber, e)
         else:
             groupName = e.NAME
 
@@ -598,13 +1219,12 @@ class DataflashLog(object):
 
             # store each token in its relevant channel
             for label in e.labels:
-                value = getattr(e, label)
-                channel = self.channels[groupName][label]
-                channel.dictData[lineNumber] = value
-                channel.listData.append((lineNumber, value))
+                self.channels[groupName][label].append(lineNumber, getattr(e, label))
 
 
-    def read_text(self, f, ignoreBadlines):
+    def read_text(self, f, ignoreBadlines, groups=None):
+        '''reads a text log a line at a time. If groups is given, data lines aren't processed but gathered into it as
+        groups[name] = (lineNumbers, lines, labels) for read_text_bulk'''
         self.formats = {'FMT':Format}
         lineNumber = 0
         numBytes = 0
@@ -649,7 +1269,17 @@ class DataflashLog(object):
                 else:
                     if not tokens[0] in self.formats:
                         raise ValueError("Unknown Format {}".format(tokens[0]))
+                    group = groups.get(tokens[0]) if groups is not None else None
+                    if group is not None:
+                        if len(tokens) != len(group[2]) + 1:
+                            raise ValueError("Invalid Length")
+                        group[0].append(lineNumber)
+                        group[1].append(line)
+                        continue
                     e = self.formats[tokens[0]](*tokens[1:])
+                    if groups is not None and e.NAME not in self.specialMessages and len(set(e.labels)) == len(e.labels):
+                        groups[e.NAME] = ([lineNumber], [line], e.labels)
+                        continue
                     self.process(lineNumber, e)
             except Exception as e:
                 print("BAD LINE: " + line, file=sys.stderr)
@@ -657,6 +1287,38 @@ class DataflashLog(object):
                     raise Exception("Error parsing line %d of log file %s - %s" % (lineNumber,self.filename,e.args[0]))
         return (numBytes,lineNumber)
 
+    def read_text_bulk(self, f, ignoreBadlines, blockSize=1<<16):
+        '''text log reader which gathers the lines of each message type and converts them a column at a time with the
+        converters precompiled for its FMT, instead of creating and processing a record per line. Header lines and the
+        special messages are still handled line by line'''
+        groups = collections.OrderedDict()
+        (numBytes, lineNumber) = self.read_text(f, ignoreBadlines, groups)
+        for (name, (lineNumbers, lines, labels)) in groups.items():
+            converters = self.formats[name].converters
+            stride = len(labels) + 1
+            blocks = [[] for label in labels]
+            # the lines are kept whole while reading, as a string costs far less memory than a list of tokens, and are
+            # split a block at a time here so every column of the block is a slice of the same flat list of tokens
+            for start in range(0, len(lines), blockSize):
+                tokens = ', '.join(lines[start:start+blockSize]).split(', ')
+                for (i, convert) in enumerate(converters):
+                    blocks[i].append(convert(tokens[i+1::stride]))
+            del lines[:]
+            lineNumbers = numpy.array(lineNumbers, dtype=numpy.int64)
+            self.channels[name] = dict((label, Channel(lineNumbers, self._joinTextBlocks(blocks[i])))
+                                       for (i, label) in enumerate(labels))
+        return (numBytes, lineNumber)
+
+    @staticmethod
+    def _joinTextBlocks(blocks):
+        '''joins the converted blocks of a column, which has the same result as converting the whole column at once'''
+        if all(isinstance(block, numpy.ndarray) for block in blocks):
+            return numpy.concatenate(blocks)
+        values = []
+        for block in blocks:
+            values.extend(block.tolist() if isinstance(block, numpy.ndarray) else block)
+        return _valuesToArray(values)
+
     def read_binary(self, f, ignoreBadlines):
         lineNumber = 0
         numBytes = 0
@@ -669,28 +1331,233 @@ class DataflashLog(object):
             self.process(lineNumber, e)
         return (numBytes,lineNumber)
 
-    def _read_binary(self, f, ignoreBadlines):
+    # message types handled by process() itself rather than stored as channel data
+    specialMessages = frozenset(['FMT', 'PARM', 'MSG', 'MODE'])
+
+    def read_binary_bulk(self, f, ignoreBadlines, lazy=False):
+        '''binary log reader which decodes each message type in one step with numpy instead of one message at a time.
+        If lazy, the file is memory-mapped rather than read in, and decoding is deferred until a channel is used'''
+        if lazy:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            data = bytearray(f.read())
+        (offsets, msgids, numBytes) = self._scan_binary(data, ignoreBadlines)
+        buf = numpy.frombuffer(data, dtype=numpy.uint8)
+
+        # group the messages by type, keeping file order (and so line order) within each type
+        order  = numpy.argsort(msgids, kind='mergesort')
+        bounds = numpy.searchsorted(msgids[order], numpy.arange(257))
+        special = []
+        groups  = collections.OrderedDict()
+        for msgid in range(256):
+            indices = order[bounds[msgid]:bounds[msgid+1]]
+            if not len(indices):
+                continue
+            cls = self._formats[msgid]
+            if cls.NAME in self.specialMessages or cls.DTYPE is None:
+                special.append(indices)
+            else:
+                groups.setdefault(cls.NAME, []).append((cls, indices))
+
+        # the few messages that need per-record handling go through process() in line order
+        if special:
+            for index in numpy.sort(numpy.concatenate(special)).tolist():
+                msgid = msgids[index]
+                if msgid == BinaryFormat.MSG:
+                    continue # already handled during the scan
+                cls = self._formats[msgid]
+                offset = offsets[index]
+                self.process(index+1, cls.RECORD._make(cls.STRUCT.unpack_from(data, offset)))
+
+        for (name, types) in groups.items():
+            labels = self.formats[name].labels
+            if lazy:
+                self.channels[name] = self._lazy_binary_group(buf, offsets, types, labels)
+            else:
+                self.channels[name] = self._decode_binary(buf, offsets, types, labels)
+
+        return (numBytes, len(offsets))
+
+    def _lazy_binary_group(self, buf, offsets, types, labels):
+        '''returns {label:Channel} for one message group, without decoding anything until one of the channels is read'''
+        group = {}
+        def load():
+            for channel in group.values():
+                channel._loader = None
+            decoded = self._decode_binary(buf, offsets, types, labels)
+            for (label, channel) in decoded.items():
+                group[label].extend(channel.lineNumbers, channel.values)
+        for label in labels:
+            group[label] = Channel(loader=load)
+        return group
+
+    def _scan_binary(self, data, ignoreBadlines):
+        '''first pass over a binary log, registering FMT messages as they are found. Returns (offsets,msgids,numBytes)
+        where offsets and msgids are numpy arrays with one entry per message in file order'''
+        self._formats = {BinaryFormat.MSG:BinaryFormat}
+        sizes = numpy.zeros(256, dtype=numpy.int64)
+        sizes[BinaryFormat.MSG] = BinaryFormat.SIZE
+        buf = numpy.frombuffer(data, dtype=numpy.uint8)
+        end = len(buf)
+        runs = []
+        count = 0
+        offset = 0
+        while end > offset + ctypes.sizeof(logheader):
+            # check the message at offset exactly as _read_binary would...
+            if not (buf[offset] == 0xa3 and buf[offset+1] == 0x95):
+                h = logheader.from_buffer_copy(buf[offset:offset+ctypes.sizeof(logheader)].tobytes())
+                if ignoreBadlines == False:
+                    raise ValueError(h)
+                else:
+                    if h.head1 == 0xff and h.head2 == 0xff and h.msgid == 0xff:
+                        print("Assuming EOF due to dataflash block tail filled with \\xff... (offset={off})".format(off=offset), file=sys.stderr)
+                        break
+                    offset += 1
+                    continue
+            msgid = int(buf[offset+2])
+            size = int(sizes[msgid])
+            if not size:
+                raise ValueError(str(logheader.from_buffer_copy(buf[offset:offset+ctypes.sizeof(logheader)].tobytes())) + "unknown type")
+            if end <= offset + size:
+                break
+            if msgid == BinaryFormat.MSG:
+                self.process(count+1, BinaryFormat.from_buffer_copy(buf[offset:offset+size].tobytes()))
+                for (typeid, cls) in self._formats.items():
+                    sizes[typeid] = cls.SIZE
+                runs.append(numpy.array([offset], dtype=numpy.int64))
+                count += 1
+                offset += size
+                continue
+            # ...then let numpy follow the chain of well formed messages from there
+            (run, offset) = self._scan_binary_run(buf, offset, sizes)
+            runs.append(run)
+            count += len(run)
+
+        if runs:
+            offsets = numpy.concatenate(runs)
+        else:
+            offsets = numpy.zeros(0, dtype=numpy.int64)
+        msgids = buf[offsets+2]
+        return (offsets, msgids, int(sizes[msgids].sum()))
+
+    def _scan_binary_run(self, buf, start, sizes, blockSize=1<<18):
+        '''returns (offsets,nextOffset) for the unbroken sequence of messages starting at start, which must be a
+        valid data message. Stops before the first FMT message, unknown type or bad data, or at the end of the block'''
+        end = len(buf)
+        window = buf[start:start+blockSize+256]
+        # every position that looks like a message header, most of them are
+        candidates = numpy.flatnonzero((window[:-2] == 0xa3) & (window[1:-1] == 0x95))
+        msgids = window[candidates+2]
+        following = candidates + sizes[msgids]
+        valid = (sizes[msgids] > 0) & (msgids != BinaryFormat.MSG) & (candidates < blockSize) & (start + following < end)
+        # a header followed directly by the next header is a message, the rest are header bytes within payloads
+        chained = valid[:-1] & (following[:-1] == candidates[1:])
+        breaks = numpy.append(numpy.flatnonzero(~chained), len(candidates)-1)
+
+        pieces = []
+        i = 0
+        while True:
+            j = breaks[numpy.searchsorted(breaks, i)]
+            if not valid[j]:
+                pieces.append(candidates[i:j])
+                nextOffset = start + candidates[j]
+                break
+            pieces.append(candidates[i:j+1])
+            k = numpy.searchsorted(candidates, following[j])
+            if k == len(candidates) or candidates[k] != following[j]:
+                nextOffset = start + following[j]
+                break
+            i = k
+        return (numpy.concatenate(pieces).astype(numpy.int64) + start, int(nextOffset))
+
+    def _decode_binary(self, buf, offsets, types, labels):
+        '''decodes every message of one group in a single step, returns {label:Channel}. types is a list of
+        (cls,indices) pairs, more than one if several message ids share the same name'''
+        lineNumbers = []
+        columns = dict((label, []) for label in labels)
+        for (cls, indices) in types:
+            if list(cls.labels) != list(labels):
+                print("Mismatched FMT messages for {} .. ignoring msgid {}".format(cls.NAME, cls.MSG), file=sys.stderr)
+                continue
+            # view every possible message-sized window of the log, then pick out the rows at our offsets
+            windows = numpy.lib.stride_tricks.as_strided(buf, shape=(len(buf)-cls.SIZE+1, cls.SIZE), strides=(1, 1))
+            records = windows[offsets[indices]].view(cls.DTYPE).reshape(-1)
+            lineNumbers.append(indices + 1)
+            for (label, _type) in zip(labels, cls.types):
+                values = records[label]
+                scale = BinaryFormat.FIELD_SCALE.get(_type, None)
+                if scale is not None:
+                    values = values / float(scale)
+                elif values.dtype.kind == 'S':
+                    # match ctypes, which stops char arrays at the first NUL
+                    values = numpy.array([v.split(b'\0', 1)[0] for v in values.tolist()], dtype=object)
+                elif values.dtype.kind == 'f':
+                    values = values.astype(numpy.float64)
+                elif values.dtype.kind == 'i' or (values.dtype.kind == 'u' and values.dtype.itemsize < 8):
+                    values = values.astype(numpy.int64)
+                columns[label].append(values)
+
+        group = {}
+        if not lineNumbers:
+            return group
+        lineNumbers = numpy.concatenate(lineNumbers)
+        order = None
+        if len(types) > 1:
+            order = numpy.argsort(lineNumbers, kind='mergesort')
+            lineNumbers = lineNumbers[order]
+        for label in labels:
+            values = numpy.concatenate(columns[label])
+            if order is not None:
+                values = values[order]
+            group[label] = Channel(lineNumbers, values)
+        return group
+
+    def _read_binary(self, f, ignoreBadlines, blockSize=1<<20):
+        '''generator of the messages in a binary log, reading the file a block at a time'''
         self._formats = {128:BinaryFormat}
-        data = bytearray(f.read())
+        data = bytearray()
+        base = 0   # file offset of data[0]
         offset = 0
-        while len(data) > offset + ctypes.sizeof(logheader):
+        eof = False
+
+        def fill(data, base, offset, needed):
+            # make sure at least needed bytes from offset are buffered, unless the file ends first. The unread tail
+            # goes into a new buffer as messages already yielded still point into the old one
+            if eof or len(data) - offset >= needed:
+                return (data, base, offset, eof)
+            (data, base) = (data[offset:], base + offset)
+            while len(data) < needed:
+                block = f.read(blockSize)
+                if not block:
+                    return (data, base, 0, True)
+                data += block
+            return (data, base, 0, False)
+
+        while True:
+            (data, base, offset, eof) = fill(data, base, offset, ctypes.sizeof(logheader) + 1)
+            if not len(data) > offset + ctypes.sizeof(logheader):
+                break
             h = logheader.from_buffer(data, offset)
             if not (h.head1 == 0xa3 and h.head2 == 0x95):
                 if ignoreBadlines == False:
                     raise ValueError(h)
                 else:
                     if h.head1 == 0xff and h.head2 == 0xff and h.msgid == 0xff:
-                        print("Assuming EOF due to dataflash block tail filled with \\xff... (offset={off})".format(off=offset), file=sys.stderr)
+                        print("Assuming EOF due to dataflash block tail filled with \\xff... (offset={off})".format(off=base+offset), file=sys.stderr)
                         break
                     offset += 1
                     continue
 
             if h.msgid in self._formats:
                 typ = self._formats[h.msgid]
+                (data, base, offset, eof) = fill(data, base, offset, typ.SIZE + 1)
                 if len(data) <= offset + typ.SIZE:
                     break
                 try:
-                    e = typ.from_buffer(data, offset)
+                    if typ is BinaryFormat:
+                        e = typ.from_buffer(data, offset)
+                    else:
+                        e = typ.RECORD._make(typ.STRUCT.unpack_from(data, offset))
                 except:
                     print("data:{} offset:{} size:{} sizeof:{} sum:{}".format(len(data),offset,typ.SIZE,ctypes.sizeof(typ),offset+typ.SIZE))
                     raise
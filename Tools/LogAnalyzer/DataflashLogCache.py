@@ -0,0 +1,210 @@
+#
+# On-disk cache of parsed logs for the LogAnalyzer, stored next to the log file
+#
+# A cache file holds everything DataflashLog.read() produces: the header info, FMT table, parameters,
+# messages, mode changes and every channel's lineNumbers/values arrays and stats. Numeric arrays are written as raw
+# little-endian blocks which are memory-mapped when the cache is loaded, so opening a cached log costs
+# only the JSON header and pages of channel data are read from disk as the tests touch them.
+#
+# Layout:   8 byte magic | uint64 header length | JSON header, padded to 8 bytes | array data
+#
+# The header records the size, mtime and a hash of the head and tail of the log it was built from, plus
+# the read options, and the cache is rebuilt whenever any of them no longer match.
+#
+
+from __future__ import print_function
+import hashlib
+import json
+import mmap
+import numpy
+import os
+import struct
+import sys
+
+import DataflashLog
+
+MAGIC     = b'LACACHE\x00'
+VERSION   = 2
+EXTENSION = '.lacache'
+HASH_BLOCK = 1 << 20  # bytes hashed from each end of the log
+ALIGN     = 8
+
+
+def cachePath(logfile):
+    '''path of the cache file for the given log'''
+    return logfile + EXTENSION
+
+def logKey(logfile):
+    '''identifies the current contents of a log file: size, mtime and a sha1 of its first and last blocks'''
+    st = os.stat(logfile)
+    sha = hashlib.sha1()
+    with open(logfile, 'rb') as f:
+        sha.update(f.read(HASH_BLOCK))
+        if st.st_size > HASH_BLOCK:
+            f.seek(max(HASH_BLOCK, st.st_size - HASH_BLOCK))
+            sha.update(f.read(HASH_BLOCK))
+    return {"size": st.st_size, "mtime": st.st_mtime, "hash": sha.hexdigest()}
+
+
+# JSON can only hold unicode text, while logs hold byte strings (py2 str, py3 bytes from binary logs), so
+# byte strings are tagged and round-tripped through latin-1 to come back as the same type they went in as
+def _encode(value):
+    if isinstance(value, numpy.generic):
+        value = value.item()
+    if isinstance(value, bytes):
+        return {"b": value.decode('latin-1')}
+    if isinstance(value, (list, tuple)):
+        return [_encode(v) for v in value]
+    return value
+
+def _decode(value):
+    if isinstance(value, dict):
+        return value["b"].encode('latin-1')
+    if isinstance(value, list):
+        return [_decode(v) for v in value]
+    return value
+
+
+def _formatEntry(cls):
+    if cls is DataflashLog.Format:
+        return {"kind": "builtin"}
+    if hasattr(cls, 'SIZE'):
+        return {"kind": "binary", "type": cls.MSG, "length": cls.SIZE, "name": _encode(cls.NAME),
+                "types": _encode(cls.types), "labels": _encode(','.join(cls.labels))}
+    return {"kind": "text", "name": _encode(cls.NAME), "types": _encode(cls.types), "labels": _encode(','.join(cls.labels))}
+
+def _formatClass(entry):
+    if entry["kind"] == "builtin":
+        return DataflashLog.Format
+    if entry["kind"] == "binary":
+        fmt = DataflashLog.BinaryFormat()
+        fmt.type   = entry["type"]
+        fmt.length = entry["length"]
+        fmt.name   = _decode(entry["name"])
+        fmt.types  = _decode(entry["types"])
+        fmt.labels = _decode(entry["labels"])
+        return fmt.to_class()
+    return DataflashLog.Format(0, 0, _decode(entry["name"]), _decode(entry["types"]), _decode(entry["labels"])).to_class()
+
+
+class _Writer(object):
+    '''collects the arrays to be stored after the header, returning a header entry for each'''
+    def __init__(self):
+        self.blocks = []
+        self.size   = 0
+
+    def add(self, array):
+        if array.dtype.kind not in "biuf":
+            return {"json": _encode(array.tolist())}
+        array = numpy.ascontiguousarray(array, dtype=array.dtype.newbyteorder('<'))
+        entry = {"offset": self.size, "count": len(array), "dtype": array.dtype.str}
+        data = array.tobytes()
+        padding = -len(data) % ALIGN
+        self.blocks.append(data + b'\x00' * padding)
+        self.size += len(data) + padding
+        return entry
+
+def _readArray(buf, base, entry):
+    if "json" in entry:
+        array = numpy.empty(len(entry["json"]), dtype=object)
+        array[:] = _decode(entry["json"])
+        return array
+    if entry["count"] == 0:
+        return numpy.zeros(0, dtype=numpy.dtype(str(entry["dtype"])))
+    return numpy.frombuffer(buf, dtype=numpy.dtype(str(entry["dtype"])), count=entry["count"], offset=base + entry["offset"])
+
+
+def save(logdata, options):
+    '''writes the cache file for an already read log, failures only produce a warning as the cache is optional'''
+    path = cachePath(logdata.filename)
+    writer = _Writer()
+    channels = {}
+    for (groupName, group) in logdata.channels.items():
+        entries = {}
+        (lines, linesArray) = (None, None)
+        for (label, channel) in group.items():
+            lineNumbers = channel.lineNumbers
+            # channels of a group normally share their line numbers, store them once
+            if linesArray is None or not numpy.array_equal(lineNumbers, linesArray):
+                linesArray = lineNumbers
+                lines = writer.add(lineNumbers)
+            entries[label] = {"lines": lines, "values": writer.add(channel.values), "stats": list(channel.stats)}
+        channels[groupName] = [[_encode(label), entry] for (label, entry) in entries.items()]
+
+    header = {
+        "version": VERSION,
+        "key": logKey(logdata.filename),
+        "options": options,
+        "info": dict((name, _encode(getattr(logdata, name))) for name in
+                     ("vehicleType", "vehicleTypeString", "firmwareVersion", "firmwareHash", "freeRAM", "hardwareType",
+                      "filesizeKB", "durationSecs", "lineCount", "skippedLines")),
+        "formats": [[_encode(name), _formatEntry(cls)] for (name, cls) in logdata.formats.items()],
+        "parameters": [[_encode(name), _encode(value)] for (name, value) in logdata.parameters.items()],
+        "messages": [[_encode(line), _encode(message)] for (line, message) in logdata.messages.items()],
+        "modeChanges": [[_encode(line), _encode(change)] for (line, change) in logdata.modeChanges.items()],
+        "channels": [[_encode(name), entries] for (name, entries) in channels.items()],
+    }
+    text = json.dumps(header, sort_keys=True).encode('utf-8')
+    text += b' ' * (-len(text) % ALIGN)
+
+    tmpPath = "%s.%u.tmp" % (path, os.getpid())
+    try:
+        with open(tmpPath, 'wb') as f:
+            f.write(MAGIC)
+            f.write(struct.pack('<Q', len(text)))
+            f.write(text)
+            for block in writer.blocks:
+                f.write(block)
+        if os.name == 'nt' and os.path.exists(path):
+            os.remove(path)
+        os.rename(tmpPath, path)
+    except (IOError, OSError) as e:
+        print("Unable to write log cache {}: {}".format(path, e), file=sys.stderr)
+        try:
+            os.remove(tmpPath)
+        except OSError:
+            pass
+        return False
+    return True
+
+def load(logdata, logfile, options):
+    '''fills logdata from the cache of logfile, returns False if there is no usable cache (missing, corrupt or stale)'''
+    path = cachePath(logfile)
+    if not os.path.exists(path):
+        return False
+    try:
+        with open(path, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                return False
+            (length,) = struct.unpack('<Q', f.read(8))
+            header = json.loads(f.read(length).decode('utf-8'))
+            if header["version"] != VERSION or header["options"] != options or header["key"] != logKey(logfile):
+                return False
+            base = len(MAGIC) + 8 + length
+            if os.fstat(f.fileno()).st_size > base:
+                buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                buf = b''
+    except (IOError, OSError, ValueError, KeyError, struct.error):
+        return False
+
+    # the header comes back as unicode, which py2 can't use for attribute or class names
+    for (name, value) in header["info"].items():
+        if sys.version_info[0] < 3 and isinstance(value, type(u'')):
+            value = str(value)
+        setattr(logdata, name, _decode(value))
+    logdata.filename = logfile
+    logdata.formats = dict((_decode(name), _formatClass(entry)) for (name, entry) in header["formats"])
+    logdata.parameters = dict((_decode(name), _decode(value)) for (name, value) in header["parameters"])
+    logdata.messages = dict((line, _decode(message)) for (line, message) in header["messages"])
+    logdata.modeChanges = dict((line, tuple(_decode(change))) for (line, change) in header["modeChanges"])
+    logdata.channels = {}
+    for (groupName, entries) in header["channels"]:
+        group = logdata.channels[_decode(groupName)] = {}
+        lines = {}
+        for (label, entry) in entries:
+            key = (entry["lines"]["offset"], entry["lines"]["count"])
+            if key not in lines:
+                lines[key] = _readArray(buf, base, entry["lines"])
+            group[_decode(label)] = DataflashLog.Channel(lines[key], _readArray(buf, base, entry["values"]), stats=DataflashLog.ChannelStats(*entry["stats"]))
+    return True
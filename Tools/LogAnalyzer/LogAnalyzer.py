@@ -20,6 +20,9 @@
 from __future__ import print_function
 
 import DataflashLog
+import PlotData
+import ResultsWriter
+import TestProfiler
 
 import pprint  # temp
 import imp
@@ -27,9 +30,13 @@ import glob
 import inspect
 import os, sys
 import argparse
+import collections
+import csv
 import datetime
+import json
+import multiprocessing
 import time
-from xml.sax.saxutils import escape
+from xml.sax.saxutils import escape, quoteattr
 
 from VehicleType import VehicleType
 
@@ -40,20 +47,77 @@ class TestResult(object):
         GOOD, FAIL, WARN, UNKNOWN, NA = range(5)
     status = None
     statusMessage = "" # can be multi-line
+    dataWindows = ()   # DataWindows of the data showing the problem, written with the JSON results and plot data
+
+
+class DataWindow(object):
+    '''a range of lines (the whole log if startLine/endLine are None) and the channels ("GROUP.Label") which show the
+    problem a test found, for TestResult.dataWindows'''
+    def __init__(self, channels, startLine=None, endLine=None):
+        self.channels  = list(channels)
+        self.startLine = startLine
+        self.endLine   = endLine
+
+statusNames = ["GOOD", "FAIL", "WARN", "UNKNOWN", "NA"]  # indexed by TestResult.StatusType
 
 
 class Test(object):
     '''base class to be inherited by log tests. Each test should be quite granular so we have lots of small tests with clear results'''
+    streamTypes = None  # message types consumed by tests which can run over a streamed log, see StreamTest
+
     def __init__(self):
         self.name     = ""
         self.result   = None   # will be an instance of TestResult after being run
         self.execTime = None
         self.enable   = True
+        self.profile  = None   # filled in by TestSuite.run(profile=N), see TestProfiler
+        self.profileStacks = None
 
     def run(self, logdata, verbose=False):
         pass
 
 
+class StreamTest(Test):
+    '''base class for tests which work through the log a message at a time, so they can also be run in a single streaming
+    pass over logs too long to hold in memory (TestSuite.runStream). streamTypes lists the message types the test wants
+    ('*' for all of them), start() is called first, on_message() with each message of those types in log order, then
+    finish() once the whole log has been read, which sets self.result. run() replays an already loaded log through the
+    same hooks, which builds a message object for each record, so tests override it where they can work on the loaded
+    channels instead'''
+    streamTypes = ()
+
+    def start(self, verbose):
+        pass
+
+    def on_message(self, lineNumber, message):
+        pass
+
+    def finish(self, logdata):
+        pass
+
+    def run(self, logdata, verbose=False):
+        self.start(verbose)
+        types = None if '*' in self.streamTypes else self.streamTypes
+        for (lineNumber, message) in DataflashLog.DataflashLogHelper.replayMessages(logdata, types):
+            self.on_message(lineNumber, message)
+        self.finish(logdata)
+
+
+# the suite being run by a pool of forked workers, they inherit it (and the parsed log) from the parent
+# process rather than having it pickled across, and only send back each test's result
+_forkedSuite = None
+
+def _runForkedTest(index):
+    test = _forkedSuite.tests[index]
+    if _forkedSuite.profile:
+        (execTime, profile, stacks) = TestProfiler.profileTest(test, _forkedSuite.logdata, _forkedSuite.verbose, _forkedSuite.profile)
+        return (index, test.result, execTime, profile, dict(stacks))
+    startTime = time.time()
+    test.run(_forkedSuite.logdata, _forkedSuite.verbose)  # RUN THE TEST
+    endTime = time.time()
+    return (index, test.result, 1000 * (endTime-startTime), None, None)
+
+
 class TestSuite(object):
     '''registers test classes, loading using a basic plugin architecture, and can run them all in one run() operation'''
     def __init__(self):
@@ -76,21 +140,114 @@ class TestSuite(object):
         # m = imp.load_source("m", dirName + '/tests/TestBadParams.py')
         # self.tests.append(m.TestBadParams())
 
-    def run(self, logdata, verbose):
-        '''run all registered tests in a single call, gathering execution timing info'''
+    def run(self, logdata, verbose, jobs=1, profile=0, callback=None):
+        '''run all registered tests in a single call, gathering execution timing info.
+        jobs > 1 runs the tests in that many forked worker processes, results are kept in test order.
+        profile > 0 runs each test under cProfile/tracemalloc, keeping that many of its top functions and allocation
+        sites in test.profile and its call stacks in test.profileStacks.
+        callback(test) is called as each test finishes, in the order they finish'''
         self.logdata = logdata
+        self.verbose = verbose
+        self.profile = profile
         if 'GPS' not in self.logdata.channels and 'GPS2' in self.logdata.channels:
             # *cough*
             self.logdata.channels['GPS'] = self.logdata.channels['GPS2']
 
         self.logfile = logdata.filename
+        for test in self.tests:
+            (test.profile, test.profileStacks) = (None, None)
+        if jobs > 1 and hasattr(os, 'fork'):
+            self.runForked(jobs, callback)
+            return
         for test in self.tests:
             # run each test in turn, gathering timing info
-            if test.enable:
+            if test.enable and profile:
+                (test.execTime, test.profile, test.profileStacks) = TestProfiler.profileTest(test, self.logdata, verbose, profile)
+            elif test.enable:
                 startTime = time.time()
                 test.run(self.logdata, verbose)  # RUN THE TEST
                 endTime = time.time()
                 test.execTime = 1000 * (endTime-startTime)
+            if test.enable and callback:
+                callback(test)
+
+    def runStream(self, logfile, verbose, format="auto", ignoreBadlines=False, callback=None):
+        '''read the log in a single pass, running the tests which support it (those with streamTypes, see StreamTest) on
+        each message as it is read, without keeping the channel data. Other tests are disabled. Returns the DataflashLog,
+        which has the header info, parameters, messages and mode changes but no channels. callback(test) is called as
+        each test finishes'''
+        tests = []
+        for test in self.tests:
+            if test.enable and test.streamTypes is None:
+                test.enable = False
+            elif test.enable:
+                tests.append(test)
+                test.execTime = 0.0
+                test.start(verbose)
+
+        handlers = {}  # message type -> tests which want it
+        def dispatch(lineNumber, message):
+            if message.NAME not in handlers:
+                handlers[message.NAME] = [test for test in tests if message.NAME in test.streamTypes or '*' in test.streamTypes]
+            for test in handlers[message.NAME]:
+                startTime = time.time()
+                test.on_message(lineNumber, message)
+                test.execTime += 1000 * (time.time()-startTime)
+
+        logdata = DataflashLog.DataflashLog()
+        logdata.readStream(logfile, dispatch, format, ignoreBadlines)
+        self.logdata = logdata
+        self.logfile = logdata.filename
+        for test in tests:
+            startTime = time.time()
+            test.finish(logdata)
+            test.execTime += 1000 * (time.time()-startTime)
+            if callback:
+                callback(test)
+        return logdata
+
+    def runForked(self, jobs, callback=None):
+        '''run the enabled tests over a pool of forked worker processes'''
+        global _forkedSuite
+        indices = [i for (i, test) in enumerate(self.tests) if test.enable]
+        _forkedSuite = self
+        try:
+            try:
+                pool = multiprocessing.get_context('fork').Pool(jobs)
+            except AttributeError:
+                # python 2 always forks
+                pool = multiprocessing.Pool(jobs)
+            try:
+                for (index, result, execTime, profile, stacks) in pool.imap_unordered(_runForkedTest, indices):
+                    self.tests[index].result   = result
+                    self.tests[index].execTime = execTime
+                    self.tests[index].profile  = profile
+                    self.tests[index].profileStacks = stacks
+                    if callback:
+                        callback(self.tests[index])
+            finally:
+                pool.close()
+                pool.join()
+        finally:
+            _forkedSuite = None
+
+    def result(self, test):
+        '''a test's result as a dict of name, status (a string from statusNames), message and execTime, plus profile when
+        the tests were profiled and windows, the data of its DataWindows (see PlotData.windowData()), if it has any'''
+        result = collections.OrderedDict([
+            ("name",     test.name),
+            ("status",   statusNames[test.result.status]),
+            ("message",  test.result.statusMessage),
+            ("execTime", test.execTime)])
+        if test.profile:
+            result["profile"] = test.profile
+        if test.result.dataWindows:
+            result["windows"] = [PlotData.windowData(self.logdata, window) for window in test.result.dataWindows]
+        return result
+
+    def results(self):
+        '''the enabled tests' results in suite order, as dicts from result()'''
+        return [self.result(test) for test in self.tests if test.enable]
 
     def outputPlainText(self, outputStats):
         '''output test results in plain text'''
@@ -118,12 +275,15 @@ class TestSuite(object):
             execTime = ""
             if outputStats:
                 execTime = "  (%6.2fms)" % (test.execTime)
+            # only tests with data windows to plot are marked [GRAPH] (see PlotData), the others' lines are stripped of the
+            # message's padding instead
+            graph = "    [GRAPH]" if test.result.dataWindows and self.logdata.channels else ""
             if test.result.status == TestResult.StatusType.GOOD:
                 print("  %20s:  GOOD       %-55s%s" % (test.name, statusMessageFirstLine, execTime))
             elif test.result.status == TestResult.StatusType.FAIL:
-                print("  %20s:  FAIL       %-55s%s    [GRAPH]" % (test.name, statusMessageFirstLine, execTime))
+                print(("  %20s:  FAIL       %-55s%s%s" % (test.name, statusMessageFirstLine, execTime, graph)).rstrip())
             elif test.result.status == TestResult.StatusType.WARN:
-                print("  %20s:  WARN       %-55s%s    [GRAPH]" % (test.name, statusMessageFirstLine, execTime))
+                print(("  %20s:  WARN       %-55s%s%s" % (test.name, statusMessageFirstLine, execTime, graph)).rstrip())
             elif test.result.status == TestResult.StatusType.NA:
                 # skip any that aren't relevant for this vehicle/hardware/etc
                 continue
@@ -203,6 +363,8 @@ class TestSuite(object):
                 xml.write("    <name>" + escape(test.name) + "</name>\n")
                 xml.write("    <status>UNKNOWN</status>\n")
                 xml.write("    <message>" + escape(test.result.statusMessage) + "</message>\n")
+            if test.profile:
+                outputXMLProfile(xml, test.profile, test.execTime, "    ")
             xml.write("  </result>\n")
         xml.write("</results>\n")
 
@@ -210,51 +372,327 @@ class TestSuite(object):
 
         xml.close()
 
+    def outputProfile(self):
+        '''output each profiled test's top functions and allocation sites in plain text'''
+        print("Test Profiles:")
+        for test in self.tests:
+            if not test.enable or not test.profile:
+                continue
+            peak = "" if test.profile["peakKB"] is None else ", peak %.1fkb" % test.profile["peakKB"]
+            print("  %s  (%.2fms%s)" % (test.name, test.execTime, peak))
+            for function in test.profile["functions"]:
+                print("    %9.3fms %9.3fms %8d  %s" % (function["totalTime"], function["cumTime"], function["calls"], function["function"]))
+            for allocation in test.profile["allocations"] or []:
+                print("    %9.1fkb %8d blocks  %s" % (allocation["sizeKB"], allocation["count"], allocation["site"]))
+        print('\n')
+
+
+def outputXMLProfile(xml, profile, execTime, indent):
+    '''writes a <profile> element with a test's top functions and allocation sites'''
+    peak = "" if profile["peakKB"] is None else " peakkb=\"%.1f\"" % profile["peakKB"]
+    xml.write("%s<profile exectime=\"%.2f\"%s>\n" % (indent, execTime, peak))
+    for function in profile["functions"]:
+        xml.write("%s  <function name=%s calls=\"%d\" tottime=\"%.3f\" cumtime=\"%.3f\" />\n" % (indent, quoteattr(function["function"]), function["calls"], function["totalTime"], function["cumTime"]))
+    for allocation in profile["allocations"] or []:
+        xml.write("%s  <allocation site=%s sizekb=\"%.1f\" count=\"%d\" />\n" % (indent, quoteattr(allocation["site"]), allocation["sizeKB"], allocation["count"]))
+    xml.write("%s</profile>\n" % indent)
+
+
+# batch mode: each worker process discovers the tests once and then analyzes one log after another
+logExtensions = ('.bin', '.log')
+_batchSuite   = None
+_batchOptions = None
+
+def expandLogPaths(paths):
+    '''expands directories (recursively, picking up .bin/.log files) and glob patterns into a list of log files'''
+    logfiles = []
+    for path in paths:
+        if os.path.isdir(path):
+            for (dirpath, dirnames, filenames) in os.walk(path):
+                dirnames.sort()
+                logfiles.extend(os.path.join(dirpath, name) for name in sorted(filenames) if os.path.splitext(name)[1].lower() in logExtensions)
+        elif glob.has_magic(path):
+            logfiles.extend(sorted(glob.glob(path)))
+        else:
+            logfiles.append(path)
+    seen = set()
+    return [f for f in logfiles if not (f in seen or seen.add(f))]
+
+def logInfo(logdata):
+    '''the header info of a log, as reported in batch mode and the JSON results'''
+    return collections.OrderedDict([
+        ("vehicletype",  logdata.vehicleTypeString),
+        ("firmware",     "%s (%s)" % (logdata.firmwareVersion, logdata.firmwareHash)),
+        ("duration",     logdata.durationSecs),
+        ("sizekb",       logdata.filesizeKB),
+        ("sizelines",    logdata.lineCount),
+        ("skippedlines", logdata.skippedLines)])
+
+def _initBatchWorker(options):
+    global _batchSuite, _batchOptions
+    _batchSuite   = TestSuite()
+    _batchOptions = options
+
+def _analyzeBatchLog(job):
+    '''reads and tests a single log of a batch, returning a report dict, errors are reported rather than raised'''
+    (index, logfile) = job
+    options = _batchOptions
+    report = collections.OrderedDict([("logfile", logfile), ("error", None)])
+    try:
+        logdata = DataflashLog.DataflashLog(logfile, format=options["format"], ignoreBadlines=options["skip_bad"], lazy=options["lazy"], cache=options["cache"])
+        report.update(logInfo(logdata))
+        if options["empty"]:
+            emptyErr = DataflashLog.DataflashLogHelper.isLogEmpty(logdata)
+            if emptyErr:
+                report["error"] = "Empty log file: %s" % emptyErr
+                return (index, report)
+        _batchSuite.run(logdata, options["verbose"], profile=options["profile_tests"])
+        report["results"] = _batchSuite.results()
+    except Exception as e:
+        report["error"] = "%s: %s" % (type(e).__name__, e)
+    return (index, report)
+
+def runBatch(logfiles, options, jobs, callback=None):
+    '''analyzes each log in turn, or over a pool of jobs worker processes, calling callback(report) as each log
+    finishes. Returns the reports in the order of logfiles'''
+    reports = [None] * len(logfiles)
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs, _initBatchWorker, (options,))
+        try:
+            for (index, report) in pool.imap_unordered(_analyzeBatchLog, enumerate(logfiles)):
+                reports[index] = report
+                if callback:
+                    callback(report)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        _initBatchWorker(options)
+        for job in enumerate(logfiles):
+            (index, report) = _analyzeBatchLog(job)
+            reports[index] = report
+            if callback:
+                callback(report)
+    return reports
+
+def summarizeBatch(reports):
+    '''per test counts of each status across the batch, plus the logs it failed or warned on'''
+    summary = collections.OrderedDict()
+    for report in reports:
+        for result in report.get("results", []):
+            if result["name"] not in summary:
+                summary[result["name"]] = collections.OrderedDict([(status, 0) for status in statusNames] + [("FAIL logs", []), ("WARN logs", [])])
+            counts = summary[result["name"]]
+            counts[result["status"]] += 1
+            if result["status"] in ("FAIL", "WARN"):
+                counts[result["status"] + " logs"].append(report["logfile"])
+    return summary
+
+def outputBatchReport(report):
+    '''one line per log with its status counts, then the first line of each FAIL/WARN/UNKNOWN message'''
+    if report["error"]:
+        print("%s: ERROR %s" % (report["logfile"], report["error"]))
+        return
+    counts = collections.Counter(result["status"] for result in report["results"])
+    print("%s: %s" % (report["logfile"], ", ".join("%d %s" % (counts[status], status) for status in statusNames[:4])))
+    for result in report["results"]:
+        if result["status"] in ("FAIL", "WARN", "UNKNOWN"):
+            print("  %20s:  %-10s %s" % (result["name"], result["status"], result["message"].strip('\n\r').split('\n')[0]))
+    sys.stdout.flush()
+
+def outputBatchSummary(reports, summaryFile):
+    '''writes the combined results of a batch, the format is picked by the file extension: .json, .csv or .xml'''
+    summary = summarizeBatch(reports)
+    errors = [(report["logfile"], report["error"]) for report in reports if report["error"]]
+    ext = os.path.splitext(summaryFile)[1].lower()
+    if ext == '.json':
+        with open(summaryFile, 'w') as f:
+            json.dump(collections.OrderedDict([("logs", reports), ("tests", summary)]), f, indent=2)
+    elif ext == '.csv':
+        with open(summaryFile, 'wb' if sys.version_info[0] < 3 else 'w') as f:
+            writer = csv.writer(f)
+            writer.writerow(["test"] + statusNames)
+            for (name, counts) in summary.items():
+                writer.writerow([name] + [counts[status] for status in statusNames])
+            for (logfile, error) in errors:
+                writer.writerow(["ERROR", logfile, error])
+    elif ext == '.xml':
+        with open(summaryFile, 'w') as xml:
+            xml.write("<?xml version=\"1.0\" encoding=\"UTF-8\"?>\n")
+            xml.write("<fleetanalysis>\n")
+            xml.write("<logs>\n")
+            for report in reports:
+                if report["error"]:
+                    xml.write("  <log file=%s>\n" % quoteattr(report["logfile"]))
+                    xml.write("    <error>" + escape(report["error"]) + "</error>\n")
+                    xml.write("  </log>\n")
+                    continue
+                xml.write("  <log file=%s vehicletype=%s>\n" % (quoteattr(report["logfile"]), quoteattr(str(report["vehicletype"]))))
+                for result in report["results"]:
+                    if "profile" in result:
+                        xml.write("    <result name=%s status=\"%s\">%s\n" % (quoteattr(result["name"]), result["status"], escape(result["message"])))
+                        outputXMLProfile(xml, result["profile"], result["execTime"], "      ")
+                        xml.write("    </result>\n")
+                        continue
+                    xml.write("    <result name=%s status=\"%s\">%s</result>\n" % (quoteattr(result["name"]), result["status"], escape(result["message"])))
+                xml.write("  </log>\n")
+            xml.write("</logs>\n")
+            xml.write("<tests>\n")
+            for (name, counts) in summary.items():
+                xml.write("  <test name=%s %s />\n" % (quoteattr(name), " ".join("%s=\"%d\"" % (status.lower(), counts[status]) for status in statusNames)))
+            xml.write("</tests>\n")
+            xml.write("</fleetanalysis>\n")
+    else:
+        raise ValueError("Unknown summary format for %s, use .json, .csv or .xml" % summaryFile)
+
 
 def main():
     dirName = os.path.dirname(os.path.abspath(__file__))
 
     # deal with command line arguments
     parser = argparse.ArgumentParser(description='Analyze an APM Dataflash log for known issues')
-    parser.add_argument('logfile', type=argparse.FileType('r'), help='path to Dataflash log file (or - for stdin)')
+    parser.add_argument('logfile', nargs='+', help='path to Dataflash log file (or - for stdin). Several files, directories or glob patterns analyze them all in batch mode')
     parser.add_argument('-f', '--format',  metavar='', type=str, action='store', choices=['bin','log','auto'], default='auto', help='log file format: \'bin\',\'log\' or \'auto\'')
     parser.add_argument('-q', '--quiet',  metavar='', action='store_const', const=True, help='quiet mode, do not print results')
     parser.add_argument('-p', '--profile', metavar='', action='store_const', const=True, help='output performance profiling data')
     parser.add_argument('-s', '--skip_bad', metavar='', action='store_const', const=True, help='skip over corrupt dataflash lines')
     parser.add_argument('-e', '--empty',  metavar='', action='store_const', const=True, help='run an initial check for an empty log')
+    parser.add_argument('-l', '--lazy',   metavar='', action='store_const', const=True, help='memory-map binary logs and only decode the message types the tests use')
+    parser.add_argument('-c', '--cache',  metavar='', action='store_const', const=True, help='load the log from a cache file stored next to it, creating or refreshing the cache as needed')
+    parser.add_argument('-j', '--jobs',   metavar='N', type=int, default=1, help='run the tests (or in batch mode, the logs) in N parallel worker processes')
+    parser.add_argument('-P', '--profile_tests', metavar='N', type=int, nargs='?', const=10, default=0, help='profile each test with cProfile (and tracemalloc on python 3), reporting its top N functions and allocation sites')
+    parser.add_argument('-F', '--flamegraph', type=str, metavar='FILE', help='with --profile_tests, write the tests\' call stacks to FILE in flamegraph collapsed-stack format')
+    parser.add_argument('-J', '--json', type=str, metavar='FILE', help='write the results as each test finishes to FILE: .json for one document, .ndjson/.jsonl (or - for stdout) for a record per line, appended to so one file can collect many logs')
+    parser.add_argument('-G', '--graphs', type=str, metavar='FILE', help='write the downsampled data of the tests marked [GRAPH] to FILE, .json or else a compact binary format (see PlotData.py)')
+    parser.add_argument('-S', '--summary', type=str, metavar='FILE', help='batch mode: write the combined results of all the logs to a .json, .csv or .xml file')
+    parser.add_argument('--stream', action='store_const', const=True, help='analyze the log in a single pass without holding it in memory, only running the tests which support this')
     parser.add_argument('-x', '--xml', type=str, metavar='XML file', nargs='?', const='', default='', help='write output to specified XML file (or - for stdout)')
     parser.add_argument('-v', '--verbose', metavar='', action='store_const', const=True, help='verbose output')
     args = parser.parse_args()
 
-    # load the log
-    startTime = time.time()
-    logdata = DataflashLog.DataflashLog(args.logfile.name, format=args.format, ignoreBadlines=args.skip_bad) # read log
-    endTime = time.time()
-    if args.profile:
-        print("Log file read time: %.2f seconds" % (endTime-startTime))
-
-    # check for empty log if requested
-    if args.empty:
-        emptyErr = DataflashLog.DataflashLogHelper.isLogEmpty(logdata)
-        if emptyErr:
-            sys.stderr.write("Empty log file: %s, %s" % (logdata.filename, emptyErr))
+    if len(args.logfile) > 1 or os.path.isdir(args.logfile[0]) or glob.has_magic(args.logfile[0]):
+        if args.xml:
+            parser.error("--xml reports on a single log, use --summary in batch mode")
+        if args.flamegraph:
+            parser.error("--flamegraph profiles a single log, use --profile_tests with a .json or .xml --summary in batch mode")
+        if args.graphs:
+            parser.error("--graphs writes a single log's plot data, use --json with a .ndjson file in batch mode")
+        if args.json and not ResultsWriter.isNDJSON(args.json):
+            parser.error("--json can only append many logs' results to a .ndjson or .jsonl file")
+        logfiles = expandLogPaths(args.logfile)
+        options = dict((name, getattr(args, name)) for name in ("format", "skip_bad", "lazy", "cache", "empty", "verbose", "profile_tests"))
+        writer = None
+        if args.json:
+            writer = ResultsWriter.ResultsWriter(args.json)
+        def reportDone(report):
+            if writer:
+                writer.writeReport(report)
+            if not args.quiet:
+                outputBatchReport(report)
+        startTime = time.time()
+        try:
+            reports = runBatch(logfiles, options, args.jobs, reportDone)
+        finally:
+            if writer:
+                writer.close()
+        endTime = time.time()
+        if args.profile:
+            print("Batch run time: %.2f seconds for %d logs" % (endTime-startTime, len(logfiles)))
+        if args.summary:
+            outputBatchSummary(reports, args.summary)
+            if not args.quiet:
+                print("Summary written to file: %s" % args.summary)
+        if any(report["error"] for report in reports):
             sys.exit(1)
-
-    #run the tests, and gather timings
-    testSuite = TestSuite()
-    startTime = time.time()
-    testSuite.run(logdata, args.verbose)  # run tests
-    endTime = time.time()
-    if args.profile:
-        print("Test suite run time: %.2f seconds" % (endTime-startTime))
+        return
+
+    logfile = args.logfile[0]
+    if logfile == '-':
+        logfile = '<stdin>'
+    elif not os.path.isfile(logfile):
+        parser.error("can't open '%s'" % logfile)
+
+    if args.flamegraph and not args.profile_tests:
+        parser.error("--flamegraph needs --profile_tests")
+    if args.stream:
+        if args.empty:
+            parser.error("--empty needs the whole log loaded, it can't be used with --stream")
+        if args.profile_tests:
+            parser.error("--profile_tests profiles each test's run over the loaded log, it can't be used with --stream")
+        if args.graphs:
+            parser.error("--graphs needs the log's channel data, it can't be used with --stream")
+        # read the log and run the tests in the same pass
+        testSuite = TestSuite()
+        startTime = time.time()
+        logdata = testSuite.runStream(logfile, args.verbose, args.format, args.skip_bad)
+        endTime = time.time()
+        if args.profile:
+            print("Streaming read and test run time: %.2f seconds" % (endTime-startTime))
+        # the tests only finish once the whole log has been read, so their results are all written at the end
+        if args.json:
+            writer = ResultsWriter.ResultsWriter(args.json)
+            writer.startLog(logdata.filename, logInfo(logdata))
+            for result in testSuite.results():
+                writer.writeResult(result)
+            writer.endLog()
+            writer.close()
+    else:
+        # load the log
+        startTime = time.time()
+        logdata = DataflashLog.DataflashLog(logfile, format=args.format, ignoreBadlines=args.skip_bad, lazy=args.lazy, cache=args.cache) # read log
+        endTime = time.time()
+        if args.profile:
+            print("Log file read time: %.2f seconds" % (endTime-startTime))
+
+        # check for empty log if requested
+        if args.empty:
+            emptyErr = DataflashLog.DataflashLogHelper.isLogEmpty(logdata)
+            if emptyErr:
+                sys.stderr.write("Empty log file: %s, %s" % (logdata.filename, emptyErr))
+                sys.exit(1)
+
+        #run the tests, and gather timings
+        testSuite = TestSuite()
+        writer = None
+        if args.json:
+            writer = ResultsWriter.ResultsWriter(args.json)
+            writer.startLog(logdata.filename, logInfo(logdata))
+        def testDone(test):
+            writer.writeResult(testSuite.result(test))
+        startTime = time.time()
+        try:
+            testSuite.run(logdata, args.verbose, args.jobs, args.profile_tests, testDone if writer else None)  # run tests
+        except Exception as e:
+            if writer:
+                writer.endLog("%s: %s" % (type(e).__name__, e))
+                writer.close()
+            raise
+        endTime = time.time()
+        if writer:
+            writer.endLog()
+            writer.close()
+        if args.profile:
+            print("Test suite run time: %.2f seconds" % (endTime-startTime))
 
     # deal with output
     if not args.quiet:
         testSuite.outputPlainText(args.profile)
+        if args.profile_tests:
+            testSuite.outputProfile()
+    if args.flamegraph:
+        TestProfiler.writeCollapsedStacks(args.flamegraph, testSuite.tests)
+        if not args.quiet:
+            print("Flamegraph stacks written to file: %s\n" % args.flamegraph)
     if args.xml:
         testSuite.outputXML(args.xml)
         if not args.quiet:
             print("XML output written to file: %s\n" % args.xml)
+    if args.graphs:
+        PlotData.writePlotData(args.graphs, testSuite.logdata, testSuite.tests)
+        if not args.quiet:
+            print("Graph data written to file: %s\n" % args.graphs)
+    if args.json and args.json != '-' and not args.quiet:
+        print("JSON output written to file: %s\n" % args.json)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,205 @@
+#
+# Downsampled plot data of the LogAnalyzer's results
+#
+# A test which warns or fails can attach DataWindows to its result (see LogAnalyzer.DataWindow): the channels which show
+# the problem and the range of lines it covers. Each channel is cut to its window here and reduced to a bounded number
+# of points with Largest-Triangle-Three-Buckets, which keeps the shape of the curve, plus the window's minimum, maximum
+# and first NaN/Inf sample, so spikes and bad values survive however long the log is.
+#
+# The data of the tests marked [GRAPH] in the plain text output can be written to a .json file, or to a compact binary
+# file for a viewer to plot big logs without the raw data. The binary file is:
+#
+#   "LAPD", uint32 version, uint32 header length, the JSON header padded with spaces to a multiple of 8 bytes, data
+#
+# all little-endian. The header is the same as the .json file, except that each series' lines, times and values are
+# {"offset": bytes from the start of the data, "count": samples}, stored as uint32, float64 and float32 arrays, each
+# padded to a multiple of 8 bytes. Unlike the .json file, which writes them as null, the binary values keep their NaNs
+# and Infs.
+#
+
+from __future__ import print_function
+import collections
+import json
+import numpy
+import os
+import struct
+
+import DataflashLog
+
+MAX_POINTS = 500  # samples kept of each channel in a data window
+
+MAGIC   = b"LAPD"
+VERSION = 1
+
+
+def lttb(x, y, maxPoints):
+    '''indices of maxPoints samples of y(x) picked by Largest-Triangle-Three-Buckets: the first and last samples, and
+    from each of maxPoints-2 buckets in between the one forming the largest triangle with the previous pick and the
+    average of the next bucket. x and y must be finite'''
+    n = len(y)
+    if n <= maxPoints:
+        return numpy.arange(n)
+    if maxPoints < 3:
+        return numpy.array([0, n-1][:max(maxPoints, 0)], dtype=numpy.int64)
+    x = numpy.asarray(x, dtype=numpy.float64)
+    y = numpy.asarray(y, dtype=numpy.float64)
+    edges = numpy.linspace(1, n-1, maxPoints-1).astype(numpy.int64)  # the buckets between the first and last samples
+    indices = numpy.empty(maxPoints, dtype=numpy.int64)
+    (indices[0], indices[-1]) = (0, n-1)
+    a = 0
+    for b in range(maxPoints-2):
+        (start, end) = (edges[b], edges[b+1])
+        (nextStart, nextEnd) = (edges[b+1], edges[b+2]) if b+2 < len(edges) else (n-1, n)
+        (avgX, avgY) = (x[nextStart:nextEnd].mean(), y[nextStart:nextEnd].mean())
+        areas = numpy.abs((x[a]-avgX) * (y[start:end]-y[a]) - (x[a]-x[start:end]) * (avgY-y[a]))
+        a = start + int(numpy.argmax(areas))
+        indices[b+1] = a
+    return indices
+
+def downsample(x, y, maxPoints=MAX_POINTS):
+    '''sorted indices of at most maxPoints samples of y(x): LTTB over the finite samples, plus the minimum, maximum and
+    first non-finite sample'''
+    n = len(y)
+    if n <= maxPoints:
+        return numpy.arange(n)
+    y = numpy.asarray(y, dtype=numpy.float64)
+    finite = numpy.flatnonzero(numpy.isfinite(y))
+    extra = []
+    if len(finite) < n:
+        extra.append(int(numpy.flatnonzero(~numpy.isfinite(y))[0]))
+    if len(finite):
+        extra.extend([int(finite[numpy.argmin(y[finite])]), int(finite[numpy.argmax(y[finite])])])
+    keep = finite[lttb(numpy.asarray(x, dtype=numpy.float64)[finite], y[finite], maxPoints - len(extra))]
+    return numpy.unique(numpy.concatenate((keep, numpy.array(extra, dtype=numpy.int64))))
+
+
+def windowArrays(logdata, window, maxPoints=MAX_POINTS):
+    '''the data of a DataWindow: its line and time ranges, and for each of its channels which the log has, the line
+    numbers, times (seconds, from the group's own time field or else the GPS time, None without either) and values of
+    at most maxPoints of its samples in the window, as numpy arrays'''
+    series = collections.OrderedDict()
+    (startTime, endTime) = (None, None)
+    for name in window.channels:
+        (groupName, label) = name.split('.', 1)
+        if groupName not in logdata.channels or label not in logdata.channels[groupName]:
+            continue
+        group = logdata.channels[groupName]
+        channel = group[label]
+        startLine = window.startLine if window.startLine is not None else 0
+        endLine   = window.endLine if window.endLine is not None else logdata.lineCount
+        (s,) = DataflashLog.SegmentIndex.lineSlices(channel, [startLine], [endLine])
+        (lineNumbers, values) = (channel.lineNumbers[s], channel.values[s])
+        if values.dtype.kind not in "biuf":
+            continue
+        times = None
+        for (timeLabel, scale) in (("TimeUS", 1.0E-6), ("TimeMS", 1.0E-3), ("Time", 1.0E-3)):
+            if timeLabel in group:
+                times = numpy.asarray(group[timeLabel].values[s], dtype=numpy.float64) * scale
+                break
+        else:
+            # older logs only time their GPS messages
+            times = DataflashLog.SegmentIndex.gpsTimesAtLines(logdata, lineNumbers)
+        keep = downsample(times if times is not None else lineNumbers, values, maxPoints)
+        series[name] = collections.OrderedDict([
+            ("lines",  lineNumbers[keep]),
+            ("times",  times[keep] if times is not None else None),
+            ("values", values[keep])])
+        if times is not None and len(times):
+            startTime = times.min() if startTime is None else min(startTime, times.min())
+            endTime   = times.max() if endTime is None else max(endTime, times.max())
+    return collections.OrderedDict([
+        ("channels",  window.channels),
+        ("startLine", window.startLine),
+        ("endLine",   window.endLine),
+        ("startTime", None if startTime is None else float(startTime)),
+        ("endTime",   None if endTime is None else float(endTime)),
+        ("series",    series)])
+
+def _native(values):
+    # JSON has no NaN/Inf, write them as null
+    return [None if isinstance(value, float) and (value != value or value in (float('inf'), float('-inf'))) else value
+            for value in values.tolist()]
+
+def windowData(logdata, window, maxPoints=MAX_POINTS):
+    '''windowArrays() as JSON-able lists'''
+    data = windowArrays(logdata, window, maxPoints)
+    for (name, arrays) in data["series"].items():
+        data["series"][name] = collections.OrderedDict([
+            ("lines",  arrays["lines"].tolist()),
+            ("times",  arrays["times"].tolist() if arrays["times"] is not None else None),
+            ("values", _native(arrays["values"]))])
+    return data
+
+
+def graphTests(tests):
+    '''the enabled tests which warned or failed and have data windows, i.e. those marked [GRAPH]'''
+    return [test for test in tests if test.enable and test.result.dataWindows and
+            test.result.status in (test.result.StatusType.FAIL, test.result.StatusType.WARN)]
+
+def writePlotData(plotFile, logdata, tests, maxPoints=MAX_POINTS):
+    '''writes the data windows of the [GRAPH] tests to plotFile, .json or else the binary format described at the top
+    of this file'''
+    binary = os.path.splitext(plotFile)[1].lower() != '.json'
+    data = []  # binary: the arrays' bytes, each padded to a multiple of 8, in the order of their offsets
+    offset = [0]
+
+    def array(values, dtype):
+        if values is None:
+            return None
+        values = numpy.ascontiguousarray(values, dtype=dtype).tobytes()
+        data.append(values + b"\0" * (-len(values) % 8))
+        offset[0] += len(data[-1])
+        return collections.OrderedDict([("offset", offset[0] - len(data[-1])), ("count", len(values) // numpy.dtype(dtype).itemsize)])
+
+    results = []
+    for test in graphTests(tests):
+        windows = []
+        for window in test.result.dataWindows:
+            if not binary:
+                windows.append(windowData(logdata, window, maxPoints))
+                continue
+            window = windowArrays(logdata, window, maxPoints)
+            for (name, arrays) in window["series"].items():
+                window["series"][name] = collections.OrderedDict([
+                    ("lines",  array(arrays["lines"], '<u4')),
+                    ("times",  array(arrays["times"], '<f8')),
+                    ("values", array(arrays["values"], '<f4'))])
+            windows.append(window)
+        results.append(collections.OrderedDict([
+            ("name",    test.name),
+            ("status",  "FAIL" if test.result.status == test.result.StatusType.FAIL else "WARN"),
+            ("message", test.result.statusMessage),
+            ("windows", windows)]))
+    document = collections.OrderedDict([("logfile", logdata.filename), ("maxPoints", maxPoints), ("results", results)])
+
+    if not binary:
+        with open(plotFile, 'w') as f:
+            json.dump(document, f, separators=(',', ':'))
+        return
+    # padding the header and each array keeps the arrays aligned to 8 bytes in the file
+    header = json.dumps(document, separators=(',', ':')).encode('utf-8')
+    header += b" " * (-(len(MAGIC) + 8 + len(header)) % 8)
+    with open(plotFile, 'wb') as f:
+        f.write(MAGIC + struct.pack('<II', VERSION, len(header)) + header)
+        for values in data:
+            f.write(values)
+
+def readPlotData(plotFile):
+    '''reads a file written by writePlotData(), returning the binary format's arrays in place of their offsets'''
+    with open(plotFile, 'rb') as f:
+        contents = f.read()
+    if contents[:len(MAGIC)] != MAGIC:
+        return json.loads(contents.decode('utf-8'), object_pairs_hook=collections.OrderedDict)
+    (version, headerLength) = struct.unpack('<II', contents[len(MAGIC):len(MAGIC)+8])
+    if version != VERSION:
+        raise Exception("Unsupported plot data version %d in %s" % (version, plotFile))
+    start = len(MAGIC) + 8
+    document = json.loads(contents[start:start+headerLength].decode('utf-8'), object_pairs_hook=collections.OrderedDict)
+    start += headerLength
+    for result in document["results"]:
+        for window in result["windows"]:
+            for arrays in window["series"].values():
+                for (key, dtype) in (("lines", '<u4'), ("times", '<f8'), ("values", '<f4')):
+                    if arrays[key] is not None:
+                        arrays[key] = numpy.frombuffer(contents, dtype=dtype, count=arrays[key]["count"], offset=start+arrays[key]["offset"])
+    return document
@@ -0,0 +1,81 @@
+#
+# Machine readable JSON/NDJSON output of the LogAnalyzer's results
+#
+# Results are written as the tests finish rather than once the whole suite is done. NDJSON output (.ndjson or .jsonl,
+# or - for stdout) is one JSON object per line: a "log" record with the log's header info, a "result" record per test
+# and an "end" record with the status counts (or the error which stopped the log being analyzed). It is opened for
+# appending, so the results of many logs, e.g. from batch runs, can be collected in one file. .json output is a
+# single document per log: the header info, then a "results" list and the counts.
+#
+# Each result carries the data windows its test attached to it (TestResult.dataWindows, see LogAnalyzer.DataWindow): the
+# line range of the problem, the time range, and a downsampled series of each channel over it (see PlotData).
+#
+
+from __future__ import print_function
+import collections
+import json
+import os
+import sys
+
+
+def isNDJSON(path):
+    '''whether results written to path are NDJSON, rather than a single JSON document'''
+    return path == '-' or os.path.splitext(path)[1].lower() in ('.ndjson', '.jsonl')
+
+
+class ResultsWriter(object):
+    '''writes the results of one or more logs as they are produced, see the top of this file for the format'''
+
+    def __init__(self, path):
+        self.path   = path
+        self.ndjson = isNDJSON(path)
+        if path == '-':
+            self.f = sys.stdout
+        else:
+            self.f = open(path, 'a' if self.ndjson else 'w')
+        self.logfile = None
+        self.counts  = None
+
+    def _record(self, record):
+        self.f.write(json.dumps(record, separators=(',', ':')) + "\n")
+        self.f.flush()
+
+    def startLog(self, logfile, info):
+        '''starts the results of a log, info being a dict of its header info'''
+        self.logfile = logfile
+        self.counts  = collections.OrderedDict()
+        if self.ndjson:
+            self._record(collections.OrderedDict([("record", "log"), ("logfile", logfile)] + list(info.items())))
+        else:
+            header = json.dumps(collections.OrderedDict([("logfile", logfile)] + list(info.items())), indent=2)
+            self.f.write(header[:-2] + ',\n  "results": [')
+
+    def writeResult(self, result):
+        '''writes one test's result dict (see TestSuite.results())'''
+        first = not self.counts
+        self.counts[result["status"]] = self.counts.get(result["status"], 0) + 1
+        if self.ndjson:
+            self._record(collections.OrderedDict([("record", "result"), ("logfile", self.logfile)] + list(result.items())))
+        else:
+            self.f.write(("\n    " if first else ",\n    ") + json.dumps(result, separators=(',', ':')))
+            self.f.flush()
+
+    def endLog(self, error=None):
+        '''finishes the log's results, with the error which stopped it being analyzed, if any'''
+        if self.ndjson:
+            self._record(collections.OrderedDict([("record", "end"), ("logfile", self.logfile), ("counts", self.counts), ("error", error)]))
+        else:
+            self.f.write("\n  ],\n  \"counts\": %s,\n  \"error\": %s\n}\n" % (json.dumps(self.counts), json.dumps(error)))
+        self.logfile = None
+
+    def writeReport(self, report):
+        '''writes a whole log's batch report (see runBatch()) at once'''
+        info = collections.OrderedDict((key, value) for (key, value) in report.items() if key not in ("logfile", "error", "results"))
+        self.startLog(report["logfile"], info)
+        for result in report.get("results", []):
+            self.writeResult(result)
+        self.endLog(report["error"])
+
+    def close(self):
+        if self.f is not sys.stdout:
+            self.f.close()
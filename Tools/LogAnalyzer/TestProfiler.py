@@ -0,0 +1,122 @@
+#
+# Per-test profiling for the LogAnalyzer's TestSuite
+#
+# Each test's run() is wrapped in cProfile, and in tracemalloc where it is available (python 3.4+), to show where
+# a slow test spends its time: the functions with the most time of their own, the lines holding the most memory
+# once the test has finished and the peak memory traced while it ran. The call graph can also be written out as
+# collapsed stacks, one "frame;frame;frame count" line per stack, which flamegraph.pl and speedscope read.
+#
+# cProfile only records caller/callee pairs, not whole stacks, so the stacks are rebuilt by walking down from the
+# test's run() and sharing each function's time between its callers in proportion to the time of each call edge.
+#
+
+from __future__ import print_function
+import cProfile
+import collections
+import os
+import pstats
+import time
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None  # python 2, only the cProfile data is collected
+
+MIN_STACK_SECS = 1e-6  # stacks below this are dropped while rebuilding them
+MAX_STACK_DEPTH = 64
+
+
+def functionLabel(func):
+    '''a readable name for a pstats function key (filename, line, name)'''
+    (filename, line, name) = func
+    if filename == '~':
+        return name  # builtins, e.g. "<method 'sort' of 'list' objects>"
+    return "%s (%s:%d)" % (name, os.path.basename(filename), line)
+
+def _edgeTime(edge):
+    # cProfile gives (calls, primitive calls, total time, cumulative time) per caller, the profile module just a count
+    return edge[3] if isinstance(edge, tuple) else 0.0
+
+def collapsedStacks(stats):
+    '''rebuilds {"frame;frame;...": seconds} of self time per call stack from pstats' caller/callee data'''
+    callees = collections.defaultdict(dict)
+    for (func, (cc, nc, tt, ct, callers)) in stats.items():
+        for (caller, edge) in callers.items():
+            callees[caller][func] = edge
+    stacks = collections.defaultdict(float)
+
+    def walk(func, path, funcs, secs):
+        (cc, nc, tt, ct, callers) = stats[func]
+        share = secs / ct if ct > 0 else 0.0
+        path = path + (functionLabel(func).replace(';', ':'),)
+        funcs = funcs | set([func])
+        selfSecs = tt * share
+        if len(path) >= MAX_STACK_DEPTH:
+            selfSecs = secs
+        elif func in callees:
+            for (callee, edge) in callees[func].items():
+                calleeSecs = _edgeTime(edge) * share
+                if callee in funcs or calleeSecs < MIN_STACK_SECS:
+                    continue  # recursion is already counted in the outer call
+                walk(callee, path, funcs, calleeSecs)
+        if selfSecs > 0:
+            stacks[';'.join(path)] += selfSecs
+
+    for (func, (cc, nc, tt, ct, callers)) in stats.items():
+        if not callers and ct >= MIN_STACK_SECS:
+            walk(func, (), set(), ct)
+    return stacks
+
+
+def profileTest(test, logdata, verbose, top=10):
+    '''runs test.run(logdata, verbose) under cProfile (and tracemalloc if available), returns (execTime in ms,
+    profile, stacks). profile is a dict of the top functions by their own time, the peak traced memory and the top
+    allocation sites still holding memory when the test finished (None without tracemalloc), stacks is as returned
+    by collapsedStacks(). Times include the profiler's overhead'''
+    tracing = tracemalloc is not None and not tracemalloc.is_tracing()
+    if tracing:
+        tracemalloc.start()
+    profiler = cProfile.Profile()
+    try:
+        startTime = time.time()
+        profiler.runcall(test.run, logdata, verbose)  # RUN THE TEST
+        endTime = time.time()
+        if tracing:
+            snapshot = tracemalloc.take_snapshot()
+            peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        if tracing:
+            tracemalloc.stop()
+
+    # leave out the profiler's own disable() call
+    stats = dict((func, stat) for (func, stat) in pstats.Stats(profiler).stats.items() if "_lsprof.Profiler" not in func[2])
+    functions = []
+    for (func, (cc, nc, tt, ct, callers)) in sorted(stats.items(), key=lambda item: -item[1][2])[:top]:
+        functions.append(collections.OrderedDict([
+            ("function", functionLabel(func)),
+            ("calls",    nc),
+            ("totalTime", 1000 * tt),
+            ("cumTime",   1000 * ct)]))
+    profile = collections.OrderedDict([("functions", functions), ("peakKB", None), ("allocations", None)])
+    if tracing:
+        snapshot = snapshot.filter_traces([tracemalloc.Filter(False, filename) for filename in (tracemalloc.__file__, cProfile.__file__, __file__)])
+        profile["peakKB"] = peak / 1024.0
+        profile["allocations"] = [collections.OrderedDict([
+            ("site",   "%s:%d" % (os.path.basename(stat.traceback[0].filename), stat.traceback[0].lineno)),
+            ("sizeKB", stat.size / 1024.0),
+            ("count",  stat.count)]) for stat in snapshot.statistics('lineno')[:top]]
+    return (1000 * (endTime-startTime), profile, collapsedStacks(stats))
+
+
+def writeCollapsedStacks(stackFile, tests):
+    '''writes the stacks of each profiled test to a flamegraph collapsed-stack file, under a frame named after the
+    test, with counts in microseconds'''
+    with open(stackFile, 'w') as f:
+        for test in tests:
+            if not test.enable or not test.profileStacks:
+                continue
+            name = test.name.replace(';', ':')
+            for (stack, secs) in sorted(test.profileStacks.items()):
+                count = int(round(1e6 * secs))
+                if count > 0:
+                    f.write("%s;%s %d\n" % (name, stack, count))
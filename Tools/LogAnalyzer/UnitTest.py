@@ -9,7 +9,17 @@
 
 from __future__ import print_function
 
+import Benchmark
 import DataflashLog
+import DataflashLogCache
+import json
+import LogAnalyzer
+import numpy
+import os
+import PlotData
+import ResultsWriter
+import shutil
+import tempfile
 import traceback
 from VehicleType import VehicleType
 
@@ -42,10 +52,30 @@ try:
 	assert(logdata.channels['CTUN']['CRate'].listData[3]   == (317, 35))
 	assert(logdata.channels['CTUN']['CRate'].listData[51]  == (421, 31))
 	assert(logdata.channels['CTUN']['CRate'].listData[115] == (563, -8))
+	assert(logdata.channels['GPS']['HDop'].lineNumbers[44] == 768)
+	assert(logdata.channels['GPS']['HDop'].values[44]      == 4.67)
+	assert(logdata.channels['GPS']['HDop'].dictData[1288]  == 2.28)
+	assert(logdata.channels['CTUN']['ThrOut'].getSegment(321,409).lineNumbers[0]  == 321)
+	assert(logdata.channels['CTUN']['ThrOut'].getSegment(321,409).lineNumbers[-1] == 409)
+	assert(logdata.channels['CTUN']['ThrOut'].getSegment(321,409).max() == 242)
+	assert(logdata.channels['CTUN']['ThrOut'].stats[:3] == (1443, 0, 895) and logdata.channels['CTUN']['ThrOut'].stats[5:9] == (0, 0, 308, 4749))
+	assert(logdata.channelStats('GPS')['HDop'].max == logdata.channels['GPS']['HDop'].max() == 4.68)
+	nanChannel = DataflashLog.Channel([1, 2, 3, 4], [1.0, float('nan'), float('inf'), 3.0])
+	assert(nanChannel.stats == (4, 1.0, 3.0, 2.0, 1.0, 1, 1, 1, 4, 2, 3))
+	assert(DataflashLog.DataflashLogHelper.isLogEmpty(logdata) is None and DataflashLog.DataflashLogHelper.isLogEmpty(DataflashLog.DataflashLog()) == "No log data")
 	assert(int(logdata.filesizeKB) == 307)
 	assert(logdata.durationSecs    == 155)
 	assert(logdata.lineCount       == 4750)
 
+	# test the line by line text reader gives the same channels as the default bulk one
+	lineData = DataflashLog.DataflashLog("examples/robert_lefebvre_octo_PM.log", bulkDecode=False)
+	assert(sorted(lineData.channels.keys()) == sorted(logdata.channels.keys()))
+	for groupName in logdata.channels:
+		for (label, channel) in logdata.channels[groupName].items():
+			assert(channel.listData == lineData.channels[groupName][label].listData)
+			assert(channel.values.dtype == lineData.channels[groupName][label].values.dtype)
+	assert(logdata.modeChanges == lineData.modeChanges and logdata.parameters == lineData.parameters)
+
 	# test LogIterator class
 	lit = DataflashLog.LogIterator(logdata)
 	assert(lit.currentLine == 0)
@@ -62,7 +92,194 @@ try:
 	lit.next()
 	assert(lit.currentLine == 4751)
 	assert(lit['ATT']['Roll'] == 2.99)
+	nearest = DataflashLog.LogIterator(logdata, 500, mode="nearest")
+	assert(nearest.iterators['ATT'] == (82, 499) and nearest.iterators['CTUN'] == (87, 500))
+	nearest.next()
+	nearest.next()
+	assert(nearest.iterators['CTUN'] == (88, 502) and nearest.currentLine == 502)
+	assert(lit.currentLine == 4751 and lit.iterators['CTUN'] != nearest.iterators['CTUN'])
+
+	# test replaying stored channel data as log messages
+	replayed = list(DataflashLog.DataflashLogHelper.replayMessages(logdata, ["CTUN", "GPS"]))
+	assert(len(replayed) == len(logdata.channels['CTUN']['ThrOut'].listData) + len(logdata.channels['GPS']['HDop'].listData))
+	assert([lineNumber for (lineNumber, message) in replayed] == sorted(lineNumber for (lineNumber, message) in replayed))
+	ctun = [(lineNumber, message) for (lineNumber, message) in replayed if message.NAME == "CTUN"]
+	assert(ctun[45][0] == 409 and ctun[45][1].ThrOut == 242)
+	for test in LogAnalyzer.TestSuite().tests:
+		if isinstance(test, LogAnalyzer.StreamTest):
+			# the column based run() of a stream test agrees with replaying the log through its hooks
+			test.run(logdata, False)
+			result = (test.result.status, test.result.statusMessage)
+			LogAnalyzer.StreamTest.run(test, logdata, False)
+			assert(result == (test.result.status, test.result.statusMessage))
+
+	# test record classes and record arrays
+	gps = logdata.formats['GPS']("3", "594444400", "7", "4.67", "0", "0", "1.5", "2.5", "0.1", "90")
+	assert(gps.Time == 594444400 and gps.HDop == 4.67 and type(gps).__slots__ == ())
+	records = logdata.recordArray('CTUN')
+	assert(records[45].lineNumber == 409 and records[45].ThrOut == 242)
+	assert(list(records.CRate[:4]) == [v for (l, v) in logdata.channels['CTUN']['CRate'].listData[:4]])
+	scaled = DataflashLog.BinaryFormat()
+	(scaled.type, scaled.length, scaled.name, scaled.types, scaled.labels) = (200, 6, b"TST", b"cB", b"Temp,Id")
+	record = scaled.to_class().RECORD._make((2150, 7))
+	assert(record.Temp == 21.5 and record[0] == 2150 and record.Id == 7)
+
+	# test TimeIndex class
+	gpsTimes = logdata.timeIndex("GPS")
+	assert(gpsTimes.timeLabel == "Time")
+	assert(gpsTimes.valueAt("HDop", gpsTimes.times[44]) == 4.67)
+	assert(gpsTimes.indexAt(gpsTimes.times[44] - 0.0001) == 43)
+	assert(len(gpsTimes.segment("HDop", gpsTimes.times[10], gpsTimes.times[20]).values) == 11)
+	assert(gpsTimes.timeAtLine(700) == 594444.4)
+	assert(DataflashLog.DataflashLogHelper.getTimeAtLine(logdata, 700) == 594444400)
+	assert(DataflashLog.DataflashLogHelper.findLoiterChunks(logdata) == [(2204, 4403)])
+
+	# test SegmentIndex class
+	segments = logdata.segmentIndex()
+	assert([segment.mode for segment in segments.segments()] == ['ALT_HOLD', 'LOITER', 'ALT_HOLD', 'STABILIZE'])
+	assert(segments[1] == ('LOITER', 269, 2204, 4403, 594509.4, 594579.8))
+	assert(list(segments.indices(['ALT_HOLD', 'STABILIZE'], minLengthSeconds=6)) == [0, 2])
+	assert(segments.modeAt(10) is None and segments.modeAt(2203) == 'ALT_HOLD' and segments.modeAt(2204) == 'LOITER')
+	assert(list(segments.armStartLines) == [306] and list(segments.armEndLines) == [4750] and not segments.isArmedAt(305))
+	thrOut = logdata.channels['CTUN']['ThrOut']
+	loiterThrOut = segments.channelSegments(thrOut, segments.indices('LOITER'))[0]
+	assert(loiterThrOut.lineNumbers[0] == 2208 and loiterThrOut.lineNumbers[-1] == 4400 and loiterThrOut.values.base is not None)
+	assert(sum(s.stop - s.start for s in segments.slices(thrOut)) == len(thrOut.values) - segments.slices(thrOut)[0].start)
+
+	# test time alignment and filtering helpers
+	assert(list(DataflashLog.DataflashLogHelper.nearestIndices([1,2,4], [0,1.5,3,5,2])) == [0,0,1,2,1])
+	filtered = DataflashLog.DataflashLogHelper.firstOrderFilter([1.0]*3000, 0.01, 5.0)
+	assert(abs(filtered[0] - 0.002) < 1e-12)
+	assert(abs(filtered[-1] - (1 - 0.998**3000)) < 1e-9)
+
+	# test InstanceStack class
+	imuLog = DataflashLog.DataflashLog()
+	imuLog.channels["IMU"]  = {"TimeMS": DataflashLog.Channel([1,3,5,7], [0,10,20,30]), "AccX": DataflashLog.Channel([1,3,5,7], [0.0,1.0,2.0,3.0])}
+	imuLog.channels["IMU2"] = {"TimeMS": DataflashLog.Channel([2,4,6], [1,18,31]), "AccX": DataflashLog.Channel([2,4,6], [0.5,2.5,3.5])}
+	imuLog.channels["IMU3"] = imuLog.channels["IMU2"]
+	assert(imuLog.instanceGroups("IMU") == ["IMU", "IMU2"])
+	imus = imuLog.instanceStack("IMU", ["AccX"])
+	assert(imus.names == ["IMU", "IMU2"] and imus.pairs() == [(0, 1)])
+	assert(imus.lineNumbers.tolist() == [[1,3,5,7], [2,4,4,6]])
+	assert(imus.values["AccX"].tolist() == [[0.0,1.0,2.0,3.0], [0.5,2.5,2.5,3.5]])
+	assert(imus.spread("AccX").tolist() == imus.difference(["AccX"], 0, 1).tolist() == [0.5,1.5,0.5,0.5])
+
+	# test the on-disk log cache
+	cacheDir = tempfile.mkdtemp()
+	try:
+		cachedLog = os.path.join(cacheDir, "octo.log")
+		shutil.copy("examples/robert_lefebvre_octo_PM.log", cachedLog)
+		DataflashLog.DataflashLog(cachedLog, cache=True)
+		assert(os.path.exists(DataflashLogCache.cachePath(cachedLog)))
+		cachedData = DataflashLog.DataflashLog()
+		assert(DataflashLogCache.load(cachedData, cachedLog, {"format": "auto", "ignoreBadlines": False}))
+		assert(cachedData.parameters  == logdata.parameters)
+		assert(cachedData.modeChanges == logdata.modeChanges)
+		assert(sorted(cachedData.formats.keys()) == sorted(logdata.formats.keys()))
+		assert(cachedData.lineCount   == logdata.lineCount)
+		assert(cachedData.channels['GPS']['HDop'].listData == logdata.channels['GPS']['HDop'].listData)
+		assert(cachedData.channels['CTUN']['ThrOut'].getSegment(321,409).max() == 242)
+		assert(cachedData.channelStats() == logdata.channelStats())
+		with open(cachedLog, 'a') as f:
+			f.write("\n")
+		assert(not DataflashLogCache.load(DataflashLog.DataflashLog(), cachedLog, {"format": "auto", "ignoreBadlines": False}))
+	finally:
+		shutil.rmtree(cacheDir)
+
+	# test the benchmark log generator and regression check
+	benchDir = tempfile.mkdtemp()
+	try:
+		generator = Benchmark.LogGenerator(logdata, {"ATT": 3, "GPS": 1})
+		for kind in ("bin", "log"):
+			benchLog = os.path.join(benchDir, "bench." + kind)
+			count = generator.write(benchLog, 0.05, kind == "bin")
+			benchData = DataflashLog.DataflashLog(benchLog)
+			assert(sorted(benchData.channels.keys()) == ["ATT", "GPS"])
+			# the binary readers stop short of a message that ends exactly at the end of the file
+			assert(benchData.lineCount == count - (kind == "bin") and benchData.skippedLines == 0)
+			assert(sorted(benchData.parameters.keys()) == sorted(logdata.parameters.keys()) and benchData.vehicleType == VehicleType.Copter)
+			assert(numpy.all(numpy.diff(benchData.channels['GPS']['Time'].values) > 0))
+	finally:
+		shutil.rmtree(benchDir)
+	baseline = {"runs": {"bin/bulk": {"parseSecs": 1.0, "peakRSS_MB": 100, "tests": {"NaNs": 0.5}}}}
+	current  = {"runs": {"bin/bulk": {"parseSecs": 1.1, "peakRSS_MB": 200, "tests": {"NaNs": 0.9}}}}
+	assert(len(Benchmark.compareResults(current, baseline)) == 2)
+
+
+	# test profiling each test's run
+	testSuite = LogAnalyzer.TestSuite()
+	testSuite.run(logdata, False, profile=3)
+	for result in testSuite.results():
+		assert(0 < len(result["profile"]["functions"]) <= 3)
+		assert(result["profile"]["functions"][0]["totalTime"] >= result["profile"]["functions"][-1]["totalTime"])
+	(fd, stackFile) = tempfile.mkstemp()
+	os.close(fd)
+	try:
+		LogAnalyzer.TestProfiler.writeCollapsedStacks(stackFile, testSuite.tests)
+		with open(stackFile) as f:
+			stacks = [line.rsplit(' ', 1) for line in f]
+		assert(stacks and all(int(count) > 0 for (stack, count) in stacks))
+		assert(set(stack.split(';')[0] for (stack, count) in stacks) <= set(test.name for test in testSuite.tests))
+	finally:
+		os.remove(stackFile)
+	testSuite.run(logdata, False)
+	assert(all("profile" not in result for result in testSuite.results()))
+
+	# test the JSON results writer and its data windows
+	window = PlotData.windowData(logdata, LogAnalyzer.DataWindow(["CTUN.ThrOut", "CTUN.Missing"], 321, 409))
+	assert(list(window["series"].keys()) == ["CTUN.ThrOut"])
+	assert(max(window["series"]["CTUN.ThrOut"]["values"]) == 242)
+	assert(all(321 <= line <= 409 for line in window["series"]["CTUN.ThrOut"]["lines"]))
+	window = PlotData.windowData(logdata, LogAnalyzer.DataWindow(["ATT.Roll"]), maxPoints=50)
+	assert(len(window["series"]["ATT.Roll"]["values"]) <= 50 and window["startTime"] < window["endTime"])
+	roll = logdata.channels["ATT"]["Roll"].values
+	assert(min(window["series"]["ATT.Roll"]["values"]) == roll.min() and max(window["series"]["ATT.Roll"]["values"]) == roll.max())
+	resultsDir = tempfile.mkdtemp()
+	try:
+		for name in ("results.ndjson", "results.ndjson", "results.json"):
+			writer = ResultsWriter.ResultsWriter(os.path.join(resultsDir, name))
+			writer.startLog(logdata.filename, LogAnalyzer.logInfo(logdata))
+			for result in testSuite.results():
+				writer.writeResult(result)
+			writer.endLog()
+			writer.close()
+		with open(os.path.join(resultsDir, "results.ndjson")) as f:
+			records = [json.loads(line) for line in f]
+		assert([record["record"] for record in records].count("log") == 2)
+		assert(len(records) == 2 * (len(testSuite.results()) + 2) and records[-1]["record"] == "end")
+		with open(os.path.join(resultsDir, "results.json")) as f:
+			document = json.load(f)
+		assert(document["logfile"] == logdata.filename and len(document["results"]) == len(testSuite.results()))
+		assert(sum(document["counts"].values()) == len(document["results"]) and document["error"] is None)
+	finally:
+		shutil.rmtree(resultsDir)
 
+	# test the min/max preserving downsampling and the plot data files
+	x = numpy.arange(10000, dtype=numpy.float64)
+	y = numpy.sin(x / 500.0)
+	(y[1234], y[5678], y[9000]) = (5.0, -5.0, float('nan'))
+	keep = PlotData.downsample(x, y, 100)
+	assert(len(keep) <= 100 and keep[0] == 0 and keep[-1] == len(y)-1)
+	assert(1234 in keep and 5678 in keep and 9000 in keep)
+	assert(PlotData.downsample(x[:50], y[:50], 100).tolist() == list(range(50)))
+	assert(PlotData.lttb(x, x, 10).tolist() == sorted(set(PlotData.lttb(x, x, 10).tolist())))
+	plotDir = tempfile.mkdtemp()
+	try:
+		graphTests = PlotData.graphTests(testSuite.tests)
+		assert(graphTests and all(test.result.status in (LogAnalyzer.TestResult.StatusType.FAIL, LogAnalyzer.TestResult.StatusType.WARN) for test in graphTests))
+		plots = []
+		for name in ("plot.json", "plot.lapd"):
+			PlotData.writePlotData(os.path.join(plotDir, name), logdata, testSuite.tests, 100)
+			plots.append(PlotData.readPlotData(os.path.join(plotDir, name)))
+		assert(os.path.getsize(os.path.join(plotDir, "plot.lapd")) < os.path.getsize(os.path.join(plotDir, "plot.json")))
+		assert([result["name"] for result in plots[0]["results"]] == [result["name"] for result in plots[1]["results"]] == [test.name for test in graphTests])
+		for (jsonResult, binaryResult) in zip(plots[0]["results"], plots[1]["results"]):
+			for (jsonWindow, binaryWindow) in zip(jsonResult["windows"], binaryResult["windows"]):
+				for (name, series) in jsonWindow["series"].items():
+					assert(series["lines"] == binaryWindow["series"][name]["lines"].tolist())
+					assert(numpy.allclose(series["values"], binaryWindow["series"][name]["values"]))
+	finally:
+		shutil.rmtree(plotDir)
 
 	# TODO: unit test DataflashLog reading 2
 	# ...
@@ -83,16 +83,6 @@ class TestAutotune(Test):
             attempts.append(TestAutotune.AutotuneSession(events[j:]))
 
         for a in attempts:
-                # this should not be necessary!
-                def class_from_channel(c):
-                    members = dict({'__init__':lambda x: setattr(x,i,None) for i in logdata.channels[c]})
-                    cls = type(\
-                               'Channel__{:s}'.format(c),
-                               (object,),
-                               members
-                               )
-                    return cls
-
                 # last wins
                 if a.success:
                     self.result.status = TestResult.StatusType.GOOD
@@ -108,18 +98,8 @@ class TestAutotune(Test):
                 self.result.statusMessage += s
 
                 if verbose:
-                    linenext = a.linestart + 1
-                    while linenext < a.linestop:
-                        try:
-                            line = logdata.channels['ATUN']['RateMax'].getNearestValueFwd(linenext)[1]
-                            if line > a.linestop:
-                                break
-                        except:
-                            break
-                        atun = class_from_channel('ATUN')()
-                        for key in logdata.channels['ATUN']:
-                            setattr(atun, key, logdata.channels['ATUN'][key].getNearestValueFwd(linenext)[0])
-                        linenext = logdata.channels['ATUN'][key].getNearestValueFwd(linenext)[1] + 1
-                        self.result.statusMessage += 'ATUN Axis:{atun.Axis} TuneStep:{atun.TuneStep} RateMin:{atun.RateMin:5.0f} RateMax:{atun.RateMax:5.0f} RPGain:{atun.RPGain:1.4f} RDGain:{atun.RDGain:1.4f} SPGain:{atun.SPGain:1.1f} (@line:{l})\n'.format(l=linenext,s=s, atun=atun)
+                    atun = logdata.recordArray('ATUN')
+                    for record in atun[(atun.lineNumber > a.linestart) & (atun.lineNumber <= a.linestop)]:
+                        self.result.statusMessage += 'ATUN Axis:{atun.Axis} TuneStep:{atun.TuneStep} RateMin:{atun.RateMin:5.0f} RateMax:{atun.RateMax:5.0f} RPGain:{atun.RPGain:1.4f} RDGain:{atun.RDGain:1.4f} SPGain:{atun.SPGain:1.1f} (@line:{l})\n'.format(l=record.lineNumber,s=s, atun=record)
                     self.result.statusMessage += '\n'
 
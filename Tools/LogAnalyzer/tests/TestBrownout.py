@@ -1,40 +1,62 @@
-from LogAnalyzer import Test,TestResult
+from LogAnalyzer import StreamTest,TestResult,DataWindow
 import DataflashLog
 
 import collections
 
-class TestBrownout(Test):
+class TestBrownout(StreamTest):
 	'''test for a log that has been truncated in flight'''
+	streamTypes = ("EV", "CTUN")
 
 	def __init__(self):
-		Test.__init__(self)
+		StreamTest.__init__(self)
 		self.name = "Brownout"
 
-	def run(self, logdata, verbose):
-		self.result = TestResult()
-		self.result.status = TestResult.StatusType.GOOD
+	def start(self, verbose):
+		self.isArmed  = False
+		self.haveCTUN = False
+		self.finalAlt = None
 
-		isArmed = False
+	def on_message(self, lineNumber, message):
 		# FIXME: cope with LOG_ARM_DISARM_MSG message
-		if "EV" in logdata.channels:
+		if message.NAME == "EV":
 			# step through the arm/disarm events in order, to see if they're symmetrical
 			# note: it seems landing detection isn't robust enough to rely upon here, so we'll only consider arm+disarm, not takeoff+land
-			for line,ev in logdata.channels["EV"]["Id"].listData:
-				if ev == 10:
-					isArmed = True
-				elif ev == 11:
-					isArmed = False
+			if message.Id == 10:
+				self.isArmed = True
+			elif message.Id == 11:
+				self.isArmed = False
+		else:
+			self.haveCTUN = True
+			if "BarAlt" in message.labels:
+				self.finalAlt = message.BarAlt
+
+	def run(self, logdata, verbose=False):
+		# only the last arm/disarm event and the last altitude matter, so read those from the channels rather than replaying every message
+		self.start(verbose)
+		if "EV" in logdata.channels and "Id" in logdata.channels["EV"]:
+			ids = logdata.channels["EV"]["Id"].values
+			armDisarm = ids[(ids == 10) | (ids == 11)]
+			self.isArmed = bool(len(armDisarm)) and armDisarm[-1] == 10
+		if "CTUN" in logdata.channels:
+			self.haveCTUN = True
+			if "BarAlt" in logdata.channels["CTUN"]:
+				self.finalAlt = logdata.channels["CTUN"]["BarAlt"].getValueAt(-1)
+		self.finish(logdata)
+
+	def finish(self, logdata):
+		self.result = TestResult()
+		self.result.status = TestResult.StatusType.GOOD
 
-		if "CTUN" not in logdata.channels:
+		if not self.haveCTUN:
 			self.result.status = TestResult.StatusType.UNKNOWN
 			self.result.statusMessage = "No CTUN log data"
 			return
 
 		# check for relative altitude at end
-		if "CTUN" in logdata.channels and "BarAlt" in logdata.channels["CTUN"]:
-			(finalAlt,finalAltLine) = logdata.channels["CTUN"]["BarAlt"].getNearestValue(logdata.lineCount, lookForwards=False)
-
+		if self.finalAlt is not None:
+			finalAlt = self.finalAlt
 			finalAltMax = 3.0   # max alt offset that we'll still consider to be on the ground
-			if isArmed and finalAlt > finalAltMax:
+			if self.isArmed and finalAlt > finalAltMax:
 				self.result.status = TestResult.StatusType.FAIL
 				self.result.statusMessage = "Truncated Log? Ends while armed at altitude %.2fm" % finalAlt
+				self.result.dataWindows = [DataWindow(["CTUN.BarAlt", "CTUN.ThrOut"])]
@@ -1,4 +1,4 @@
-from LogAnalyzer import Test,TestResult
+from LogAnalyzer import Test,TestResult,DataWindow
 import DataflashLog
 
 import math
@@ -105,6 +105,9 @@ class TestCompass(Test):
                 if verbose:
                     self.result.statusMessage = self.result.statusMessage + "Min mag_field of %.2f on line %d\n" % (minMagField,minMagFieldLine)
                     self.result.statusMessage = self.result.statusMessage + "Max mag_field of %.2f on line %d\n" % (maxMagField,maxMagFieldLine)
+                if self.result.status != TestResult.StatusType.GOOD:
+                    # the offsets, and the field against throttle for interference
+                    self.result.dataWindows = [DataWindow(["MAG.MagX", "MAG.MagY", "MAG.MagZ", "MAG.OfsX", "MAG.OfsY", "MAG.OfsZ", "CTUN.ThrOut"])]
 
             else:
                 self.result.statusMessage = self.result.statusMessage + "No MAG data, unable to test mag_field interference\n"
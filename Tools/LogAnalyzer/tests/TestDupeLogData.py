@@ -1,41 +1,68 @@
 from __future__ import print_function
 
-from LogAnalyzer import Test,TestResult
+from LogAnalyzer import Test,TestResult,DataWindow
 import DataflashLog
 
+import numpy
+from numpy.lib.stride_tricks import as_strided
+
 
 class TestDupeLogData(Test):
 	'''test for duplicated data in log, which has been happening on PX4/Pixhawk'''
 
+	windowSize = 20  # number of consecutive samples which have to repeat to count as duplicated data
+
 	def __init__(self):
 		Test.__init__(self)
 		self.name = "Dupe Log Data"
-		
-	def __matchSample(self, sample, sampleStartIndex, logdata):
-		'''return the line number where a match is found, otherwise return False'''
-
-		# ignore if all data in sample is the same value
-		nSame = 0
-		for s in sample:
-			if s[1] == sample[0][1]:
-				nSame += 1
-		if nSame == 20:
-			return False
 
-		# c
-		data = logdata.channels["ATT"]["Pitch"].listData
-		for i in range(sampleStartIndex, len(data)):
-			#print("Checking against index %d" % i)
-			if i == sampleStartIndex:
-				continue # skip matching against ourselves
-			j = 0
-			while j<20 and (i+j)<len(data) and data[i+j][1] == sample[j][1]:
-				#print("### Match found, j=%d, data=%f, sample=%f, log data matched to sample at line %d" % (j,data[i+j][1],sample[j][1],data[i+j][0]))
-				j += 1
-			if j == 20: # all samples match
-				return data[i][0]
-
-		return False
+	def __findDuplicate(self, values):
+		'''returns (i,j), the indices of the first window of values which is repeated later on in the data and of its first
+		repeat, or None. Windows which are all the same value, or contain NaNs, are ignored'''
+		n = self.windowSize
+		nWindows = len(values) - n + 1
+		if nWindows < 2:
+			return None
+		values = numpy.array(values, dtype=numpy.float64)
+		values[values == 0] = 0.0  # -0.0 == 0.0, but not bitwise
+		windows = as_strided(values, shape=(nWindows, n), strides=(values.strides[0], values.strides[0]))
+
+		# ignore windows which are constant or contain NaNs, using running counts over the samples
+		same = numpy.concatenate(([0], numpy.cumsum(values[1:] == values[:-1])))
+		nans = numpy.concatenate(([0], numpy.cumsum(numpy.isnan(values))))
+		valid = ((same[n-1:] - same[:nWindows]) < n-1) & ((nans[n:] - nans[:nWindows]) == 0)
+		indices = numpy.flatnonzero(valid)
+
+		# hash every window from the bits of its values, then sort so equal windows are adjacent (and in log order)
+		bits = values.view(numpy.uint64)
+		bits = (bits ^ (bits >> numpy.uint64(31))) * numpy.uint64(0xbf58476d1ce4e5b9)
+		hashes = numpy.zeros(nWindows, dtype=numpy.uint64)
+		for j in range(n):
+			hashes = hashes * numpy.uint64(0x100000001b3) + bits[j:j+nWindows]
+		hashes = hashes[indices]
+		order = numpy.argsort(hashes, kind='mergesort')
+		(hashes, indices) = (hashes[order], indices[order])
+		candidates = numpy.flatnonzero(hashes[1:] == hashes[:-1])
+		if not len(candidates):
+			return None
+
+		# confirm the candidate pairs, a hash collision splits its group into windows of equal values
+		(first, second) = (indices[candidates], indices[candidates+1])
+		matches = (windows[first] == windows[second]).all(axis=1)
+		if matches.all():
+			best = numpy.argmin(first)
+			return (int(first[best]), int(second[best]))
+		found = []
+		for group in numpy.unique(hashes[candidates]):
+			repeats = {}  # window values -> (first index, index of its first repeat)
+			for i in indices[hashes == group].tolist():
+				key = windows[i].tobytes()
+				if key not in repeats:
+					repeats[key] = (i, None)
+				elif repeats[key][1] is None:
+					repeats[key] = (repeats[key][0], i)
+			found.extend(pair for pair in repeats.values() if pair[1] is not None)
+		return min(found) if found else None
 
 	def run(self, logdata, verbose):
 		self.result = TestResult()
@@ -47,33 +74,14 @@ class TestDupeLogData(Test):
 			self.result.statusMessage = "No ATT log data"
 			return
 
-		# pick 10 sample points within the range of ATT data we have
-		sampleStartIndices = []
-		attStartIndex = 0
-		attEndIndex   = len(logdata.channels["ATT"]["Pitch"].listData)-1
-		step = attEndIndex / 11
-		for i in range(step,attEndIndex-step,step):
-			sampleStartIndices.append(i)
-			#print("Dupe data sample point index %d at line %d" % (i, logdata.channels["ATT"]["Pitch"].listData[i][0]))
-
-		# get 20 datapoints of pitch from each sample location and check for a match elsewhere
-		sampleIndex = 0
-		for i in range(sampleStartIndices[0], len(logdata.channels["ATT"]["Pitch"].listData)):
-			if i == sampleStartIndices[sampleIndex]:
-				#print("Checking sample %d" % i)
-				sample = logdata.channels["ATT"]["Pitch"].listData[i:i+20]
-				matchedLine = self.__matchSample(sample, i, logdata)
-				if matchedLine:
-					#print("Data from line %d found duplicated at line %d" % (sample[0][0],matchedLine))
-					self.result.status = TestResult.StatusType.FAIL
-					self.result.statusMessage = "Duplicate data chunks found in log (%d and %d)" % (sample[0][0],matchedLine)
-					return
-				sampleIndex += 1
-				if sampleIndex >= len(sampleStartIndices):
-					break
-
-
-
-
-
-
+		# check every run of 20 pitch values for a match later in the log
+		pitch = logdata.channels["ATT"]["Pitch"]
+		duplicate = self.__findDuplicate(pitch.values)
+		if duplicate:
+			(i, j) = duplicate
+			#print("Data from line %d found duplicated at line %d" % (pitch.lineNumbers[i],pitch.lineNumbers[j]))
+			self.result.status = TestResult.StatusType.FAIL
+			self.result.statusMessage = "Duplicate data chunks found in log (%d and %d)" % (pitch.lineNumbers[i],pitch.lineNumbers[j])
+			last = min(len(pitch.lineNumbers), j+self.windowSize) - 1
+			self.result.dataWindows = [DataWindow(["ATT.Pitch"], pitch.lineNumbers[i], pitch.lineNumbers[i+self.windowSize-1]),
+			                           DataWindow(["ATT.Pitch"], pitch.lineNumbers[j], pitch.lineNumbers[last])]
@@ -1,46 +1,61 @@
-from LogAnalyzer import Test,TestResult
+from LogAnalyzer import StreamTest,TestResult
 import DataflashLog
 
 
-class TestEvents(Test):
+class TestEvents(StreamTest):
 	'''test for erroneous events and failsafes'''
 	# TODO: need to check for vehicle-specific codes
+	streamTypes = ("ERR",)
 
 	def __init__(self):
-		Test.__init__(self)
+		StreamTest.__init__(self)
 		self.name = "Event/Failsafe"
 
-	def run(self, logdata, verbose):
-		self.result = TestResult()
-		self.result.status = TestResult.StatusType.GOOD
+	def start(self, verbose):
+		self.errors = set()
 
-		errors = set()
+	def on_message(self, lineNumber, message):
+		self.check(message.Subsys, message.ECode)
 
+	def run(self, logdata, verbose=False):
+		# only the ERR codes are needed, so go through those two columns rather than replaying whole messages
+		self.start(verbose)
 		if "ERR" in logdata.channels:
-			assert(len(logdata.channels["ERR"]["Subsys"].listData) == len(logdata.channels["ERR"]["ECode"].listData))
-			for i in range(len(logdata.channels["ERR"]["Subsys"].listData)):
-				subSys = logdata.channels["ERR"]["Subsys"].listData[i][1]
-				eCode  = logdata.channels["ERR"]["ECode"].listData[i][1]
-				if subSys == 2 and (eCode == 1):
-			 		errors.add("PPM")
-				elif subSys == 3 and (eCode == 1 or eCode == 2):
-			 		errors.add("COMPASS")
-				elif subSys == 5 and (eCode == 1):
-			 		errors.add("FS_THR")
-				elif subSys == 6 and (eCode == 1):
-			 		errors.add("FS_BATT")
-				elif subSys == 7 and (eCode == 1):
-			 		errors.add("GPS")
-				elif subSys == 8 and (eCode == 1):
-			 		errors.add("GCS")
-				elif subSys == 9 and (eCode == 1 or eCode == 2):
-			 		errors.add("FENCE")
-				elif subSys == 10:
-			 		errors.add("FLT_MODE")
-				elif subSys == 11 and (eCode == 2):
-			 		errors.add("GPS_GLITCH")
-				elif subSys == 12 and (eCode == 1):
-			 		errors.add("CRASH")
+			subSys = logdata.channels["ERR"]["Subsys"].values.tolist()
+			eCode  = logdata.channels["ERR"]["ECode"].values.tolist()
+			assert(len(subSys) == len(eCode))
+			for (s, e) in zip(subSys, eCode):
+				self.check(s, e)
+		self.finish(logdata)
+
+	def check(self, subSys, eCode):
+		'''records the error an ERR subsystem and code report, if any'''
+		if subSys == 2 and (eCode == 1):
+			self.errors.add("PPM")
+		elif subSys == 3 and (eCode == 1 or eCode == 2):
+			self.errors.add("COMPASS")
+		elif subSys == 5 and (eCode == 1):
+			self.errors.add("FS_THR")
+		elif subSys == 6 and (eCode == 1):
+			self.errors.add("FS_BATT")
+		elif subSys == 7 and (eCode == 1):
+			self.errors.add("GPS")
+		elif subSys == 8 and (eCode == 1):
+			self.errors.add("GCS")
+		elif subSys == 9 and (eCode == 1 or eCode == 2):
+			self.errors.add("FENCE")
+		elif subSys == 10:
+			self.errors.add("FLT_MODE")
+		elif subSys == 11 and (eCode == 2):
+			self.errors.add("GPS_GLITCH")
+		elif subSys == 12 and (eCode == 1):
+			self.errors.add("CRASH")
+
+	def finish(self, logdata):
+		self.result = TestResult()
+		self.result.status = TestResult.StatusType.GOOD
+
+		errors = self.errors
 
 		if errors:
 			if len(errors) == 1 and "FENCE" in errors:
@@ -1,32 +1,56 @@
-from LogAnalyzer import Test,TestResult
+from LogAnalyzer import StreamTest,TestResult,DataWindow
 import DataflashLog
 
+import numpy
 
-class TestGPSGlitch(Test):
+
+class TestGPSGlitch(StreamTest):
 	'''test for GPS glitch reporting or bad GPS data (satellite count, hdop)'''
+	streamTypes = ("GPS", "ERR")
 
 	def __init__(self):
-		Test.__init__(self)
+		StreamTest.__init__(self)
 		self.name = "GPS"
 
-	def run(self, logdata, verbose):
+	def start(self, verbose):
+		self.gpsGlitchCount = 0
+		self.minSats = None
+		self.maxHDop = None
+
+	def on_message(self, lineNumber, message):
+		if message.NAME == "ERR":
+			# glitch protection is currently copter-only, but might be added to other vehicle types later and there's no harm in leaving the test in for all
+			if message.Subsys == 11 and (message.ECode == 2):
+				self.gpsGlitchCount += 1
+		else:
+			if self.minSats is None or message.NSats < self.minSats:
+				self.minSats = message.NSats
+			if self.maxHDop is None or message.HDop > self.maxHDop:
+				self.maxHDop = message.HDop
+
+	def run(self, logdata, verbose=False):
+		# count the glitches from the ERR columns and take the satellite/HDop extremes from the channel stats, rather than replaying every message
+		self.start(verbose)
+		if "ERR" in logdata.channels:
+			subSys = logdata.channels["ERR"]["Subsys"].values
+			eCode  = logdata.channels["ERR"]["ECode"].values
+			assert(len(subSys) == len(eCode))
+			self.gpsGlitchCount = int(numpy.count_nonzero((subSys == 11) & (eCode == 2)))
+		if "GPS" in logdata.channels:
+			self.minSats = logdata.channels["GPS"]["NSats"].stats.min
+			self.maxHDop = logdata.channels["GPS"]["HDop"].stats.max
+		self.finish(logdata)
+
+	def finish(self, logdata):
 		self.result = TestResult()
 		self.result.status = TestResult.StatusType.GOOD
 
-		if "GPS" not in logdata.channels:
+		if self.minSats is None:
 			self.result.status = TestResult.StatusType.UNKNOWN
 			self.result.statusMessage = "No GPS log data"
 			return
 
-		# glitch protection is currently copter-only, but might be added to other vehicle types later and there's no harm in leaving the test in for all
-		gpsGlitchCount = 0
-		if "ERR" in logdata.channels:
-			assert(len(logdata.channels["ERR"]["Subsys"].listData) == len(logdata.channels["ERR"]["ECode"].listData))
-			for i in range(len(logdata.channels["ERR"]["Subsys"].listData)):
-				subSys = logdata.channels["ERR"]["Subsys"].listData[i][1]
-				eCode  = logdata.channels["ERR"]["ECode"].listData[i][1]
-				if subSys == 11 and (eCode == 2):
-			 		gpsGlitchCount += 1
+		gpsGlitchCount = self.gpsGlitchCount
 		if gpsGlitchCount:
 			self.result.status = TestResult.StatusType.FAIL
 			self.result.statusMessage = "GPS glitch errors found (%d)" % gpsGlitchCount
@@ -37,11 +61,11 @@ class TestGPSGlitch(Test):
 		minSatsFAIL = 5
 		maxHDopWARN = 3.0
 		maxHDopFAIL = 10.0
-		foundBadSatsWarn = logdata.channels["GPS"]["NSats"].min() < minSatsWARN
-		foundBadHDopWarn = logdata.channels["GPS"]["HDop"].max()  > maxHDopWARN
-		foundBadSatsFail = logdata.channels["GPS"]["NSats"].min() < minSatsFAIL
-		foundBadHDopFail = logdata.channels["GPS"]["HDop"].max()  > maxHDopFAIL
-		satsMsg = "Min satellites: %s, Max HDop: %s" % (logdata.channels["GPS"]["NSats"].min(), logdata.channels["GPS"]["HDop"].max())	
+		foundBadSatsWarn = self.minSats < minSatsWARN
+		foundBadHDopWarn = self.maxHDop > maxHDopWARN
+		foundBadSatsFail = self.minSats < minSatsFAIL
+		foundBadHDopFail = self.maxHDop > maxHDopFAIL
+		satsMsg = "Min satellites: %s, Max HDop: %s" % (self.minSats, self.maxHDop)
 		if gpsGlitchCount:
 			self.result.statusMessage = self.result.statusMessage + "\n" + satsMsg
 		if foundBadSatsFail or foundBadHDopFail:
@@ -52,5 +76,7 @@ class TestGPSGlitch(Test):
 			if not gpsGlitchCount:
 				self.result.status = TestResult.StatusType.WARN
 				self.result.statusMessage = satsMsg
+		if self.result.status != TestResult.StatusType.GOOD:
+			self.result.dataWindows = [DataWindow(["GPS.NSats", "GPS.HDop"])]
 
 
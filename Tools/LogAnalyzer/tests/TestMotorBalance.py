@@ -1,4 +1,4 @@
-from LogAnalyzer import Test,TestResult
+from LogAnalyzer import Test,TestResult,DataWindow
 import DataflashLog
 
 from VehicleType import VehicleType
@@ -22,11 +22,13 @@ class TestBalanceTwist(Test):
             return
 
         ch = []
+        names = []
 
         for i in range(8):
             for prefix in "Chan", "Ch", "C":
                 if prefix+repr((i+1)) in logdata.channels["RCOU"]:
                     ch.append(map(lambda x: x[1], logdata.channels["RCOU"][prefix+repr((i+1))].listData))
+                    names.append("RCOU."+prefix+repr((i+1)))
 
         ch = zip(*ch)
         num_channels = 0
@@ -64,3 +66,5 @@ class TestBalanceTwist(Test):
             self.result.status = TestResult.StatusType.WARN
         if abs(min(avg_ch)-max(avg_ch)) > 150:
             self.result.status = TestResult.StatusType.FAIL
+        if self.result.status != TestResult.StatusType.GOOD:
+            self.result.dataWindows = [DataWindow(names)]
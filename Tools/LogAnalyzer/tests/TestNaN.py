@@ -1,29 +1,57 @@
-from LogAnalyzer import Test,TestResult
+from LogAnalyzer import StreamTest,TestResult,DataWindow
 import math
 
-class TestNaN(Test):
-    '''test for NaNs present in log'''
+class TestNaN(StreamTest):
+    '''test for NaNs (and Infs) present in log'''
+    streamTypes = ('*',)
 
     def __init__(self):
-        Test.__init__(self)
+        StreamTest.__init__(self)
         self.name = "NaNs"
 
-    def run(self, logdata, verbose):
+    def start(self, verbose):
+        self.nanFields = []  # (kind, channel, field) in the order they were first found, kind being "NaN" or "Inf"
+        self.found = set()
+
+    def on_message(self, lineNumber, message):
+        for field in message.labels:
+            val = getattr(message, field)
+            if not isinstance(val, float) or not (math.isnan(val) or math.isinf(val)):
+                continue
+            kind = "NaN" if math.isnan(val) else "Inf"
+            if (kind, message.NAME, field) not in self.found:
+                self.found.add((kind, message.NAME, field))
+                self.nanFields.append((kind, message.NAME, field))
+
+    def run(self, logdata, verbose=False):
+        # a loaded log's channel stats already count the NaNs and Infs, so rather than replaying every message, order
+        # the fields with any by the line of the first one (then by field order within the message, as a replay would)
+        self.start(verbose)
+        found = []
+        for (channel, group) in logdata.channels.items():
+            labels = logdata.formats[channel].labels if channel in logdata.formats else sorted(group)
+            for (field, stats) in logdata.channelStats(channel).items():
+                order = labels.index(field) if field in labels else len(labels)
+                if stats.nanCount:
+                    found.append((stats.firstNaNLine, order, "NaN", channel, field))
+                if stats.infCount:
+                    found.append((stats.firstInfLine, order, "Inf", channel, field))
+        self.nanFields = [(kind, channel, field) for (line, order, kind, channel, field) in sorted(found)]
+        self.finish(logdata)
+
+    def finish(self, logdata):
         self.result = TestResult()
         self.result.status = TestResult.StatusType.GOOD
 
         def FAIL():
             self.result.status = TestResult.StatusType.FAIL
 
-
-        for channel in logdata.channels.keys():
-            for field in logdata.channels[channel].keys():
-                try:
-                    for tupe in logdata.channels[channel][field].listData:
-                        (ts, val) = tupe
-                        if isinstance(val, float) and math.isnan(val):
-                            FAIL()
-                            self.result.statusMessage += "Found NaN in %s.%s\n" % (channel, field,)
-                            raise ValueError()
-                except ValueError as e:
-                    continue
+        for (kind, channel, field) in self.nanFields:
+            FAIL()
+            self.result.statusMessage += "Found %s in %s.%s\n" % (kind, channel, field,)
+        if self.nanFields:
+            fields = []
+            for (kind, channel, field) in self.nanFields:
+                if "%s.%s" % (channel, field) not in fields:
+                    fields.append("%s.%s" % (channel, field))
+            self.result.dataWindows = [DataWindow(fields)]
@@ -3,7 +3,6 @@ import DataflashLog
 
 import math
 import numpy as np
-import matplotlib.pyplot as plt
 
 class TestFlow(Test):
     '''test optical flow sensor scale factor calibration'''
@@ -56,29 +55,13 @@ class TestFlow(Test):
 
             # load required optical flow data
             if "OF" in logdata.channels:
-                flowX = np.zeros(len(logdata.channels["OF"]["flowX"].listData))
-                for i in range(len(logdata.channels["OF"]["flowX"].listData)):
-                    (line, flowX[i])  = logdata.channels["OF"]["flowX"].listData[i]
-
-                bodyX = np.zeros(len(logdata.channels["OF"]["bodyX"].listData))
-                for i in range(len(logdata.channels["OF"]["bodyX"].listData)):
-                    (line, bodyX[i])  = logdata.channels["OF"]["bodyX"].listData[i]
-
-                flowY = np.zeros(len(logdata.channels["OF"]["flowY"].listData))
-                for i in range(len(logdata.channels["OF"]["flowY"].listData)):
-                    (line, flowY[i])  = logdata.channels["OF"]["flowY"].listData[i]
-
-                bodyY = np.zeros(len(logdata.channels["OF"]["bodyY"].listData))
-                for i in range(len(logdata.channels["OF"]["bodyY"].listData)):
-                    (line, bodyY[i])  = logdata.channels["OF"]["bodyY"].listData[i]
-
-                flow_time_us = np.zeros(len(logdata.channels["OF"]["TimeUS"].listData))
-                for i in range(len(logdata.channels["OF"]["TimeUS"].listData)):
-                    (line, flow_time_us[i])  = logdata.channels["OF"]["TimeUS"].listData[i]
-
-                flow_qual = np.zeros(len(logdata.channels["OF"]["Qual"].listData))
-                for i in range(len(logdata.channels["OF"]["Qual"].listData)):
-                    (line, flow_qual[i])  = logdata.channels["OF"]["Qual"].listData[i]
+                flow = logdata.timeIndex("OF")
+                flowX = np.asarray(flow.values("flowX"), dtype=float)
+                bodyX = np.asarray(flow.values("bodyX"), dtype=float)
+                flowY = np.asarray(flow.values("flowY"), dtype=float)
+                bodyY = np.asarray(flow.values("bodyY"), dtype=float)
+                flow_time_us = np.asarray(flow.values("TimeUS"), dtype=float)
+                flow_qual = np.asarray(flow.values("Qual"), dtype=float)
 
             else:
                 FAIL()
@@ -87,46 +70,35 @@ class TestFlow(Test):
 
             # load required attitude data
             if "ATT" in logdata.channels:
-                Roll = np.zeros(len(logdata.channels["ATT"]["Roll"].listData))
-                for i in range(len(logdata.channels["ATT"]["Roll"].listData)):
-                    (line, Roll[i])  = logdata.channels["ATT"]["Roll"].listData[i]
-
-                Pitch = np.zeros(len(logdata.channels["ATT"]["Pitch"].listData))
-                for i in range(len(logdata.channels["ATT"]["Pitch"].listData)):
-                    (line, Pitch[i])  = logdata.channels["ATT"]["Pitch"].listData[i]
-
-                att_time_us = np.zeros(len(logdata.channels["ATT"]["TimeUS"].listData))
-                for i in range(len(logdata.channels["ATT"]["TimeUS"].listData)):
-                    (line, att_time_us[i])  = logdata.channels["ATT"]["TimeUS"].listData[i]
+                att = logdata.timeIndex("ATT")
+                Roll = np.asarray(att.values("Roll"), dtype=float)
+                Pitch = np.asarray(att.values("Pitch"), dtype=float)
+                att_time = att.times
 
             else:
                 FAIL()
                 self.result.statusMessage = "FAIL: no attitude data\n"
                 return
 
-            # calculate the start time for the roll calibration
-            startTime = int(0)
-            startRollIndex = int(0)
-            for i in range(len(Roll)):
-                if abs(Roll[i]) > tilt_threshold:
-                    startTime = att_time_us[i]
-                    break
-            for i in range(len(flow_time_us)):
-                if flow_time_us[i] > startTime:
-                    startRollIndex = i
-                    break
-
-            # calculate the end time for the roll calibration
-            endTime = int(0)
-            endRollIndex = int(0)
-            for i in range(len(Roll)-1,-1,-1):
-                if abs(Roll[i]) > tilt_threshold:
-                    endTime = att_time_us[i]
-                    break
-            for i in range(len(flow_time_us)-1,-1,-1):
-                if flow_time_us[i] < endTime:
-                    endRollIndex = i
-                    break
+            def calibrationRange(angle):
+                # the flow samples between the first and last times the vehicle is tilted past tilt_threshold
+                tilted = np.flatnonzero(np.abs(angle) > tilt_threshold)
+                startTime = att_time[tilted[0]] if len(tilted) else 0
+                endTime   = att_time[tilted[-1]] if len(tilted) else 0
+                startIndex = flow.searchTime(startTime, 'right')
+                if startIndex >= len(flow):
+                    startIndex = 0
+                endIndex = max(flow.searchTime(endTime, 'left') - 1, 0)
+                return (int(startIndex), int(endIndex))
+
+            def usable(startIndex, endIndex, bodyRate):
+                # samples within the calibration range with enough (but not too much) angular rate and good flow quality
+                index = np.arange(len(flow_time_us))
+                return (index >= startIndex) & (index <= endIndex) & (index < len(Roll)) & \
+                       (np.abs(bodyRate) > min_rate_threshold) & (np.abs(bodyRate) < max_rate_threshold) & (flow_qual > quality_threshold)
+
+            # calculate the start and end of the roll calibration
+            (startRollIndex, endRollIndex) = calibrationRange(Roll)
 
             # check we have enough roll data points
             if (endRollIndex - startRollIndex <= min_num_points):
@@ -136,38 +108,13 @@ class TestFlow(Test):
 
             # resample roll test data excluding data before first movement and after last movement
             # also exclude data where there is insufficient angular rate
-            flowX_resampled = []
-            bodyX_resampled = []
-            flowX_time_us_resampled = []
-            for i in range(len(Roll)):
-                if (i >= startRollIndex) and (i <= endRollIndex) and (abs(bodyX[i]) > min_rate_threshold) and (abs(bodyX[i]) < max_rate_threshold) and (flow_qual[i] > quality_threshold):
-                    flowX_resampled.append(flowX[i])
-                    bodyX_resampled.append(bodyX[i])
-                    flowX_time_us_resampled.append(flow_time_us[i])
-
-            # calculate the start time for the pitch calibration
-            startTime = 0
-            startPitchIndex = int(0)
-            for i in range(len(Pitch)):
-                if abs(Pitch[i]) > tilt_threshold:
-                    startTime = att_time_us[i]
-                    break
-            for i in range(len(flow_time_us)):
-                if flow_time_us[i] > startTime:
-                    startPitchIndex = i
-                    break
-
-            # calculate the end time for the pitch calibration
-            endTime = 0
-            endPitchIndex = int(0)
-            for i in range(len(Pitch)-1,-1,-1):
-                if abs(Pitch[i]) > tilt_threshold:
-                    endTime = att_time_us[i]
-                    break
-            for i in range(len(flow_time_us)-1,-1,-1):
-                if flow_time_us[i] < endTime:
-                    endPitchIndex = i
-                    break
+            rollMask = usable(startRollIndex, endRollIndex, bodyX)
+            flowX_resampled = flowX[rollMask]
+            bodyX_resampled = bodyX[rollMask]
+            flowX_time_us_resampled = flow_time_us[rollMask]
+
+            # calculate the start and end of the pitch calibration
+            (startPitchIndex, endPitchIndex) = calibrationRange(Pitch)
 
             # check we have enough pitch data points
             if (endPitchIndex - startPitchIndex <= min_num_points):
@@ -177,14 +124,10 @@ class TestFlow(Test):
 
             # resample pitch test data excluding data before first movement and after last movement
             # also exclude data where there is insufficient or too much angular rate
-            flowY_resampled = []
-            bodyY_resampled = []
-            flowY_time_us_resampled = []
-            for i in range(len(Roll)):
-                if (i >= startPitchIndex) and (i <= endPitchIndex) and (abs(bodyY[i]) > min_rate_threshold) and (abs(bodyY[i]) < max_rate_threshold) and (flow_qual[i] > quality_threshold):
-                    flowY_resampled.append(flowY[i])
-                    bodyY_resampled.append(bodyY[i])
-                    flowY_time_us_resampled.append(flow_time_us[i])
+            pitchMask = usable(startPitchIndex, endPitchIndex, bodyY)
+            flowY_resampled = flowY[pitchMask]
+            bodyY_resampled = bodyY[pitchMask]
+            flowY_time_us_resampled = flow_time_us[pitchMask]
 
             # fit a straight line to the flow vs body rate data and calculate the scale factor parameter required to achieve a slope of 1
             coef_flow_x , cov_x = np.polyfit(bodyX_resampled,flowX_resampled,1,rcond=None, full=False, w=None, cov=True)
@@ -195,9 +138,9 @@ class TestFlow(Test):
             flow_fyscaler_new = int(1000 * (((1 + 0.001 * float(flow_fyscaler))/coef_flow_y[0] - 1)))
 
             # Do a sanity check on the scale factor variance
-            if sqrt(cov_x[0][0]) > param_std_threshold or sqrt(cov_y[0][0]) > param_std_threshold:
+            if math.sqrt(cov_x[0][0]) > param_std_threshold or math.sqrt(cov_y[0][0]) > param_std_threshold:
                 FAIL()
-                self.result.statusMessage = "FAIL: inaccurate fit - poor quality or insufficient data\nFLOW_FXSCALER 1STD = %u\nFLOW_FYSCALER 1STD = %u\n" % (round(1000*sqrt(cov_x[0][0])),round(1000*sqrt(cov_y[0][0])))
+                self.result.statusMessage = "FAIL: inaccurate fit - poor quality or insufficient data\nFLOW_FXSCALER 1STD = %u\nFLOW_FYSCALER 1STD = %u\n" % (round(1000*math.sqrt(cov_x[0][0])),round(1000*math.sqrt(cov_y[0][0])))
 
             # Do a sanity check on the scale factors
             if abs(flow_fxscaler_new) > param_abs_threshold or abs(flow_fyscaler_new) > param_abs_threshold:
@@ -205,7 +148,7 @@ class TestFlow(Test):
                 self.result.statusMessage = "FAIL: required scale factors are excessive\nFLOW_FXSCALER=%i\nFLOW_FYSCALER=%i\n" % (flow_fxscaler,flow_fyscaler)
 
             # display recommended scale factors
-            self.result.statusMessage = "Set FLOW_FXSCALER to %i\nSet FLOW_FYSCALER to %i\n\nCal plots saved to flow_calibration.pdf\nCal parameters saved to flow_calibration.param\n\nFLOW_FXSCALER 1STD = %u\nFLOW_FYSCALER 1STD = %u\n" % (flow_fxscaler_new,flow_fyscaler_new,round(1000*sqrt(cov_x[0][0])),round(1000*sqrt(cov_y[0][0])))
+            self.result.statusMessage = "Set FLOW_FXSCALER to %i\nSet FLOW_FYSCALER to %i\n\nCal plots saved to flow_calibration.pdf\nCal parameters saved to flow_calibration.param\n\nFLOW_FXSCALER 1STD = %u\nFLOW_FYSCALER 1STD = %u\n" % (flow_fxscaler_new,flow_fyscaler_new,round(1000*math.sqrt(cov_x[0][0])),round(1000*math.sqrt(cov_y[0][0])))
 
             # calculate fit display data
             body_rate_display = [-max_rate_threshold,max_rate_threshold]
@@ -215,6 +158,8 @@ class TestFlow(Test):
             flowY_display = fit_coef_y(body_rate_display)
 
             # plot and save calibration test points to PDF
+            # matplotlib is only imported here, it is slow to load and most logs have no flow data
+            import matplotlib.pyplot as plt
             from matplotlib.backends.backend_pdf import PdfPages
             output_plot_filename = "flow_calibration.pdf"
             pp = PdfPages(output_plot_filename)
@@ -1,4 +1,4 @@
-from LogAnalyzer import Test,TestResult
+from LogAnalyzer import Test,TestResult,DataWindow
 import DataflashLog
 
 import collections
@@ -8,6 +8,8 @@ class TestPitchRollCoupling(Test):
     '''test for divergence between input and output pitch/roll, i.e. mechanical failure or bad PID tuning'''
     # TODO: currently we're only checking for roll/pitch outside of max lean angle, will come back later to analyze roll/pitch in versus out values
 
+    windowLines = 2000  # lines either side of the worst angle in the result's data window
+
     def __init__(self):
         Test.__init__(self)
         self.name = "Pitch/Roll"
@@ -105,10 +107,12 @@ class TestPitchRollCoupling(Test):
         if maxRoll and abs(maxRoll)>abs(maxPitch):
             self.result.status = TestResult.StatusType.FAIL
             self.result.statusMessage = "Roll (%.2f, line %d) > maximum lean angle (%.2f)" % (maxRoll, maxRollLine, maxLeanAngle)
+            self.result.dataWindows = [DataWindow(["ATT.Roll", "ATT.DesRoll"], max(maxRollLine-self.windowLines, 0), maxRollLine+self.windowLines)]
             return
         if maxPitch:
             self.result.status = TestResult.StatusType.FAIL
             self.result.statusMessage = "Pitch (%.2f, line %d) > maximum lean angle (%.2f)" % (maxPitch, maxPitchLine, maxLeanAngle)
+            self.result.dataWindows = [DataWindow(["ATT.Pitch", "ATT.DesPitch"], max(maxPitchLine-self.windowLines, 0), maxPitchLine+self.windowLines)]
             return
 
 
@@ -1,6 +1,6 @@
 from __future__ import print_function
 
-from LogAnalyzer import Test,TestResult
+from LogAnalyzer import Test,TestResult,DataWindow
 import DataflashLog
 
 
@@ -68,13 +68,16 @@ class TestThrust(Test):
             (startLine,endLine) = (data[seg[0]][0], data[seg[1]][0])
             avgClimbRate = logdata.channels["CTUN"][climbRate].getSegment(startLine,endLine).avg()
             avgThrOut    = logdata.channels["CTUN"]["ThrOut"].getSegment(startLine,endLine).avg()
+            window = DataWindow(["CTUN.ThrOut", "CTUN."+climbRate], startLine, endLine)
             if avgClimbRate < climbThresholdFAIL:
                 self.result.status = TestResult.StatusType.FAIL
                 self.result.statusMessage = "Avg climb rate %.2f cm/s for throttle avg %d" % (avgClimbRate,avgThrOut)
+                self.result.dataWindows = [window]
                 return
             if avgClimbRate < climbThresholdWARN:
                 self.result.status = TestResult.StatusType.WARN
                 self.result.statusMessage = "Avg climb rate %.2f  cm/s for throttle avg %d" % (avgClimbRate,avgThrOut)
+                self.result.dataWindows = [window]
 
 
 
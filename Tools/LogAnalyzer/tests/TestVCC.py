@@ -1,34 +1,62 @@
-from LogAnalyzer import Test,TestResult
+from LogAnalyzer import StreamTest,TestResult,DataWindow
 import DataflashLog
 
 import collections
 
 
-class TestVCC(Test):
+class TestVCC(StreamTest):
     '''test for VCC within recommendations, or abrupt end to log in flight'''
+    streamTypes = ("CURR", "POWR")
 
     def __init__(self):
-        Test.__init__(self)
+        StreamTest.__init__(self)
         self.name = "VCC"
 
-    def run(self, logdata, verbose):
+    def start(self, verbose):
+        self.haveCURR = False
+        self.vcc = {}  # message type -> (min, max) Vcc
+
+    def on_message(self, lineNumber, message):
+        if message.NAME == "CURR":
+            self.haveCURR = True
+        if "Vcc" in message.labels:
+            vcc = message.Vcc
+            (vccMin, vccMax) = self.vcc.get(message.NAME, (vcc, vcc))
+            self.vcc[message.NAME] = (min(vccMin, vcc), max(vccMax, vcc))
+
+    def run(self, logdata, verbose=False):
+        # the Vcc range comes from the channel stats, rather than replaying every message
+        self.start(verbose)
+        self.haveCURR = "CURR" in logdata.channels
+        for name in self.streamTypes:
+            if name in logdata.channels and "Vcc" in logdata.channels[name]:
+                stats = logdata.channels[name]["Vcc"].stats
+                if stats.min is not None:
+                    self.vcc[name] = (stats.min, stats.max)
+        self.finish(logdata)
+
+    def finish(self, logdata):
         self.result = TestResult()
         self.result.status = TestResult.StatusType.GOOD
 
-        if not "CURR" in logdata.channels:
+        if not self.haveCURR:
             self.result.status = TestResult.StatusType.UNKNOWN
             self.result.statusMessage = "No CURR log data"
             return
 
         # just a naive min/max test for now
-        try:
-            vccMin  = logdata.channels["CURR"]["Vcc"].min()
-            vccMax  = logdata.channels["CURR"]["Vcc"].max()
-        except KeyError as e:
-            vccMin  = logdata.channels["POWR"]["Vcc"].min()
-            vccMax  = logdata.channels["POWR"]["Vcc"].max()
+        if "CURR" in self.vcc:
+            (vccMin, vccMax) = self.vcc["CURR"]
+            window = DataWindow(["CURR.Vcc"])
+        elif "POWR" in self.vcc:
+            (vccMin, vccMax) = self.vcc["POWR"]
+            window = DataWindow(["POWR.Vcc"])
             vccMin *= 1000
             vccMax *= 1000
+        else:
+            self.result.status = TestResult.StatusType.UNKNOWN
+            self.result.statusMessage = "No Vcc log data"
+            return
 
         vccDiff = vccMax - vccMin;
         vccMinThreshold = 4.6 * 1000;
@@ -39,4 +67,5 @@ class TestVCC(Test):
         elif vccMin < vccMinThreshold:
             self.result.status = TestResult.StatusType.FAIL
             self.result.statusMessage = "VCC below minimum of %sv (%sv)" % (repr(vccMinThreshold/1000.0),repr(vccMin/1000.0))
-        
+        if self.result.status != TestResult.StatusType.GOOD:
+            self.result.dataWindows = [window]
@@ -1,6 +1,6 @@
 from __future__ import print_function
 
-from LogAnalyzer import Test,TestResult
+from LogAnalyzer import Test,TestResult,DataWindow
 import DataflashLog
 
 import numpy
@@ -9,6 +9,8 @@ import numpy
 class TestVibration(Test):
     '''test for accelerometer vibration (accX/accY/accZ) within recommendations'''
 
+    stableModes = ["LOITER", "HYBRID", "POSHOLD", "AUTO"]  # modes in which the vehicle holds steady, each segment of them is checked
+
     def __init__(self):
         Test.__init__(self)
         self.name = "Vibration"
@@ -33,29 +35,29 @@ class TestVibration(Test):
             self.result.statusMessage = "No IMU log data"
             return
 
-        # find some stable LOITER data to analyze, at least 10 seconds
-        chunks = DataflashLog.DataflashLogHelper.findLoiterChunks(logdata, minLengthSeconds=10, noRCInputs=True)
-        if not chunks:
+        # find the stable LOITER/AUTO/etc. segments to analyze, at least 10 seconds each
+        segments = logdata.segmentIndex()
+        if segments.startTimes is None:
+            self.result.status = TestResult.StatusType.UNKNOWN
+            self.result.statusMessage = "No GPS log data to time flight mode segments"
+            return
+        indices = segments.indices(self.stableModes, minLengthSeconds=10)
+        if not len(indices):
             self.result.status = TestResult.StatusType.UNKNOWN
-            self.result.statusMessage = "No stable LOITER log data found"       
+            self.result.statusMessage = "No stable LOITER/AUTO log data found"
             return
 
-        # for now we'll just use the first (largest) chunk of LOITER data
         # TODO: ignore the first couple of secs to avoid bad data during transition - or can we check more analytically that we're stable?
-        # TODO: accumulate all LOITER chunks over min size, or just use the largest one?
-        startLine = chunks[0][0]
-        endLine   = chunks[0][1]
-        #print("TestVibration using LOITER chunk from lines %s to %s" % (repr(startLine), repr(endLine)))
-
-        def getStdDevIMU(logdata, channelName, startLine,endLine):
-            loiterData = logdata.channels["IMU"][channelName].getSegment(startLine,endLine)
-            numpyData  = numpy.array(loiterData.dictData.values())
-            return numpy.std(numpyData)
-
         # use 2x standard deviations as the metric, so if 95% of samples lie within the aim range we're good
-        stdDevX = abs(2 * getStdDevIMU(logdata,"AccX",startLine,endLine))
-        stdDevY = abs(2 * getStdDevIMU(logdata,"AccY",startLine,endLine))
-        stdDevZ = abs(2 * getStdDevIMU(logdata,"AccZ",startLine,endLine))
+        # each segment is a view of the IMU arrays, and the worst one decides the result
+        imu = logdata.channels["IMU"]
+        stdDevs = []  # (X,Y,Z) per segment
+        for axis in ("AccX", "AccY", "AccZ"):
+            values = imu[axis].values
+            stdDevs.append([abs(2 * numpy.std(values[s])) if s.stop > s.start else 0.0 for s in segments.slices(imu[axis], indices)])
+        stdDevs = list(zip(*stdDevs))
+        worst = max(range(len(indices)), key=lambda i: max(stdDevs[i][0] / aimRangeFailXY, stdDevs[i][1] / aimRangeFailXY, stdDevs[i][2] / aimRangeFailZ))
+        (stdDevX, stdDevY, stdDevZ) = stdDevs[worst]
         if (stdDevX > aimRangeFailXY) or (stdDevY > aimRangeFailXY) or (stdDevZ > aimRangeFailZ):
             self.result.status = TestResult.StatusType.FAIL
             self.result.statusMessage = "Vibration too high (X:%.2fg, Y:%.2fg, Z:%.2fg)" % (stdDevX,stdDevY,stdDevZ)
@@ -65,5 +67,10 @@ class TestVibration(Test):
         else:
             self.result.status = TestResult.StatusType.GOOD
             self.result.statusMessage = "Good vibration values (X:%.2fg, Y:%.2fg, Z:%.2fg)" % (stdDevX,stdDevY,stdDevZ)
-
-        
+        if self.result.status != TestResult.StatusType.GOOD:
+            segment = segments[indices[worst]]
+            self.result.dataWindows = [DataWindow(["IMU.AccX", "IMU.AccY", "IMU.AccZ"], segment.startLine, segment.endLine)]
+        if len(indices) > 1:
+            for (i, (x, y, z)) in zip(indices, stdDevs):
+                segment = segments[i]
+                self.result.statusMessage += "\n%s lines %d-%d (X:%.2fg, Y:%.2fg, Z:%.2fg)" % (segment.mode, segment.startLine, segment.endLine, x, y, z)
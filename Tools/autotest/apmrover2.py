@@ -111,38 +111,25 @@ def drive_APMrover2(binary, viewerip=None, use_map=False, valgrind=False, gdb=Fa
     if frame is None:
         frame = 'rover'
 
-    options = '--sitl=127.0.0.1:5501 --out=127.0.0.1:19550 --streamrate=10'
+    options = '--sitl=%s --out=%s --streamrate=10' % (util.sitl_address(), util.mavlink_address())
     if viewerip:
         options += " --out=%s:14550" % viewerip
     if use_map:
         options += ' --map'
 
     home = "%f,%f,%u,%u" % (HOME.lat, HOME.lng, HOME.alt, HOME.heading)
-    sitl = util.start_SITL(binary, wipe=True, model=frame, home=home, speedup=10)
-    mavproxy = util.start_MAVProxy_SITL('APMrover2', options=options)
-
-    print("WAITING FOR PARAMETERS")
-    mavproxy.expect('Received [0-9]+ parameters')
 
     # setup test parameters
     if params is None:
         params = vinfo.options["APMrover2"]["frames"][frame]["default_params_filename"]
     if not isinstance(params, list):
         params = [params]
-    for x in params:
-        mavproxy.send("param load %s\n" % os.path.join(testdir, x))
-        mavproxy.expect('Loaded [0-9]+ parameters')
-    mavproxy.send("param set LOG_REPLAY 1\n")
-    mavproxy.send("param set LOG_DISARMED 1\n")
-    time.sleep(3)
-
-    # restart with new parms
-    util.pexpect_close(mavproxy)
-    util.pexpect_close(sitl)
+    defaults_file = write_test_defaults('APMrover2', binary, params, [("LOG_REPLAY", 1), ("LOG_DISARMED", 1)])
 
-    sitl = util.start_SITL(binary, model='rover', home=home, speedup=10, valgrind=valgrind, gdb=gdb)
+    sitl = util.start_SITL(binary, wipe=True, model='rover', home=home, speedup=10,
+                           defaults_file=defaults_file, valgrind=valgrind, gdb=gdb)
     mavproxy = util.start_MAVProxy_SITL('APMrover2', options=options)
-    mavproxy.expect('Telemetry log: (\S+)')
+    util.expect_ready(mavproxy, 'Telemetry log: (\S+)')
     logfile = mavproxy.match.group(1)
     print("LOGFILE %s" % logfile)
 
@@ -155,7 +142,7 @@ def drive_APMrover2(binary, viewerip=None, use_map=False, valgrind=False, gdb=Fa
     except Exception:
         pass
 
-    mavproxy.expect('Received [0-9]+ parameters')
+    util.expect_ready(mavproxy, 'Received [0-9]+ parameters')
 
     util.expect_setup_callback(mavproxy, expect_callback)
 
@@ -166,9 +153,9 @@ def drive_APMrover2(binary, viewerip=None, use_map=False, valgrind=False, gdb=Fa
 
     # get a mavlink connection going
     try:
-        mav = mavutil.mavlink_connection('127.0.0.1:19550', robust_parsing=True)
+        mav = mavutil.mavlink_connection(util.mavlink_address(), robust_parsing=True)
     except Exception as msg:
-        print("Failed to start mavlink connection on 127.0.0.1:19550" % msg)
+        print("Failed to start mavlink connection on %s: %s" % (util.mavlink_address(), msg))
         raise
     mav.message_hooks.append(message_hook)
     mav.idle_hooks.append(idle_hook)
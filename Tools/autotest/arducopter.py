@@ -10,7 +10,6 @@ from __future__ import print_function
 import math
 import os
 import shutil
-import time
 
 import pexpect
 from pymavlink import mavutil, mavwp
@@ -972,34 +971,23 @@ def fly_ArduCopter(binary, viewerip=None, use_map=False, valgrind=False, gdb=Fal
         frame = '+'
 
     home = "%f,%f,%u,%u" % (HOME.lat, HOME.lng, HOME.alt, HOME.heading)
-    sitl = util.start_SITL(binary, wipe=True, model=frame, home=home, speedup=speedup_default)
-    mavproxy = util.start_MAVProxy_SITL('ArduCopter', options='--sitl=127.0.0.1:5501 --out=127.0.0.1:19550 --quadcopter')
-    mavproxy.expect('Received [0-9]+ parameters')
 
     # setup test parameters
     if params is None:
         params = vinfo.options["ArduCopter"]["frames"][frame]["default_params_filename"]
     if not isinstance(params, list):
         params = [params]
-    for x in params:
-        mavproxy.send("param load %s\n" % os.path.join(testdir, x))
-        mavproxy.expect('Loaded [0-9]+ parameters')
-    mavproxy.send("param set LOG_REPLAY 1\n")
-    mavproxy.send("param set LOG_DISARMED 1\n")
-    time.sleep(3)
-
-    # reboot with new parameters
-    util.pexpect_close(mavproxy)
-    util.pexpect_close(sitl)
+    defaults_file = write_test_defaults('ArduCopter', binary, params, [("LOG_REPLAY", 1), ("LOG_DISARMED", 1)])
 
-    sitl = util.start_SITL(binary, model=frame, home=home, speedup=speedup_default, valgrind=valgrind, gdb=gdb)
-    options = '--sitl=127.0.0.1:5501 --out=127.0.0.1:19550 --quadcopter --streamrate=5'
+    sitl = util.start_SITL(binary, wipe=True, model=frame, home=home, speedup=speedup_default,
+                           defaults_file=defaults_file, valgrind=valgrind, gdb=gdb)
+    options = '--sitl=%s --out=%s --quadcopter --streamrate=5' % (util.sitl_address(), util.mavlink_address())
     if viewerip:
         options += ' --out=%s:14550' % viewerip
     if use_map:
         options += ' --map'
     mavproxy = util.start_MAVProxy_SITL('ArduCopter', options=options)
-    mavproxy.expect('Telemetry log: (\S+)')
+    util.expect_ready(mavproxy, 'Telemetry log: (\S+)')
     logfile = mavproxy.match.group(1)
     print("LOGFILE %s" % logfile)
 
@@ -1025,9 +1013,9 @@ def fly_ArduCopter(binary, viewerip=None, use_map=False, valgrind=False, gdb=Fal
 
     # get a mavlink connection going
     try:
-        mav = mavutil.mavlink_connection('127.0.0.1:19550', robust_parsing=True)
+        mav = mavutil.mavlink_connection(util.mavlink_address(), robust_parsing=True)
     except Exception as msg:
-        print("Failed to start mavlink connection on 127.0.0.1:19550" % msg)
+        print("Failed to start mavlink connection on %s: %s" % (util.mavlink_address(), msg))
         raise
     mav.message_hooks.append(message_hook)
     mav.idle_hooks.append(idle_hook)
@@ -1325,34 +1313,23 @@ def fly_CopterAVC(binary, viewerip=None, use_map=False, valgrind=False, gdb=Fals
         frame = 'heli'
 
     home = "%f,%f,%u,%u" % (AVCHOME.lat, AVCHOME.lng, AVCHOME.alt, AVCHOME.heading)
-    sitl = util.start_SITL(binary, wipe=True, model=frame, home=home, speedup=speedup_default)
-    mavproxy = util.start_MAVProxy_SITL('ArduCopter', options='--sitl=127.0.0.1:5501 --out=127.0.0.1:19550')
-    mavproxy.expect('Received [0-9]+ parameters')
 
     # setup test parameters
     if params is None:
         params = vinfo.options["ArduCopter"]["frames"][frame]["default_params_filename"]
     if not isinstance(params, list):
         params = [params]
-    for x in params:
-        mavproxy.send("param load %s\n" % os.path.join(testdir, x))
-        mavproxy.expect('Loaded [0-9]+ parameters')
-    mavproxy.send("param set LOG_REPLAY 1\n")
-    mavproxy.send("param set LOG_DISARMED 1\n")
-    time.sleep(3)
-
-    # reboot with new parameters
-    util.pexpect_close(mavproxy)
-    util.pexpect_close(sitl)
+    defaults_file = write_test_defaults('CopterAVC', binary, params, [("LOG_REPLAY", 1), ("LOG_DISARMED", 1)])
 
-    sitl = util.start_SITL(binary, model='heli', home=home, speedup=speedup_default, valgrind=valgrind, gdb=gdb)
-    options = '--sitl=127.0.0.1:5501 --out=127.0.0.1:19550 --streamrate=5'
+    sitl = util.start_SITL(binary, wipe=True, model='heli', home=home, speedup=speedup_default,
+                           defaults_file=defaults_file, valgrind=valgrind, gdb=gdb)
+    options = '--sitl=%s --out=%s --streamrate=5' % (util.sitl_address(), util.mavlink_address())
     if viewerip:
         options += ' --out=%s:14550' % viewerip
     if use_map:
         options += ' --map'
     mavproxy = util.start_MAVProxy_SITL('ArduCopter', options=options)
-    mavproxy.expect('Telemetry log: (\S+)')
+    util.expect_ready(mavproxy, 'Telemetry log: (\S+)')
     logfile = mavproxy.match.group(1)
     print("LOGFILE %s" % logfile)
 
@@ -1380,9 +1357,9 @@ def fly_CopterAVC(binary, viewerip=None, use_map=False, valgrind=False, gdb=Fals
 
     # get a mavlink connection going
     try:
-        mav = mavutil.mavlink_connection('127.0.0.1:19550', robust_parsing=True)
+        mav = mavutil.mavlink_connection(util.mavlink_address(), robust_parsing=True)
     except Exception as msg:
-        print("Failed to start mavlink connection on 127.0.0.1:19550" % msg)
+        print("Failed to start mavlink connection on %s: %s" % (util.mavlink_address(), msg))
         raise
     mav.message_hooks.append(message_hook)
     mav.idle_hooks.append(idle_hook)
@@ -448,7 +448,7 @@ def fly_ArduPlane(binary, viewerip=None, use_map=False, valgrind=False, gdb=Fals
     """
     global homeloc
 
-    options = '--sitl=127.0.0.1:5501 --out=127.0.0.1:19550 --streamrate=10'
+    options = '--sitl=%s --out=%s --streamrate=10' % (util.sitl_address(), util.mavlink_address())
     if viewerip:
         options += " --out=%s:14550" % viewerip
     if use_map:
@@ -458,7 +458,7 @@ def fly_ArduPlane(binary, viewerip=None, use_map=False, valgrind=False, gdb=Fals
                           valgrind=valgrind, gdb=gdb,
                           defaults_file=os.path.join(testdir, 'default_params/plane-jsbsim.parm'))
     mavproxy = util.start_MAVProxy_SITL('ArduPlane', options=options)
-    mavproxy.expect('Telemetry log: (\S+)')
+    util.expect_ready(mavproxy, 'Telemetry log: (\S+)')
     logfile = mavproxy.match.group(1)
     print("LOGFILE %s" % logfile)
 
@@ -473,7 +473,7 @@ def fly_ArduPlane(binary, viewerip=None, use_map=False, valgrind=False, gdb=Fals
 
     util.expect_setup_callback(mavproxy, expect_callback)
 
-    mavproxy.expect('Received [0-9]+ parameters')
+    util.expect_ready(mavproxy, 'Received [0-9]+ parameters')
 
     expect_list_clear()
     expect_list_extend([sitl, mavproxy])
@@ -482,9 +482,9 @@ def fly_ArduPlane(binary, viewerip=None, use_map=False, valgrind=False, gdb=Fals
 
     # get a mavlink connection going
     try:
-        mav = mavutil.mavlink_connection('127.0.0.1:19550', robust_parsing=True)
+        mav = mavutil.mavlink_connection(util.mavlink_address(), robust_parsing=True)
     except Exception as msg:
-        print("Failed to start mavlink connection on 127.0.0.1:19550" % msg)
+        print("Failed to start mavlink connection on %s: %s" % (util.mavlink_address(), msg))
         raise
     mav.message_hooks.append(message_hook)
     mav.idle_hooks.append(idle_hook)
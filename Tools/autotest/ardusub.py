@@ -98,32 +98,22 @@ def dive_ArduSub(binary, viewerip=None, use_map=False, valgrind=False, gdb=False
     you can pass viewerip as an IP address to optionally send fg and
     mavproxy packets too for local viewing of the mission in real time
     """
-    options = '--sitl=127.0.0.1:5501 --out=127.0.0.1:19550 --streamrate=10'
+    options = '--sitl=%s --out=%s --streamrate=10' % (util.sitl_address(), util.mavlink_address())
     if viewerip:
         options += " --out=%s:14550" % viewerip
     if use_map:
         options += ' --map'
 
     home = "%f,%f,%u,%u" % (HOME.lat, HOME.lng, HOME.alt, HOME.heading)
-    sitl = util.start_SITL(binary, model='vectored', wipe=True, home=home, speedup=10)
-    mavproxy = util.start_MAVProxy_SITL('ArduSub', options=options)
-    mavproxy.expect('Received [0-9]+ parameters')
 
     # setup test parameters
-    mavproxy.send("param load %s/default_params/sub.parm\n" % testdir)
-    mavproxy.expect('Loaded [0-9]+ parameters')
-    mavproxy.send('param set FS_GCS_ENABLE 0\n')
-    mavproxy.send("param set LOG_REPLAY 1\n")
-    mavproxy.send("param set LOG_DISARMED 1\n")
-    time.sleep(3)
-
-    # reboot with new parameters
-    util.pexpect_close(mavproxy)
-    util.pexpect_close(sitl)
+    defaults_file = write_test_defaults('ArduSub', binary, ['default_params/sub.parm'],
+                                        [("FS_GCS_ENABLE", 0), ("LOG_REPLAY", 1), ("LOG_DISARMED", 1)])
 
-    sitl = util.start_SITL(binary, model='vectored', home=home, speedup=10, valgrind=valgrind, gdb=gdb)
+    sitl = util.start_SITL(binary, model='vectored', wipe=True, home=home, speedup=10,
+                           defaults_file=defaults_file, valgrind=valgrind, gdb=gdb)
     mavproxy = util.start_MAVProxy_SITL('ArduSub', options=options)
-    mavproxy.expect('Telemetry log: (\S+)')
+    util.expect_ready(mavproxy, 'Telemetry log: (\S+)')
     logfile = mavproxy.match.group(1)
     print("LOGFILE %s" % logfile)
 
@@ -136,7 +126,7 @@ def dive_ArduSub(binary, viewerip=None, use_map=False, valgrind=False, gdb=False
     except Exception:
         pass
 
-    mavproxy.expect('Received [0-9]+ parameters')
+    util.expect_ready(mavproxy, 'Received [0-9]+ parameters')
 
     util.expect_setup_callback(mavproxy, expect_callback)
 
@@ -147,9 +137,9 @@ def dive_ArduSub(binary, viewerip=None, use_map=False, valgrind=False, gdb=False
 
     # get a mavlink connection going
     try:
-        mav = mavutil.mavlink_connection('127.0.0.1:19550', robust_parsing=True)
+        mav = mavutil.mavlink_connection(util.mavlink_address(), robust_parsing=True)
     except Exception as msg:
-        print("Failed to start mavlink connection on 127.0.0.1:19550" % msg)
+        print("Failed to start mavlink connection on %s: %s" % (util.mavlink_address(), msg))
         raise
     mav.message_hooks.append(message_hook)
     mav.idle_hooks.append(idle_hook)
@@ -21,24 +21,38 @@ import arduplane
 import quadplane
 import ardusub
 from pysim import util
+from pysim.sitl_pool import SITLPool, pool_key
 
 os.environ['PYTHONUNBUFFERED'] = '1'
 
 os.putenv('TMPDIR', util.reltopdir('tmp'))
 
 
-def get_default_params(atype, binary):
-    """Get default parameters."""
-
+def default_params_model(binary):
+    """Return the model the defaults steps run binary with."""
     # use rover simulator so SITL is not starved of input
+    if binary.find("plane") != -1 or binary.find("rover") != -1:
+        return "rover"
+    return "+"
+
+
+def default_params_home():
+    """Return the home the defaults steps run SITL at."""
     from pymavlink import mavutil
     HOME = mavutil.location(40.071374969556928, -105.22978898137808, 1583.702759, 246)
-    if binary.find("plane") != -1 or binary.find("rover") != -1:
-        frame = "rover"
-    else:
-        frame = "+"
+    return home_option(HOME)
+
+
+def home_option(loc):
+    """Return a location as SITL's --home option."""
+    return "%f,%f,%u,%u" % (loc.lat, loc.lng, loc.alt, loc.heading)
 
-    home = "%f,%f,%u,%u" % (HOME.lat, HOME.lng, HOME.alt, HOME.heading)
+
+def get_default_params(atype, binary):
+    """Get default parameters."""
+
+    frame = default_params_model(binary)
+    home = default_params_home()
     sitl = util.start_SITL(binary, wipe=True, model=frame, home=home, speedup=10, unhide_parameters=True)
     mavproxy = util.start_MAVProxy_SITL(atype)
     print("Dumping defaults")
@@ -169,6 +183,8 @@ parser.add_option("--gdb", default=False, action='store_true', help='run ArduPil
 parser.add_option("--debug", default=False, action='store_true', help='make built binaries debug binaries')
 parser.add_option("-j", default=None, type='int', help='build CPUs')
 parser.add_option("--frame", type='string', default=None, help='specify frame type')
+parser.add_option("--parallel", default=1, type='int', help='number of steps to run at once, each vehicle test with its own SITL instance and ports')
+parser.add_option("--pool", default=False, action='store_true', help='keep SITL instances running between steps starting the same vehicle and frame, resetting them rather than starting them again')
 
 opts, args = parser.parse_args()
 
@@ -226,22 +242,39 @@ def skip_step(step):
     return False
 
 
-def binary_path(step, debug=False):
+# the SITL binary built by each vehicle build step
+build_targets = {
+    'build.ArduPlane': 'arduplane',
+    'build.APMrover2': 'ardurover',
+    'build.ArduCopter': 'arducopter',
+    'build.AntennaTracker': 'antennatracker',
+    'build.Helicopter': 'arducopter-heli',
+    'build.ArduSub': 'ardusub',
+}
+
+
+def binary_name(step):
+    """Return the name of the SITL binary a step runs, or None."""
     if step.find("ArduCopter") != -1:
-        binary_name = "arducopter"
+        return "arducopter"
     elif step.find("ArduPlane") != -1:
-        binary_name = "arduplane"
+        return "arduplane"
     elif step.find("APMrover2") != -1:
-        binary_name = "ardurover"
+        return "ardurover"
     elif step.find("AntennaTracker") != -1:
-        binary_name = "antennatracker"
+        return "antennatracker"
     elif step.find("CopterAVC") != -1:
-        binary_name = "arducopter-heli"
+        return "arducopter-heli"
     elif step.find("QuadPlane") != -1:
-        binary_name = "arduplane"
+        return "arduplane"
     elif step.find("ArduSub") != -1:
-        binary_name = "ardusub"
-    else:
+        return "ardusub"
+    return None
+
+
+def binary_path(step, debug=False):
+    name = binary_name(step)
+    if name is None:
         # cope with builds that don't have a specific binary
         return None
 
@@ -250,7 +283,7 @@ def binary_path(step, debug=False):
     else:
         binary_basedir = "sitl"
 
-    binary = util.reltopdir(os.path.join('build', binary_basedir, 'bin', binary_name))
+    binary = util.reltopdir(os.path.join('build', binary_basedir, 'bin', name))
     if not os.path.exists(binary):
         if os.path.exists(binary + ".exe"):
             binary += ".exe"
@@ -260,8 +293,47 @@ def binary_path(step, debug=False):
     return binary
 
 
-def run_step(step):
-    """Run one step."""
+def sitl_args(step):
+    """Return the start_SITL() arguments, less the defaults file, of the
+    wiped SITL instance a step starts, or None if it doesn't start one."""
+    if step.startswith('defaults.'):
+        return dict(model=default_params_model(binary_name(step)), home=default_params_home(), speedup=10,
+                    unhide_parameters=True)
+    return {
+        'fly.ArduCopter': dict(model=opts.frame or '+', home=home_option(arducopter.HOME),
+                               speedup=arducopter.speedup_default, valgrind=opts.valgrind, gdb=opts.gdb),
+        'fly.CopterAVC': dict(model='heli', home=home_option(arducopter.AVCHOME),
+                              speedup=arducopter.speedup_default, valgrind=opts.valgrind, gdb=opts.gdb),
+        'fly.QuadPlane': dict(model='quadplane', home=quadplane.HOME_LOCATION,
+                              speedup=10, valgrind=opts.valgrind, gdb=opts.gdb),
+        'drive.APMrover2': dict(model='rover', home=home_option(apmrover2.HOME),
+                                speedup=10, valgrind=opts.valgrind, gdb=opts.gdb),
+        'dive.ArduSub': dict(model='vectored', home=home_option(ardusub.HOME),
+                             speedup=10, valgrind=opts.valgrind, gdb=opts.gdb),
+    }.get(step)
+
+
+def pool_keys(steps):
+    """Return the keys (see SITLPool.want()) of the wiped SITL instances
+    steps start, for the SITL pool. A step starting its instance differently
+    from these just doesn't get a pooled one."""
+    keys = []
+    for step in steps:
+        args = sitl_args(step)
+        if args is None or args.get('gdb'):
+            # the pool doesn't run instances under gdb
+            continue
+        try:
+            binary = binary_path(step, debug=opts.debug)
+        except ValueError:
+            # not built yet
+            continue
+        keys.append(pool_key(util.sitl_command(binary, wipe=True, **args)))
+    return keys
+
+
+def run_step(step, clean=True):
+    """Run one step. clean is passed to the SITL build steps."""
 
     # remove old logs
     util.run_cmd('/bin/rm -f logs/*.BIN logs/LASTLOG.TXT')
@@ -269,23 +341,8 @@ def run_step(step):
     if step == "prerequisites":
         return test_prerequisites()
 
-    if step == 'build.ArduPlane':
-        return util.build_SITL('bin/arduplane', j=opts.j, debug=opts.debug)
-
-    if step == 'build.APMrover2':
-        return util.build_SITL('bin/ardurover', j=opts.j, debug=opts.debug)
-
-    if step == 'build.ArduCopter':
-        return util.build_SITL('bin/arducopter', j=opts.j, debug=opts.debug)
-
-    if step == 'build.AntennaTracker':
-        return util.build_SITL('bin/antennatracker', j=opts.j, debug=opts.debug)
-
-    if step == 'build.Helicopter':
-        return util.build_SITL('bin/arducopter-heli', j=opts.j, debug=opts.debug)
-    
-    if step == 'build.ArduSub':
-        return util.build_SITL('bin/ardusub', j=opts.j, debug=opts.debug)
+    if step in build_targets:
+        return util.build_SITL('bin/%s' % build_targets[step], j=opts.j, debug=opts.debug, clean=clean)
 
     binary = binary_path(step, debug=opts.debug)
 
@@ -481,45 +538,170 @@ def check_logs(step):
         util.run_cmd('/bin/cp A*/A*.elf ../buildlogs', directory=util.reltopdir('.'))
 
 
-def run_tests(steps):
-    """Run a list of steps."""
+def ready_wait_report():
+    """Return how long the current step waited for SITL and MAVProxy
+    readiness, for its PASSED/FAILED line."""
+    if util.ready_wait_time == 0:
+        return ""
+    return " (%.1fs waiting for SITL and MAVProxy readiness)" % util.ready_wait_time
+
+
+def run_steps(steps):
+    """Run a list of steps one after another, returning the failed steps."""
     global results
 
-    passed = True
     failed = []
-    for step in steps:
+    for (i, step) in enumerate(steps):
         util.pexpect_close_all()
-        if skip_step(step):
-            continue
+        if util.sitl_pool is not None:
+            util.sitl_pool.want(pool_keys(steps[i+1:]))
 
         t1 = time.time()
+        util.reset_ready_wait()
         print(">>>> RUNNING STEP: %s at %s" % (step, time.asctime()))
         try:
             if not run_step(step):
-                print(">>>> FAILED STEP: %s at %s" % (step, time.asctime()))
-                passed = False
+                print(">>>> FAILED STEP: %s at %s%s" % (step, time.asctime(), ready_wait_report()))
                 failed.append(step)
                 results.add(step, '<span class="failed-text">FAILED</span>', time.time() - t1)
                 continue
         except Exception as msg:
-            passed = False
             failed.append(step)
-            print(">>>> FAILED STEP: %s at %s (%s)" % (step, time.asctime(), msg))
+            print(">>>> FAILED STEP: %s at %s (%s)%s" % (step, time.asctime(), msg, ready_wait_report()))
             traceback.print_exc(file=sys.stdout)
             results.add(step, '<span class="failed-text">FAILED</span>', time.time() - t1)
             check_logs(step)
             continue
         results.add(step, '<span class="passed-text">PASSED</span>', time.time() - t1)
-        print(">>>> PASSED STEP: %s at %s" % (step, time.asctime()))
+        print(">>>> PASSED STEP: %s at %s%s" % (step, time.asctime(), ready_wait_report()))
         check_logs(step)
-    if not passed:
+    return failed
+
+
+def is_vehicle_step(step):
+    """See if a step runs a SITL vehicle."""
+    return step.split('.')[0] in ('defaults', 'fly', 'drive', 'dive')
+
+
+def step_dependencies(step, steps):
+    """Return the steps in steps which must finish before step can start.
+
+    Vehicle steps only wait for the build of their binary, the vehicle builds
+    run one at a time, and any other step waits for everything before it, as
+    does everything after it."""
+    earlier = steps[:steps.index(step)]
+    barriers = [s for s in earlier if not is_vehicle_step(s) and s not in build_targets]
+    if is_vehicle_step(step):
+        builds = [s for s in earlier if build_targets.get(s) == binary_name(step)]
+        return barriers + builds[-1:]
+    if step in build_targets:
+        return barriers + [s for s in earlier if s in build_targets]
+    return earlier
+
+
+def step_output(step):
+    """Return the file a step's output goes to when running in parallel."""
+    return util.reltopdir('../buildlogs/%s-output.txt' % step)
+
+
+def start_step(step, instance, clean):
+    """Fork a process running a step on its own SITL instance, in its own
+    working directory and with its output going to step_output(step).
+    The process exits with 0 if the step passed. Returns its pid."""
+    sys.stdout.flush()
+    pid = os.fork()
+    if pid != 0:
+        return pid
+    passed = False
+    try:
+        # SITL and MAVProxy write their eeprom, logs and aircraft directories to the current directory
+        workdir = util.reltopdir('tmp/autotest/%s' % step)
+        util.mkdir_p(workdir)
+        os.chdir(workdir)
+        output = open(step_output(step), mode='w')
+        os.dup2(output.fileno(), sys.stdout.fileno())
+        os.dup2(output.fileno(), sys.stderr.fileno())
+        util.set_instance(instance)
+        print(">>>> RUNNING STEP: %s at %s (instance %u in %s)" % (step, time.asctime(), instance, workdir))
+        try:
+            passed = run_step(step, clean=clean)
+        except Exception as msg:
+            print(">>>> FAILED STEP: %s at %s (%s)" % (step, time.asctime(), msg))
+            traceback.print_exc(file=sys.stdout)
+        print(">>>> FINISHED STEP: %s at %s%s" % (step, time.asctime(), ready_wait_report()))
+        check_logs(step)
+    except Exception:
+        traceback.print_exc(file=sys.stdout)
+    finally:
+        util.pexpect_close_all()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(0 if passed else 1)
+
+
+def run_steps_parallel(steps, jobs):
+    """Run a list of steps with up to jobs at once, returning the failed steps.
+
+    Each running step gets the lowest free SITL instance, and so its own block
+    of ports, see util.set_instance()."""
+    global results
+
+    failed = []
+    pending = list(steps)
+    running = {}  # pid -> (step, instance, start time)
+    finished = set()
+    cleaned = False
+    while pending or running:
+        for step in pending[:]:
+            if len(running) >= jobs:
+                break
+            if not all(dep in finished for dep in step_dependencies(step, steps)):
+                continue
+            instance = min(set(range(jobs)) - set(r[1] for r in running.values()))
+            # only the first SITL build cleans, later ones would remove the binaries of running steps
+            clean = step in build_targets and not cleaned
+            cleaned = cleaned or step in build_targets
+            print(">>>> STARTING STEP: %s at %s (instance %u)" % (step, time.asctime(), instance))
+            pending.remove(step)
+            running[start_step(step, instance, clean)] = (step, instance, time.time())
+
+        (pid, status) = os.waitpid(-1, 0)
+        if pid not in running:
+            continue
+        (step, instance, t1) = running.pop(pid)
+        finished.add(step)
+        sys.stdout.write(util.loadfile(step_output(step)))
+        results.addfile('%s output' % step, os.path.basename(step_output(step)))
+        if status != 0:
+            failed.append(step)
+            results.add(step, '<span class="failed-text">FAILED</span>', time.time() - t1)
+            print(">>>> FAILED STEP: %s at %s" % (step, time.asctime()))
+        else:
+            results.add(step, '<span class="passed-text">PASSED</span>', time.time() - t1)
+            print(">>>> PASSED STEP: %s at %s" % (step, time.asctime()))
+    return failed
+
+
+def run_tests(steps):
+    """Run a list of steps."""
+    global results
+
+    steps = [step for step in steps if not skip_step(step)]
+    if opts.parallel > 1:
+        failed = run_steps_parallel(steps, opts.parallel)
+    else:
+        failed = run_steps(steps)
+    if failed:
         print("FAILED %u tests: %s" % (len(failed), failed))
 
+    if util.sitl_pool is not None:
+        util.sitl_pool.close()
+        print(util.sitl_pool.report())
     util.pexpect_close_all()
 
     write_fullresults()
 
-    return passed
+    return not failed
 
 
 util.mkdir_p(util.reltopdir('../buildlogs'))
@@ -532,6 +714,14 @@ if lck is None:
 
 atexit.register(util.pexpect_close_all)
 
+if opts.pool:
+    if opts.parallel > 1:
+        # each parallel step runs in a process of its own, there is nothing to reuse
+        print("--pool is ignored with --parallel")
+    else:
+        util.sitl_pool = SITLPool(util.reltopdir('tmp/sitl-pool'))
+        atexit.register(util.sitl_pool.close)
+
 if len(args) > 0:
     # allow a wildcard list of steps
     matched = []
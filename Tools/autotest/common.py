@@ -1,10 +1,11 @@
 from __future__ import print_function
 import math
+import os
 import time
 
 from pymavlink import mavwp
 
-from pysim import util
+from pysim import param_loader, util
 
 # a list of pexpect objects to read while waiting for
 # messages. This keeps the output to stdout flowing
@@ -62,176 +63,312 @@ def get_bearing(loc1, loc2):
     return bearing
 
 
+class TelemetryMonitor(object):
+    """The latest state of the vehicle, from its MAVLink messages.
+
+    The monitor is a message hook of the connection, so it sees each message
+    once as pymavlink decodes it, whoever is receiving. It keeps the latest
+    message of each type, tracks the sim time from the time_boot_ms of the
+    messages which have it, and passes each message to the callbacks
+    subscribed to its type. The wait_* helpers below are predicates over
+    this state, checked as the messages they depend on arrive, with
+    timeouts in sim time.
+    """
+    def __init__(self, mav):
+        self.mav = mav
+        self.messages = {}
+        self.subscribers = {}
+        self.sim_time = None
+        self.timed_messages = 0
+        self.wait_start = None
+        self.last_progress = None
+
+    def message_hook(self, mav, m):
+        mtype = m.get_type()
+        if mtype == 'BAD_DATA':
+            return
+        self.messages[mtype] = m
+        time_boot_ms = getattr(m, 'time_boot_ms', None)
+        if time_boot_ms is not None:
+            self.sim_time = time_boot_ms * 1.0e-3
+            self.timed_messages += 1
+        for callback in self.subscribers.get(mtype, [])[:]:
+            callback(m)
+
+    def subscribe(self, mtype, callback):
+        """Call callback(m) with each message m of type mtype."""
+        self.subscribers.setdefault(mtype, []).append(callback)
+
+    def unsubscribe(self, mtype, callback):
+        self.subscribers[mtype].remove(callback)
+
+    def update(self, timeout=0.1):
+        """Receive the messages which have arrived, waiting up to timeout
+        seconds for the first."""
+        m = self.mav.recv_match(blocking=True, timeout=timeout)
+        while m is not None:
+            m = self.mav.recv_msg()
+
+    def have(self, *mtypes):
+        """See if messages of all the given types have been received."""
+        return all(mtype in self.messages for mtype in mtypes)
+
+    def next_sim_time(self):
+        """Wait for the next message with a sim time and return it, in seconds."""
+        count = self.timed_messages
+        while self.timed_messages == count:
+            self.update()
+        return self.sim_time
+
+    def position_known(self):
+        return self.have('GPS_RAW_INT', 'VFR_HUD') and self.messages['GPS_RAW_INT'].fix_type >= 3
+
+    def location(self):
+        """Return the vehicle's location, once it has a GPS fix."""
+        from pymavlink import mavutil
+        while not self.position_known():
+            self.update()
+        gps = self.messages['GPS_RAW_INT']
+        hud = self.messages['VFR_HUD']
+        return mavutil.location(gps.lat*1.0e-7, gps.lon*1.0e-7, hud.alt, hud.heading)
+
+    def wait(self, predicate, mtypes, timeout=30, fail=None):
+        """Wait for predicate(m) to be true of a message m of one of mtypes,
+        returning True, or for fail(m) to be, or for timeout seconds of sim
+        time to pass, returning False."""
+        result = []
+
+        def check(m):
+            if result:
+                return
+            if predicate(m):
+                result.append(True)
+            elif fail is not None and fail(m):
+                result.append(False)
+        for mtype in mtypes:
+            self.subscribe(mtype, check)
+        self.last_progress = None
+        try:
+            self.wait_start = self.next_sim_time()
+            while not result:
+                if self.sim_time >= self.wait_start + timeout:
+                    return False
+                self.update()
+        finally:
+            for mtype in mtypes:
+                self.unsubscribe(mtype, check)
+        return result[0]
+
+    def progress(self, text):
+        """Print a wait's progress, at most once per second of sim time."""
+        if self.last_progress is not None and self.sim_time is not None and self.sim_time < self.last_progress + 1:
+            return
+        self.last_progress = self.sim_time
+        print(text)
+
+    def restart_timeout(self):
+        """Start the timeout of the current wait again, e.g. on progress."""
+        self.wait_start = self.sim_time
+
+
+def telemetry(mav):
+    """Return the TelemetryMonitor of a connection, starting it on first use."""
+    if getattr(mav, 'telemetry_monitor', None) is None:
+        mav.telemetry_monitor = TelemetryMonitor(mav)
+        mav.message_hooks.append(mav.telemetry_monitor.message_hook)
+    return mav.telemetry_monitor
+
+
 def wait_seconds(mav, seconds_to_wait):
-    tstart = get_sim_time(mav)
-    tnow = tstart
-    while tstart + seconds_to_wait > tnow:
-        tnow = get_sim_time(mav)
+    monitor = telemetry(mav)
+    tstart = monitor.next_sim_time()
+    while tstart + seconds_to_wait > monitor.next_sim_time():
+        pass
 
 
 def get_sim_time(mav):
-    m = mav.recv_match(type='SYSTEM_TIME', blocking=True)
-    return m.time_boot_ms * 1.0e-3
+    return telemetry(mav).next_sim_time()
 
 
 def wait_altitude(mav, alt_min, alt_max, timeout=30):
     """Wait for a given altitude range."""
-    climb_rate = 0
-    previous_alt = 0
+    previous_alt = [0]
+
+    def reached(m):
+        climb_rate = m.alt - previous_alt[0]
+        previous_alt[0] = m.alt
+        telemetry(mav).progress("Wait Altitude: Cur:%u, min_alt:%u, climb_rate: %u" % (m.alt, alt_min, climb_rate))
+        return m.alt >= alt_min and m.alt <= alt_max
 
-    tstart = get_sim_time(mav)
     print("Waiting for altitude between %u and %u" % (alt_min, alt_max))
-    while get_sim_time(mav) < tstart + timeout:
-        m = mav.recv_match(type='VFR_HUD', blocking=True)
-        climb_rate = m.alt - previous_alt
-        previous_alt = m.alt
-        print("Wait Altitude: Cur:%u, min_alt:%u, climb_rate: %u" % (m.alt, alt_min, climb_rate))
-        if m.alt >= alt_min and m.alt <= alt_max:
-            print("Altitude OK")
-            return True
+    if telemetry(mav).wait(reached, ['VFR_HUD'], timeout=timeout):
+        print("Altitude OK")
+        return True
     print("Failed to attain altitude range")
     return False
 
 
 def wait_groundspeed(mav, gs_min, gs_max, timeout=30):
     """Wait for a given ground speed range."""
-    tstart = get_sim_time(mav)
+    def reached(m):
+        telemetry(mav).progress("Wait groundspeed %.1f, target:%.1f" % (m.groundspeed, gs_min))
+        return m.groundspeed >= gs_min and m.groundspeed <= gs_max
+
     print("Waiting for groundspeed between %.1f and %.1f" % (gs_min, gs_max))
-    while get_sim_time(mav) < tstart + timeout:
-        m = mav.recv_match(type='VFR_HUD', blocking=True)
-        print("Wait groundspeed %.1f, target:%.1f" % (m.groundspeed, gs_min))
-        if m.groundspeed >= gs_min and m.groundspeed <= gs_max:
-            return True
+    if telemetry(mav).wait(reached, ['VFR_HUD'], timeout=timeout):
+        return True
     print("Failed to attain groundspeed range")
     return False
 
 
 def wait_roll(mav, roll, accuracy, timeout=30):
     """Wait for a given roll in degrees."""
-    tstart = get_sim_time(mav)
-    print("Waiting for roll of %d at %s" % (roll, time.ctime()))
-    while get_sim_time(mav) < tstart + timeout:
-        m = mav.recv_match(type='ATTITUDE', blocking=True)
+    def reached(m):
         p = math.degrees(m.pitch)
         r = math.degrees(m.roll)
-        print("Roll %d Pitch %d" % (r, p))
-        if math.fabs(r - roll) <= accuracy:
-            print("Attained roll %d" % roll)
-            return True
+        telemetry(mav).progress("Roll %d Pitch %d" % (r, p))
+        return math.fabs(r - roll) <= accuracy
+
+    print("Waiting for roll of %d at %s" % (roll, time.ctime()))
+    if telemetry(mav).wait(reached, ['ATTITUDE'], timeout=timeout):
+        print("Attained roll %d" % roll)
+        return True
     print("Failed to attain roll %d" % roll)
     return False
 
 
 def wait_pitch(mav, pitch, accuracy, timeout=30):
     """Wait for a given pitch in degrees."""
-    tstart = get_sim_time(mav)
-    print("Waiting for pitch of %u at %s" % (pitch, time.ctime()))
-    while get_sim_time(mav) < tstart + timeout:
-        m = mav.recv_match(type='ATTITUDE', blocking=True)
+    def reached(m):
         p = math.degrees(m.pitch)
         r = math.degrees(m.roll)
-        print("Pitch %d Roll %d" % (p, r))
-        if math.fabs(p - pitch) <= accuracy:
-            print("Attained pitch %d" % pitch)
-            return True
+        telemetry(mav).progress("Pitch %d Roll %d" % (p, r))
+        return math.fabs(p - pitch) <= accuracy
+
+    print("Waiting for pitch of %u at %s" % (pitch, time.ctime()))
+    if telemetry(mav).wait(reached, ['ATTITUDE'], timeout=timeout):
+        print("Attained pitch %d" % pitch)
+        return True
     print("Failed to attain pitch %d" % pitch)
     return False
 
 
 def wait_heading(mav, heading, accuracy=5, timeout=30):
     """Wait for a given heading."""
-    tstart = get_sim_time(mav)
+    def reached(m):
+        telemetry(mav).progress("Heading %u" % m.heading)
+        return math.fabs(m.heading - heading) <= accuracy
+
     print("Waiting for heading %u with accuracy %u" % (heading, accuracy))
-    while get_sim_time(mav) < tstart + timeout:
-        m = mav.recv_match(type='VFR_HUD', blocking=True)
-        print("Heading %u" % m.heading)
-        if math.fabs(m.heading - heading) <= accuracy:
-            print("Attained heading %u" % heading)
-            return True
+    if telemetry(mav).wait(reached, ['VFR_HUD'], timeout=timeout):
+        print("Attained heading %u" % heading)
+        return True
     print("Failed to attain heading %u" % heading)
     return False
 
 
 def wait_distance(mav, distance, accuracy=5, timeout=30):
     """Wait for flight of a given distance."""
-    tstart = get_sim_time(mav)
-    start = mav.location()
-    while get_sim_time(mav) < tstart + timeout:
-        pos = mav.location()
-        delta = get_distance(start, pos)
-        print("Distance %.2f meters" % delta)
-        if math.fabs(delta - distance) <= accuracy:
-            print("Attained distance %.2f meters OK" % delta)
-            return True
-        if delta > (distance + accuracy):
-            print("Failed distance - overshoot delta=%f distance=%f" % (delta, distance))
+    monitor = telemetry(mav)
+    start = monitor.location()
+    delta = [0]
+
+    def reached(m):
+        if not monitor.position_known():
             return False
+        delta[0] = get_distance(start, monitor.location())
+        monitor.progress("Distance %.2f meters" % delta[0])
+        return math.fabs(delta[0] - distance) <= accuracy
+
+    def overshot(m):
+        return monitor.position_known() and delta[0] > (distance + accuracy)
+
+    if monitor.wait(reached, ['GPS_RAW_INT'], timeout=timeout, fail=overshot):
+        print("Attained distance %.2f meters OK" % delta[0])
+        return True
+    if delta[0] > (distance + accuracy):
+        print("Failed distance - overshoot delta=%f distance=%f" % (delta[0], distance))
+        return False
     print("Failed to attain distance %u" % distance)
     return False
 
 
 def wait_location(mav, loc, accuracy=5, timeout=30, target_altitude=None, height_accuracy=-1):
     """Wait for arrival at a location."""
-    tstart = get_sim_time(mav)
+    monitor = telemetry(mav)
     if target_altitude is None:
         target_altitude = loc.alt
+    delta = [0]
+
+    def reached(m):
+        if not monitor.position_known():
+            return False
+        pos = monitor.location()
+        delta[0] = get_distance(loc, pos)
+        monitor.progress("Distance %.2f meters alt %.1f" % (delta[0], pos.alt))
+        if delta[0] > accuracy:
+            return False
+        return height_accuracy == -1 or math.fabs(pos.alt - target_altitude) <= height_accuracy
+
     print("Waiting for location %.4f,%.4f at altitude %.1f height_accuracy=%.1f" % (
         loc.lat, loc.lng, target_altitude, height_accuracy))
-    while get_sim_time(mav) < tstart + timeout:
-        pos = mav.location()
-        delta = get_distance(loc, pos)
-        print("Distance %.2f meters alt %.1f" % (delta, pos.alt))
-        if delta <= accuracy:
-            if height_accuracy != -1 and math.fabs(pos.alt - target_altitude) > height_accuracy:
-                continue
-            print("Reached location (%.2f meters)" % delta)
-            return True
+    if monitor.wait(reached, ['GPS_RAW_INT'], timeout=timeout):
+        print("Reached location (%.2f meters)" % delta[0])
+        return True
     print("Failed to attain location")
     return False
 
 
 def wait_waypoint(mav, wpnum_start, wpnum_end, allow_skip=True, max_dist=2, timeout=400):
     """Wait for waypoint ranges."""
-    tstart = get_sim_time(mav)
+    monitor = telemetry(mav)
     # this message arrives after we set the current WP
     start_wp = mav.waypoint_current()
-    current_wp = start_wp
+    current_wp = [start_wp]
     mode = mav.flightmode
+    failed_early = [False]
 
     print("\ntest: wait for waypoint ranges start=%u end=%u\n\n" % (wpnum_start, wpnum_end))
     # if start_wp != wpnum_start:
     #    print("test: Expected start waypoint %u but got %u" % (wpnum_start, start_wp))
     #    return False
 
-    while get_sim_time(mav) < tstart + timeout:
-        seq = mav.waypoint_current()
-        m = mav.recv_match(type='NAV_CONTROLLER_OUTPUT', blocking=True)
-        wp_dist = m.wp_dist
-        m = mav.recv_match(type='VFR_HUD', blocking=True)
-
-        # if we changed mode, fail
-        if mav.flightmode != mode:
-            print('Exited %s mode' % mode)
+    def reached(m):
+        if mav.flightmode != mode or not monitor.have('VFR_HUD'):
             return False
-
-        print("test: WP %u (wp_dist=%u Alt=%d), current_wp: %u, wpnum_end: %u" % (seq, wp_dist, m.alt, current_wp, wpnum_end))
-        if seq == current_wp+1 or (seq > current_wp+1 and allow_skip):
+        seq = monitor.messages['MISSION_CURRENT'].seq
+        wp_dist = m.wp_dist
+        monitor.progress("test: WP %u (wp_dist=%u Alt=%d), current_wp: %u, wpnum_end: %u" % (
+            seq, wp_dist, monitor.messages['VFR_HUD'].alt, current_wp[0], wpnum_end))
+        if seq == current_wp[0]+1 or (seq > current_wp[0]+1 and allow_skip):
             print("test: Starting new waypoint %u" % seq)
-            tstart = get_sim_time(mav)
-            current_wp = seq
+            monitor.restart_timeout()
+            current_wp[0] = seq
             # the wp_dist check is a hack until we can sort out the right seqnum
             # for end of mission
         # if current_wp == wpnum_end or (current_wp == wpnum_end-1 and wp_dist < 2):
-        if (current_wp == wpnum_end and wp_dist < max_dist):
+        if (current_wp[0] == wpnum_end and wp_dist < max_dist):
             print("Reached final waypoint %u" % seq)
             return True
         if (seq >= 255):
             print("Reached final waypoint %u" % seq)
             return True
-        if seq > current_wp+1:
-            print("Failed: Skipped waypoint! Got wp %u expected %u" % (seq, current_wp+1))
-            return False
-    print("Failed: Timed out waiting for waypoint %u of %u" % (wpnum_end, wpnum_end))
+        return False
+
+    def failed(m):
+        # if we changed mode, fail
+        if mav.flightmode != mode:
+            print('Exited %s mode' % mode)
+            failed_early[0] = True
+        elif monitor.messages['MISSION_CURRENT'].seq > current_wp[0]+1:
+            print("Failed: Skipped waypoint! Got wp %u expected %u" % (monitor.messages['MISSION_CURRENT'].seq, current_wp[0]+1))
+            failed_early[0] = True
+        return failed_early[0]
+
+    if monitor.wait(reached, ['NAV_CONTROLLER_OUTPUT'], timeout=timeout, fail=failed):
+        return True
+    if not failed_early[0]:
+        print("Failed: Timed out waiting for waypoint %u of %u" % (wpnum_end, wpnum_end))
     return False
 
 
@@ -254,6 +391,34 @@ def wait_mode(mav, mode, timeout=None):
     return mav.flightmode
 
 
+def write_test_defaults(atype, binary, param_files, params=[]):
+    """Merge parameter files (relative to the autotest directory) and a list
+    of (name, value) parameters into a SITL --defaults file, so the vehicle
+    boots with its test parameters rather than having them loaded and being
+    rebooted. Returns the file's path.
+
+    SITL panics on a name in a --defaults file which the vehicle doesn't
+    have, so parameters missing from the defaults.<atype> step's dump of
+    binary's parameters are left out, with a warning."""
+    testdir = os.path.dirname(os.path.realpath(__file__))
+    defaults = param_loader.read_param_files([os.path.join(testdir, f) for f in param_files])
+    for (name, value) in params:
+        defaults[name.upper()] = value
+    dump = util.reltopdir('../buildlogs/%s-defaults.parm' % atype)
+    if os.path.exists(dump) and os.path.getmtime(dump) >= os.path.getmtime(binary):
+        known = param_loader.read_param_file(dump)
+        unknown = [name for name in defaults.keys() if name not in known]
+        if unknown:
+            print("WARNING: %s has no parameters %s, leaving them out" % (os.path.basename(binary), ", ".join(unknown)))
+            for name in unknown:
+                del defaults[name]
+    else:
+        print("WARNING: no dump of the parameters of %s to check the defaults against" % binary)
+    filename = os.path.abspath("%s-test-defaults.parm" % atype)
+    param_loader.write_defaults_file(filename, defaults)
+    return filename
+
+
 def mission_count(filename):
     """Load a mission from a file and return number of waypoints."""
     wploader = mavwp.MAVWPLoader()
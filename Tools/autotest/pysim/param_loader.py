@@ -0,0 +1,190 @@
+"""
+ Load parameters into SITL over MAVLink directly, or write them to a
+ SITL --defaults file, rather than through MAVProxy's "param load"
+"""
+from __future__ import print_function
+import collections
+import math
+import struct
+import time
+
+from . import util
+
+
+def read_param_file(filename, params=None):
+    """Read a parameter file of NAME VALUE (or NAME,VALUE) lines, as written
+    by MAVProxy and read by SITL's --defaults, into an ordered dict. Lines
+    starting with # are comments. Updates and returns params if given."""
+    if params is None:
+        params = collections.OrderedDict()
+    f = open(filename, mode='r')
+    for line in f:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        a = line.replace(',', ' ').replace('=', ' ').split()
+        if len(a) < 2:
+            raise RuntimeError("Bad parameter line %s in %s" % (line, filename))
+        params[a[0].upper()] = float(a[1])
+    f.close()
+    return params
+
+
+def read_param_files(filenames):
+    """Read a list of parameter files, later files overriding earlier ones."""
+    params = collections.OrderedDict()
+    for filename in filenames:
+        read_param_file(filename, params)
+    return params
+
+
+def write_defaults_file(filename, params):
+    """Write a dict of parameters to a file for SITL's --defaults option."""
+    f = open(filename, mode='w')
+    for (name, value) in params.items():
+        f.write("%-16s %s\n" % (name, format_value(value)))
+    f.close()
+    print("Wrote %u parameters to %s" % (len(params), filename))
+
+
+def format_value(value):
+    """Format a parameter value without losing float32 precision."""
+    if float(value) == int(value):
+        return "%d" % int(value)
+    return "%.9g" % value
+
+
+def float32(value):
+    """Round a value to the float32 it is sent and stored as."""
+    return struct.unpack('<f', struct.pack('<f', value))[0]
+
+
+def stored_value(value, param_type):
+    """Return the value a parameter of a MAV_PARAM_TYPE holds after being set
+    to value, rounded and clamped to an integer as AP_Param::set_float() does."""
+    from pymavlink import mavutil
+    ranges = {
+        mavutil.mavlink.MAV_PARAM_TYPE_INT8: (-128, 127),
+        mavutil.mavlink.MAV_PARAM_TYPE_INT16: (-32768, 32767),
+        mavutil.mavlink.MAV_PARAM_TYPE_INT32: (-2147483648, 2147483647),
+    }
+    if param_type not in ranges:
+        return float32(value)
+    (low, high) = ranges[param_type]
+    value = float32(value + math.copysign(0.01, value))
+    return float(min(max(int(value), low), high))
+
+
+def param_name(m):
+    """Return the parameter name of a PARAM_VALUE."""
+    name = m.param_id
+    if not isinstance(name, str):
+        name = name.decode('ascii', 'ignore')
+    return name.rstrip('\0').upper()
+
+
+def fetch_params(mav, timeout=60, children=[]):
+    """Fetch all of a vehicle's parameters over a MAVLink connection which
+    has seen its heartbeat, into an ordered dict. Parameters still missing
+    once the vehicle stops sending are requested by index."""
+    mav.mav.param_request_list_send(mav.target_system, mav.target_component)
+    params = {}  # index -> (name, value)
+    count = None
+    tstart = time.time()
+    tlast = tstart
+    while count is None or len(params) < count:
+        now = time.time()
+        if now - tstart > timeout:
+            raise RuntimeError("Timed out fetching parameters (%u of %s)" % (len(params), count))
+        m = mav.recv_match(type='PARAM_VALUE', blocking=True, timeout=0.1)
+        if m is not None:
+            count = m.param_count
+            params[m.param_index] = (param_name(m), m.param_value)
+            tlast = now
+        elif now - tlast > 1.0:
+            if count is None:
+                mav.mav.param_request_list_send(mav.target_system, mav.target_component)
+            else:
+                for index in range(count):
+                    if index not in params:
+                        mav.mav.param_request_read_send(mav.target_system, mav.target_component, b'', index)
+            tlast = now
+        for p in children:
+            util.pexpect_drain(p)
+    return collections.OrderedDict(params[index] for index in sorted(params.keys()))
+
+
+class ParamLoader(object):
+    """Set many parameters over a MAVLink connection.
+
+    Up to window PARAM_SETs are in flight at once. Each is acknowledged by
+    the vehicle's PARAM_VALUE for the parameter with the new value, as
+    stored in the parameter's type, and one not acknowledged within timeout
+    seconds is sent again, up to max_sends times in all. The output of the
+    pexpect children is drained while waiting.
+    """
+    def __init__(self, mav, window=10, timeout=1.0, max_sends=4, children=[]):
+        self.mav = mav
+        self.window = window
+        self.timeout = timeout
+        self.max_sends = max_sends
+        self.children = children
+        self.sent = 0
+        self.resent = 0
+
+    def send(self, name, value):
+        """Send one PARAM_SET."""
+        from pymavlink import mavutil
+        self.mav.mav.param_set_send(self.mav.target_system, self.mav.target_component,
+                                    name.encode('ascii'), value, mavutil.mavlink.MAV_PARAM_TYPE_REAL32)
+        self.sent += 1
+
+    def acknowledged(self, m, inflight):
+        """Return the name of the in flight parameter a PARAM_VALUE acknowledges, or None."""
+        name = param_name(m)
+        if name not in inflight:
+            return None
+        value = stored_value(inflight[name][0], m.param_type)
+        if math.fabs(m.param_value - value) > 1.0e-6 * max(1.0, math.fabs(value)):
+            return None
+        return name
+
+    def load(self, params):
+        """Set a dict of parameters, in order. The connection must have seen
+        the vehicle's heartbeat. Returns the names of the parameters which
+        were never acknowledged, e.g. because the vehicle doesn't have them."""
+        tstart = time.time()
+        pending = list(params.items())
+        inflight = collections.OrderedDict()  # name -> (value, time last sent, times sent)
+        failed = []
+        while pending or inflight:
+            now = time.time()
+            for (name, (value, sent, sends)) in list(inflight.items()):
+                if now - sent < self.timeout:
+                    continue
+                if sends >= self.max_sends:
+                    del inflight[name]
+                    failed.append(name)
+                    continue
+                self.send(name, value)
+                self.resent += 1
+                inflight[name] = (value, now, sends + 1)
+            while pending and len(inflight) < self.window:
+                (name, value) = pending.pop(0)
+                name = name.upper()
+                self.send(name, value)
+                inflight[name] = (value, time.time(), 1)
+
+            m = self.mav.recv_match(type='PARAM_VALUE', blocking=True, timeout=0.05)
+            while m is not None:
+                name = self.acknowledged(m, inflight)
+                if name is not None:
+                    del inflight[name]
+                m = self.mav.recv_match(type='PARAM_VALUE', blocking=False)
+            for p in self.children:
+                util.pexpect_drain(p)
+        print("Set %u parameters in %.2fs (%u PARAM_SETs, %u resent)" % (
+            len(params) - len(failed), time.time() - tstart, self.sent, self.resent))
+        if failed:
+            print("Parameters not acknowledged: %s" % ", ".join(failed))
+        return failed
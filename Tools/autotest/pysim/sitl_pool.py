@@ -0,0 +1,279 @@
+"""
+ A pool of live SITL instances, reused across autotest steps
+"""
+from __future__ import print_function
+import collections
+import os
+import shutil
+import sys
+import time
+
+import pexpect
+
+from . import param_loader, util
+
+# parameters which enable or select something set up at boot. An instance is
+# started again rather than reset when any of them has to change, so this errs
+# on the side of a wipe
+REBOOT_PARAM_SUFFIXES = ('_ENABLE', '_TYPE', '_MONITOR', '_PROTOCOL', '_CLASS', '_MREV', '_VERSION')
+
+
+class PooledInstance(object):
+    """A SITL instance started by the pool."""
+    def __init__(self, child, cmd, binary, model, defaults):
+        self.child = child
+        self.cmd = cmd
+        self.binary = binary
+        self.model = model
+        self.mtime = os.path.getmtime(binary)
+        self.defaults = defaults  # the --defaults parameters it booted with
+        self.boot_params = None  # all its parameters after booting, if it is to be reused
+        self.boot_mode = None  # its flight mode after booting, if it is to be reused
+        self.cwd = None  # the directory of the step using it
+
+    def key(self):
+        return pool_key(self.cmd)
+
+
+def options(cmd):
+    """Return a SITL command line without the options a reset can stand in for."""
+    ret = []
+    skip = False
+    for arg in cmd:
+        if skip:
+            skip = False
+        elif arg == '--defaults':
+            skip = True
+        elif arg != '-w':
+            ret.append(arg)
+    return ret
+
+
+def pool_key(cmd):
+    """Return the key of the instances started with the SITL command line cmd
+    which a reset can make stand in for each other."""
+    return tuple(options(cmd))
+
+
+class SITLPool(object):
+    """Keep SITL instances running between the steps which start the same
+    vehicle binary with the same options, bar -w and --defaults.
+
+    A step closing a pooled instance leaves it running if a later step (see
+    want()) starts an instance with the same key. The next wiped
+    start_SITL() of those is reset over MAVLink rather than started again:
+    the mission is cleared, the parameters which differ from the values it
+    booted with, overridden by the new --defaults file, are set with the
+    ParamLoader, and the flight mode it booted in is set. SITL can't reboot
+    itself, so where a reset can't stand in for a wipe the instance is closed
+    and a new one is started with -w instead: if the binary has been
+    rebuilt, the vehicle is armed or away from its home, it booted with
+    defaults the new ones don't override, or a parameter in
+    REBOOT_PARAM_SUFFIXES has to change. A reset doesn't restore the
+    simulation clock, the simulated battery's consumption or the EKF, which
+    carry on from the last step.
+
+    Only instances a later step can use are kept, and their parameters are
+    only fetched at boot then, so steps which all start their instances
+    differently, as the default step list does, cost nothing extra.
+
+    Pooled instances run in their own directory. When a step closes one its
+    logs and any other files are moved, and its EEPROM copied, to the step's
+    directory, as if it had run there. There is only one pooled instance at
+    a time as they all use this process's SITL ports.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        self.idle = None  # the running instance waiting for a step
+        self.busy = {}  # child -> PooledInstance
+        self.wanted = set()  # keys of the instances later steps start
+        self.hits = 0
+        self.misses = 0
+        self.closed = False
+
+    def want(self, keys):
+        """Set the keys (see pool_key()) of the wiped instances later steps
+        start, closing the idle instance if none of them can use it."""
+        self.wanted = set(keys)
+        if self.idle is not None and self.idle.key() not in self.wanted:
+            self.evict()
+
+    def spawn(self, cmd):
+        """Start an instance in the pool's directory."""
+        shutil.rmtree(self.directory, ignore_errors=True)
+        util.mkdir_p(self.directory)
+        print("Running (pooled): %s" % util.cmd_as_shell(cmd))
+        child = pexpect.spawn(cmd[0], cmd[1:], cwd=self.directory, logfile=sys.stdout, encoding=util.ENCODING, timeout=5)
+        util.expect_ready(child, 'Waiting for connection', timeout=300)
+        return child
+
+    def connect(self, instance):
+        """Open a MAVLink connection straight to an instance."""
+        from pymavlink import mavutil
+        mav = mavutil.mavlink_connection('tcp:127.0.0.1:%u' % util.instance_port(5760), robust_parsing=True)
+        util.wait_heartbeats(mav, 1, timeout=30, children=[instance.child])
+        m = mav.messages['HEARTBEAT']
+        mav.target_system = m.get_srcSystem()
+        mav.target_component = m.get_srcComponent()
+        return mav
+
+    def acquire(self, cmd, binary, model, defaults_file):
+        """Return a wiped instance of binary and model started with the
+        command line cmd, or one reset to stand in for it, ready for its
+        next connection."""
+        defaults = collections.OrderedDict()
+        if defaults_file is not None:
+            defaults = param_loader.read_param_files(defaults_file.split(','))
+        instance = self.idle
+        self.idle = None
+        if instance is not None and not self.reset(instance, cmd, binary, defaults):
+            self.close_instance(instance)
+            instance = None
+        if instance is not None:
+            self.hits += 1
+            print("SITL pool hit: reset %s %s" % (os.path.basename(binary), model))
+        else:
+            self.misses += 1
+            instance = PooledInstance(self.spawn(cmd), cmd, binary, model, defaults)
+            if instance.key() in self.wanted:
+                # remember what the reset restores
+                mav = self.connect(instance)
+                try:
+                    instance.boot_params = param_loader.fetch_params(mav, children=[instance.child])
+                    # by now the vehicle has finished initialising
+                    util.wait_heartbeats(mav, 1, timeout=30, children=[instance.child])
+                    instance.boot_mode = mav.messages['HEARTBEAT'].custom_mode
+                finally:
+                    mav.close()
+        instance.cwd = os.getcwd()
+        self.busy[instance.child] = instance
+        util.pexpect_autoclose(instance.child)
+        return instance.child
+
+    def reset(self, instance, cmd, binary, defaults):
+        """Reset a running instance to stand in for a new one started with
+        cmd. Returns False if it can't."""
+        if (instance.key() != pool_key(cmd) or instance.mtime != os.path.getmtime(binary) or
+                instance.boot_params is None):
+            return False
+        if not set(instance.defaults.keys()) <= set(defaults.keys()):
+            print("SITL pool: can't restore the defaults %s booted with" % os.path.basename(binary))
+            return False
+        util.pexpect_drain(instance.child)
+        mav = self.connect(instance)
+        try:
+            if mav.motors_armed():
+                print("SITL pool: vehicle is armed")
+                return False
+            if not self.at_home(mav, instance):
+                return False
+            target = collections.OrderedDict(instance.boot_params)
+            target.update(defaults)
+            current = param_loader.fetch_params(mav, children=[instance.child])
+            changes = collections.OrderedDict(
+                (name, value) for (name, value) in target.items()
+                if name in current and param_loader.float32(current[name]) != param_loader.float32(value))
+            reboot = [name for name in changes.keys() if name.endswith(REBOOT_PARAM_SUFFIXES)]
+            if reboot:
+                print("SITL pool: %s need a reboot" % ", ".join(reboot))
+                return False
+            mav.mav.mission_clear_all_send(mav.target_system, mav.target_component)
+            if mav.recv_match(type='MISSION_ACK', blocking=True, timeout=10) is None:
+                print("SITL pool: mission not cleared")
+                return False
+            loader = param_loader.ParamLoader(mav, children=[instance.child])
+            if loader.load(changes):
+                return False
+            return self.restore_mode(mav, instance)
+        finally:
+            mav.close()
+
+    def restore_mode(self, mav, instance):
+        """Put the vehicle back in the flight mode it booted in."""
+        from pymavlink import mavutil
+        if mav.messages['HEARTBEAT'].custom_mode == instance.boot_mode:
+            return True
+        mav.mav.set_mode_send(mav.target_system, mavutil.mavlink.MAV_MODE_FLAG_CUSTOM_MODE_ENABLED,
+                              instance.boot_mode)
+        tstart = time.time()
+        while time.time() - tstart < 10:
+            m = mav.recv_match(type='HEARTBEAT', blocking=True, timeout=1)
+            util.pexpect_drain(instance.child)
+            if m is not None and m.custom_mode == instance.boot_mode:
+                return True
+        print("SITL pool: flight mode %u not restored" % instance.boot_mode)
+        return False
+
+    def at_home(self, mav, instance):
+        """See if the vehicle is back where it started."""
+        from pymavlink import mavutil
+        if '--home' not in instance.cmd:
+            return True
+        home = [float(x) for x in instance.cmd[instance.cmd.index('--home')+1].split(',')]
+        mav.mav.request_data_stream_send(mav.target_system, mav.target_component,
+                                         mavutil.mavlink.MAV_DATA_STREAM_POSITION, 4, 1)
+        m = mav.recv_match(type='GLOBAL_POSITION_INT', blocking=True, timeout=10)
+        if m is None:
+            print("SITL pool: no position")
+            return False
+        distance = util.gps_distance(home[0], home[1], m.lat*1.0e-7, m.lon*1.0e-7)
+        if distance > 5 or m.relative_alt > 1000:
+            print("SITL pool: vehicle is %.1fm from home at %.1fm" % (distance, m.relative_alt*1.0e-3))
+            return False
+        return True
+
+    def release(self, child):
+        """Hand a pooled instance back when its step closes it, leaving it
+        running if a later step can use it. Returns False if child isn't
+        from the pool."""
+        if child not in self.busy:
+            return False
+        instance = self.busy.pop(child)
+        self.return_files(instance.cwd)
+        if self.closed or instance.boot_params is None or instance.key() not in self.wanted:
+            self.close_instance(instance)
+            return True
+        if child in util.close_list:
+            util.close_list.remove(child)
+        self.evict()
+        self.idle = instance
+        return True
+
+    def return_files(self, cwd):
+        """Move the logs and other files of an instance to the directory of
+        the step which used it, copying its EEPROM as it may keep running."""
+        for name in os.listdir(self.directory):
+            src = os.path.join(self.directory, name)
+            dest = os.path.join(cwd, name)
+            if name == 'eeprom.bin':
+                shutil.copy(src, dest)
+            elif os.path.isdir(src):
+                util.mkdir_p(dest)
+                for f in os.listdir(src):
+                    util.rmfile(os.path.join(dest, f))
+                    shutil.move(os.path.join(src, f), dest)
+            else:
+                util.rmfile(dest)
+                shutil.move(src, dest)
+
+    def close_instance(self, instance):
+        self.busy.pop(instance.child, None)
+        util.pexpect_close(instance.child)
+
+    def evict(self):
+        """Close the idle instance, e.g. to free the SITL ports for an
+        instance started outside the pool."""
+        if self.idle is None:
+            return
+        self.close_instance(self.idle)
+        self.idle = None
+
+    def close(self):
+        """Close all the pool's instances."""
+        self.closed = True
+        for child in list(self.busy.keys()):
+            self.release(child)
+        self.evict()
+
+    def report(self):
+        return "SITL pool: %u hits, %u misses" % (self.hits, self.misses)
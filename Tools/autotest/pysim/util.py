@@ -3,6 +3,7 @@ import math
 import os
 import random
 import re
+import socket
 import sys
 import time
 from math import acos, atan2, cos, pi, sqrt
@@ -98,14 +99,15 @@ def waf_clean():
     run_cmd([relwaf(), "clean"], directory=topdir(), checkfail=True)
 
 
-def build_SITL(build_target, j=None, debug=False, board='sitl'):
+def build_SITL(build_target, j=None, debug=False, board='sitl', clean=True):
     """Build desktop SITL."""
 
     # first configure
     waf_configure(board, j=j, debug=debug)
 
     # then clean
-    waf_clean()
+    if clean:
+        waf_clean()
 
     # then build
     cmd_make = [relwaf(), "build", "--target", build_target]
@@ -140,9 +142,11 @@ def pexpect_autoclose(p):
 
 
 def pexpect_close(p):
-    """Close a pexpect child."""
+    """Close a pexpect child, or return it to sitl_pool if it came from there."""
     global close_list
 
+    if sitl_pool is not None and sitl_pool.release(p):
+        return
     try:
         p.close()
     except Exception:
@@ -183,12 +187,110 @@ def make_safe_filename(text):
     return filename
 
 
+# the SITL instance run by this process, see set_instance()
+sitl_instance = 0
+
+
+def set_instance(instance):
+    """Set the SITL instance (-I) started by this process.
+
+    Each instance adds 10*instance to all of its SITL and MAVProxy ports, so
+    several simulators can run at once."""
+    global sitl_instance
+    sitl_instance = instance
+
+
+def instance_port(port):
+    """Return an instance 0 port number offset for this process's SITL instance."""
+    return port + 10 * sitl_instance
+
+
+def sitl_address():
+    """Return the address MAVProxy sends SITL its RC input on (--sitl)."""
+    return '127.0.0.1:%u' % instance_port(5501)
+
+
+def mavlink_address():
+    """Return the address of the MAVProxy output the tests connect to."""
+    return '127.0.0.1:%u' % instance_port(19550)
+
+
+# the pool wiped SITL instances are started from, if any, see pysim/sitl_pool.py
+sitl_pool = None
+
+
+# seconds spent waiting for SITL and MAVProxy to become ready since the last reset_ready_wait()
+ready_wait_time = 0.0
+
+
+def reset_ready_wait():
+    """Reset ready_wait_time, e.g. at the start of a step."""
+    global ready_wait_time
+    ready_wait_time = 0.0
+
+
+def wait_ready(description, probe, timeout=60, children=[], interval=0.05):
+    """Wait until probe() returns True, draining the output of the given
+    pexpect children meanwhile so they don't block on it. The time spent is
+    added to ready_wait_time."""
+    global ready_wait_time
+    tstart = time.time()
+    try:
+        while not probe():
+            if time.time() - tstart > timeout:
+                raise RuntimeError("Timed out after %us waiting for %s" % (timeout, description))
+            for p in children:
+                pexpect_drain(p)
+            time.sleep(interval)
+    finally:
+        ready_wait_time += time.time() - tstart
+    print("Ready: %s after %.2fs" % (description, time.time() - tstart))
+
+
+def expect_ready(child, pattern, timeout=60):
+    """Wait for a readiness pattern on a pexpect child's console, adding the
+    time spent to ready_wait_time."""
+    global ready_wait_time
+    tstart = time.time()
+    try:
+        return child.expect(pattern, timeout=timeout)
+    finally:
+        ready_wait_time += time.time() - tstart
+
+
+def tcp_port_listening(port, address='127.0.0.1'):
+    """See if something is listening on a local TCP port, without connecting
+    to it (SITL only accepts one connection on each of its ports)."""
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    # lets the bind succeed over connections of an earlier process still in TIME_WAIT
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    try:
+        s.bind((address, port))
+    except socket.error:
+        return True
+    finally:
+        s.close()
+    return False
+
+
+def wait_heartbeats(mav, count=2, timeout=60, children=[]):
+    """Wait for count HEARTBEATs from the vehicle, e.g. to let a change
+    settle for a moment of sim time."""
+    seen = [0]
+
+    def probe():
+        if mav.recv_match(type='HEARTBEAT', blocking=True, timeout=0.1) is not None:
+            seen[0] += 1
+        return seen[0] >= count
+    wait_ready("%u heartbeats" % count, probe, timeout=timeout, children=children, interval=0)
+
+
 def valgrind_log_filepath(binary, model):
     return make_safe_filename('%s-%s-valgrind.log' % (os.path.basename(binary), model,))
 
 
-def start_SITL(binary, valgrind=False, gdb=False, wipe=False, synthetic_clock=True, home=None, model=None, speedup=1, defaults_file=None, unhide_parameters=False):
-    """Launch a SITL instance."""
+def sitl_command(binary, valgrind=False, gdb=False, wipe=False, synthetic_clock=True, home=None, model=None, speedup=1, defaults_file=None, unhide_parameters=False):
+    """Return the command line start_SITL() runs a SITL instance with."""
     cmd = []
     if valgrind and os.path.exists('/usr/bin/valgrind'):
         cmd.extend(['valgrind', '-q', '--log-file=%s' % valgrind_log_filepath(binary=binary, model=model)])
@@ -199,6 +301,8 @@ def start_SITL(binary, valgrind=False, gdb=False, wipe=False, synthetic_clock=Tr
         cmd.extend(['xterm', '-e', 'gdb', '-x', '/tmp/x.gdb', '--args'])
     
     cmd.append(binary)
+    if sitl_instance != 0:
+        cmd.extend(['-I', str(sitl_instance)])
     if wipe:
         cmd.append('-w')
     if synthetic_clock:
@@ -213,33 +317,47 @@ def start_SITL(binary, valgrind=False, gdb=False, wipe=False, synthetic_clock=Tr
         cmd.extend(['--defaults', defaults_file])
     if unhide_parameters:
         cmd.extend(['--unhide-groups'])
+    return cmd
+
+
+def start_SITL(binary, valgrind=False, gdb=False, wipe=False, synthetic_clock=True, home=None, model=None, speedup=1, defaults_file=None, unhide_parameters=False):
+    """Launch a SITL instance."""
+    cmd = sitl_command(binary, valgrind=valgrind, gdb=gdb, wipe=wipe, synthetic_clock=synthetic_clock, home=home,
+                       model=model, speedup=speedup, defaults_file=defaults_file, unhide_parameters=unhide_parameters)
+    if sitl_pool is not None:
+        if wipe and not gdb:
+            return sitl_pool.acquire(cmd, binary, model, defaults_file)
+        # free the SITL ports for this instance
+        sitl_pool.evict()
     print("Running: %s" % cmd_as_shell(cmd))
     first = cmd[0]
     rest = cmd[1:]
     child = pexpect.spawn(first, rest, logfile=sys.stdout, encoding=ENCODING, timeout=5)
     delaybeforesend = 0
     pexpect_autoclose(child)
-    # give time for parameters to properly setup
-    time.sleep(3)
+    # SITL has set up its parameters by the time it listens for its first connection
     if gdb:
         # if we run GDB we do so in an xterm.  "Waiting for
-        # connection" is never going to appear on xterm's output.
-        # ... so let's give it another magic second.
-        time.sleep(1)
+        # connection" is never going to appear on xterm's output,
+        # so look for the listening port instead
+        wait_ready("SITL listening on port %u" % instance_port(5760),
+                   lambda: tcp_port_listening(instance_port(5760)), timeout=300)
         # TODO: have a SITL-compiled ardupilot able to have its
         # console on an output fd.
     else:
-        child.expect('Waiting for connection', timeout=300)
+        expect_ready(child, 'Waiting for connection', timeout=300)
     return child
 
 
-def start_MAVProxy_SITL(atype, aircraft=None, setup=False, master='tcp:127.0.0.1:5760',
+def start_MAVProxy_SITL(atype, aircraft=None, setup=False, master=None,
                         options=None, logfile=sys.stdout):
     """Launch mavproxy connected to a SITL instance."""
     import pexpect
     global close_list
     MAVPROXY = os.getenv('MAVPROXY_CMD', 'mavproxy.py')
-    cmd = MAVPROXY + ' --master=%s --out=127.0.0.1:14550' % master
+    if master is None:
+        master = 'tcp:127.0.0.1:%u' % instance_port(5760)
+    cmd = MAVPROXY + ' --master=%s --out=127.0.0.1:%u' % (master, instance_port(14550))
     if setup:
         cmd += ' --setup'
     if aircraft is None: